@@ -3,13 +3,34 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import json
 import os
+import struct
 import subprocess
 import tempfile
+import threading
+import zipfile
 from os.path import exists, join
 
 from . import common
 
+# The binary xml chunks of a compiled AndroidManifest.xml (ResChunk_header
+# and friends in frameworks/base/libs/androidfw/include/androidfw/ResourceTypes.h)
+_RES_XML_TYPE = 0x0003
+_RES_STRING_POOL_TYPE = 0x0001
+_RES_XML_START_ELEMENT_TYPE = 0x0102
+_UTF8_FLAG = 0x100
+_TYPE_STRING = 0x03
+_NO_INDEX = 0xffffffff
+
+MANIFEST = "AndroidManifest.xml"
+CACHE_FILE_NAME = "apk_packages.json"
+
+_cache_lock = threading.Lock()
+
+class BadManifest(Exception):
+    pass
+
 def _check_output(args, **kwargs):
     with tempfile.TemporaryFile() as f:
         kwargs['stderr'] = f
@@ -39,8 +60,118 @@ def get_aapt_bin():
 
     raise RuntimeError("Could not find build-tools in " + android_sdk)
 
-def get_package(apk):
+def _read_length(data, offset, utf8):
+    # one unit, or two with the high bit of the first set
+    if utf8:
+        length = struct.unpack_from("<B", data, offset)[0]
+        if length & 0x80:
+            return ((length & 0x7f) << 8) | struct.unpack_from("<B", data, offset + 1)[0], offset + 2
+        return length, offset + 1
+    length = struct.unpack_from("<H", data, offset)[0]
+    if length & 0x8000:
+        return ((length & 0x7fff) << 16) | struct.unpack_from("<H", data, offset + 2)[0], offset + 4
+    return length, offset + 2
+
+def _parse_string_pool(data, start):
+    header_size = struct.unpack_from("<H", data, start + 2)[0]
+    count, _, flags, strings_start = struct.unpack_from("<IIII", data, start + 8)
+    utf8 = flags & _UTF8_FLAG
+    strings = []
+    for i in range(count):
+        offset = start + strings_start + struct.unpack_from("<I", data, start + header_size + 4 * i)[0]
+        if utf8:
+            # the length in utf-16 units, then in bytes
+            _, offset = _read_length(data, offset, True)
+            length, offset = _read_length(data, offset, True)
+            strings.append(data[offset:offset + length].decode("utf-8"))
+        else:
+            length, offset = _read_length(data, offset, False)
+            strings.append(data[offset:offset + 2 * length].decode("utf-16-le"))
+    return strings
+
+def parse_manifest_package(data):
+    """Returns the package attribute of the <manifest> element of a
+    compiled AndroidManifest.xml"""
+    try:
+        chunk_type, header_size, size = struct.unpack_from("<HHI", data, 0)
+        if chunk_type != _RES_XML_TYPE:
+            raise BadManifest("Not a binary xml file")
+
+        strings = None
+        offset = header_size
+        while offset < min(size, len(data)):
+            chunk_type, header_size, chunk_size = struct.unpack_from("<HHI", data, offset)
+            if chunk_size < 8:
+                raise BadManifest("Bad chunk size %d at %d" % (chunk_size, offset))
+            if chunk_type == _RES_STRING_POOL_TYPE and strings is None:
+                strings = _parse_string_pool(data, offset)
+            elif chunk_type == _RES_XML_START_ELEMENT_TYPE:
+                # manifest is the root element, so it is the first one
+                return _find_package(data, offset + header_size, strings)
+            offset += chunk_size
+    except (struct.error, IndexError, TypeError, UnicodeDecodeError) as e:
+        raise BadManifest("Malformed binary xml: %s" % e)
+    raise BadManifest("No <manifest> element")
+
+def _find_package(data, start, strings):
+    _, name, attribute_start, attribute_size, attribute_count = struct.unpack_from("<IIHHH", data, start)
+    if strings[name] != "manifest":
+        raise BadManifest("The root element is <%s>" % strings[name])
+    for i in range(attribute_count):
+        namespace, name, raw_value, _, _, data_type, value = struct.unpack_from(
+            "<IIIHBBI", data, start + attribute_start + i * attribute_size)
+        if namespace == _NO_INDEX and strings[name] == "package":
+            if raw_value != _NO_INDEX:
+                return strings[raw_value]
+            if data_type == _TYPE_STRING:
+                return strings[value]
+            raise BadManifest("The package attribute is not a string")
+    raise BadManifest("<manifest> has no package attribute")
+
+def _get_package_from_apk(apk):
+    with zipfile.ZipFile(apk) as z:
+        return parse_manifest_package(z.read(MANIFEST))
+
+def _get_package_from_aapt(apk):
     output = _check_output([get_aapt_bin(), 'dump', 'badging', apk], stderr=os.devnull)
     for line in output.split('\n'):
         if line.startswith('package:'):
             return parse_package_line(line)
+
+def _get_cache_file(cache_dir):
+    return join(cache_dir or common.get_cache_dir(), CACHE_FILE_NAME)
+
+def _read_cache(cache_dir):
+    try:
+        with open(_get_cache_file(cache_dir)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def get_package(apk, cache_dir=None):
+    """Returns the package name of apk, read from its manifest, with aapt
+    only used if the manifest could not be parsed. The result is cached
+    for as long as the apk keeps its size and mtime."""
+    path = os.path.abspath(apk)
+    st = os.stat(path)
+    with _cache_lock:
+        entry = _read_cache(cache_dir).get(path)
+    if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+        return entry["package"]
+
+    try:
+        package = _get_package_from_apk(path)
+    except (BadManifest, zipfile.BadZipfile, KeyError):
+        package = _get_package_from_aapt(path)
+    if not package:
+        return package
+
+    try:
+        with _cache_lock:
+            cache = _read_cache(cache_dir)
+            cache[path] = {"size": st.st_size, "mtime": st.st_mtime, "package": package}
+            common.write_json(_get_cache_file(cache_dir), cache)
+    except (IOError, OSError):
+        # it is only a cache
+        pass
+    return package
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import socket
+import stat
+import struct
+import subprocess
+import threading
+
+# Speaks the protocol of the adb server (the daemon `adb start-server`
+# runs on the host), so that commands and pulls do not need to spawn the
+# adb binary every time. Requests are a 4 digit hex length followed by the
+# payload, and are answered with OKAY or FAIL. After host:transport the
+# connection talks to the device: shell: streams the output of a command
+# until the device closes it, and sync: switches to the file sync protocol
+# which can pull any number of files over the same connection.
+
+DEFAULT_HOST = "localhost"
+DEFAULT_PORT = 5037
+
+# Connecting to the server should be instantaneous, it either listens or not
+CONNECT_TIMEOUT = 5
+
+_SYNC_CHUNK = 64 * 1024
+_EXIT_MARKER = "__adb_exit__:"
+
+
+class AdbError(RuntimeError):
+    pass
+
+
+def _get_address():
+    host = os.environ.get("ANDROID_ADB_SERVER_ADDRESS", DEFAULT_HOST)
+    port = int(os.environ.get("ANDROID_ADB_SERVER_PORT", DEFAULT_PORT))
+    return host, port
+
+
+def transport_request(adb_args):
+    """The host:transport request that selects the same device as the given
+    adb command line arguments would"""
+    adb_args = list(adb_args)
+    if "-s" in adb_args:
+        return "host:transport:" + adb_args[adb_args.index("-s") + 1]
+    if "-d" in adb_args:
+        return "host:transport-usb"
+    if "-e" in adb_args:
+        return "host:transport-local"
+    return "host:transport-any"
+
+
+def _read_exactly(sock, n):
+    chunks = []
+    while n:
+        chunk = sock.recv(n)
+        if not chunk:
+            raise AdbError("Connection closed by adb server")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+
+def _read_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(_SYNC_CHUNK)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def _send_request(sock, request):
+    payload = request.encode("utf-8")
+    sock.sendall(("%04x" % len(payload)).encode("ascii") + payload)
+    status = _read_exactly(sock, 4)
+    if status == b"OKAY":
+        return
+    if status == b"FAIL":
+        raise AdbError("%s: %s" % (request, _read_hex_string(sock)))
+    raise AdbError("%s: unexpected response %r" % (request, status))
+
+
+def _read_hex_string(sock):
+    length = int(_read_exactly(sock, 4), 16)
+    return _read_exactly(sock, length).decode("utf-8", "replace")
+
+
+class AdbClient:
+    """A client for the adb server, bound to the device adb_args selects"""
+
+    def __init__(self, adb_args=[], host=None, port=None):
+        default_host, default_port = _get_address()
+        self._address = (host or default_host, port or default_port)
+        self._transport = transport_request(adb_args)
+        # idle sync connections, which stay open between pulls
+        self._sync_connections = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.create_connection(self._address, CONNECT_TIMEOUT)
+        sock.settimeout(None)
+        return sock
+
+    def _connect_device(self):
+        sock = self._connect()
+        try:
+            _send_request(sock, self._transport)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def version(self):
+        sock = self._connect()
+        try:
+            _send_request(sock, "host:version")
+            return int(_read_hex_string(sock), 16)
+        finally:
+            sock.close()
+
+    def devices(self):
+        """Returns a list of (serial, state) of every device the server knows"""
+        sock = self._connect()
+        try:
+            _send_request(sock, "host:devices")
+            lines = _read_hex_string(sock).splitlines()
+        finally:
+            sock.close()
+        return [tuple(line.split("\t", 1)) for line in lines if "\t" in line]
+
+    def shell(self, command):
+        """Runs command on the device and returns its output, raising
+        CalledProcessError if it exits with a non zero status like
+        common.check_output() would"""
+        # The shell protocol has no exit status, so print it at the end
+        sock = self._connect_device()
+        try:
+            _send_request(sock, "shell:%s; printf '\\n%s%%d' $?" % (command, _EXIT_MARKER))
+            output = _read_all(sock).decode("utf-8", "replace")
+        finally:
+            sock.close()
+
+        output, marker, status = output.rpartition(_EXIT_MARKER)
+        if not marker:
+            raise AdbError("shell:%s: no exit status in output" % command)
+        # drop the newline printed before the marker, which older devices
+        # running commands on a pty turn into \r\n
+        output = output[:-2] if output.endswith("\r\n") else output[:-1]
+        status = int(status.strip())
+        if status:
+            raise subprocess.CalledProcessError(status, command, output)
+        return output
+
+    def open_remote(self, src):
+        """Returns a file object streaming the contents of src on the
+        device, like `adb exec-out cat` would"""
+        sock = self._connect_device()
+        try:
+            _send_request(sock, "exec:cat %s" % src)
+            # the file keeps the connection open until it is closed
+            return sock.makefile("rb")
+        finally:
+            sock.close()
+
+    def _acquire_sync(self):
+        with self._lock:
+            if self._sync_connections:
+                return self._sync_connections.pop()
+        sock = self._connect_device()
+        try:
+            _send_request(sock, "sync:")
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def _release_sync(self, sock):
+        with self._lock:
+            self._sync_connections.append(sock)
+
+    def _sync_request(self, sock, request_id, path):
+        path = path.encode("utf-8")
+        sock.sendall(request_id + struct.pack("<I", len(path)) + path)
+
+    def _sync(self, operation):
+        # A connection that failed half way through a transfer is in an
+        # unknown state, so only healthy ones go back to the pool
+        sock = self._acquire_sync()
+        try:
+            result = operation(sock)
+        except Exception:
+            sock.close()
+            raise
+        self._release_sync(sock)
+        return result
+
+    def stat(self, path):
+        """Returns (mode, size, mtime) of path on the device, mode is 0 if
+        it does not exist"""
+        def operation(sock):
+            self._sync_request(sock, b"STAT", path)
+            response = _read_exactly(sock, 16)
+            if response[:4] != b"STAT":
+                raise AdbError("STAT %s: unexpected response %r" % (path, response[:4]))
+            return struct.unpack("<III", response[4:])
+
+        return self._sync(operation)
+
+    def list_directory(self, path):
+        """Returns (name, mode, size, mtime) of every entry of the directory
+        path on the device, except . and .."""
+        def operation(sock):
+            self._sync_request(sock, b"LIST", path)
+            entries = []
+            while True:
+                header = _read_exactly(sock, 20)
+                request_id = header[:4]
+                mode, size, mtime, length = struct.unpack("<IIII", header[4:])
+                if request_id == b"DONE":
+                    return entries
+                if request_id != b"DENT":
+                    raise AdbError("LIST %s: unexpected response %r" % (path, request_id))
+                name = _read_exactly(sock, length).decode("utf-8")
+                if name not in (".", ".."):
+                    entries.append((name, mode, size, mtime))
+
+        return self._sync(operation)
+
+    def pull_directory(self, src, dest):
+        """Copies the contents of the directory src on the device into the
+        existing directory dest"""
+        for name, mode, _, _ in self.list_directory(src):
+            remote = src.rstrip("/") + "/" + name
+            local = os.path.join(dest, name)
+            if stat.S_ISDIR(mode):
+                os.mkdir(local)
+                self.pull_directory(remote, local)
+            elif stat.S_ISREG(mode):
+                self.pull(remote, local)
+
+    def pull(self, src, dest):
+        """Copies the file src on the device to dest"""
+        def operation(sock):
+            self._sync_request(sock, b"RECV", src)
+            with open(dest, "wb") as f:
+                while True:
+                    header = _read_exactly(sock, 8)
+                    request_id = header[:4]
+                    length = struct.unpack("<I", header[4:])[0]
+                    if request_id == b"DATA":
+                        f.write(_read_exactly(sock, length))
+                    elif request_id == b"DONE":
+                        return None
+                    elif request_id == b"FAIL":
+                        # the connection is still usable after this
+                        return _read_exactly(sock, length).decode("utf-8", "replace")
+                    else:
+                        raise AdbError("pull %s: unexpected response %r" % (src, request_id))
+
+        try:
+            failure = self._sync(operation)
+        except Exception:
+            if os.path.exists(dest):
+                os.remove(dest)
+            raise
+        if failure is not None:
+            os.remove(dest)
+            raise AdbError("pull %s: %s" % (src, failure))
+
+    def close(self):
+        with self._lock:
+            connections, self._sync_connections = self._sync_connections, []
+        for sock in connections:
+            try:
+                sock.sendall(b"QUIT" + struct.pack("<I", 0))
+            except socket.error:
+                pass
+            sock.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(adb_args=[]):
+    """Returns a shared AdbClient for adb_args, or None if no adb server is
+    listening, in which case the adb binary should be used instead (it
+    starts the server)"""
+    key = (_get_address(), tuple(adb_args))
+    with _clients_lock:
+        client = _clients.get(key)
+    if client is not None:
+        return client
+
+    client = AdbClient(adb_args)
+    try:
+        client.version()
+    except (socket.error, AdbError):
+        return None
+
+    with _clients_lock:
+        return _clients.setdefault(key, client)
@@ -1,12 +1,18 @@
+from . import adb_client
 from . import common
 
 
 class AdbExecutor:
-    def __init__(self):
-        pass
+    def __init__(self, adb_args=[]):
+        self._adb_args = list(adb_args)
 
     def execute(self, command):
-        result = common.check_output([common.get_adb()] + command)
+        client = adb_client.get_client(self._adb_args)
+        if client and command and command[0] == "shell":
+            # adb joins the arguments of shell the same way
+            result = client.shell(" ".join(command[1:]))
+        else:
+            result = common.check_output([common.get_adb()] + self._adb_args + command)
         if result is None:
             raise RuntimeError("ERROR: you shouldn't see this in normal operation,"
                                "file a bug report please.\n\n "
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import codecs
+import getopt
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import zipfile
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+from PIL import Image
+
+from . import comparator
+from . import metadata
+from . import pull_screenshots
+from . import zip_stream
+
+
+def usage():
+    print("usage: python -m android_screenshot_tests.benchmark compare|encode|bundle|report [--size=WxH] [--repeat=N] [--count=N]", file=sys.stderr)
+
+
+def _legacy_difference(im1, im2):
+    # The per-pixel loop Recorder used before the comparator module
+    pairs = zip(im1.getdata(), im2.getdata())
+    if len(im1.getbands()) == 1:
+        return sum(abs(p1 - p2) for p1, p2 in pairs)
+    return sum(abs(c1 - c2) for p1, p2 in pairs for c1, c2 in zip(p1, p2))
+
+
+def _synthetic_pair(size):
+    im1 = Image.new("RGBA", size, "white")
+    im2 = im1.copy()
+    rng = random.Random(size[0] * size[1])
+    for _ in range(100):
+        im2.putpixel((rng.randrange(size[0]), rng.randrange(size[1])), (255, 0, 0, 255))
+    return im1, im2
+
+
+def _time(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def bench_compare(size, repeat):
+    im1, im2 = _synthetic_pair(size)
+    legacy = _time(lambda: _legacy_difference(im1, im2), repeat)
+    vectorized = _time(lambda: comparator.compare(im1, im2), repeat)
+    engine = "numpy" if comparator.numpy is not None else "ImageChops"
+    print("compare %dx%d:" % size)
+    print("  legacy loop:      %8.1f ms" % (legacy * 1000))
+    print("  comparator (%s): %8.1f ms (%.0fx)" % (engine, vectorized * 1000, legacy / vectorized))
+
+
+def _synthetic_screenshot(size):
+    # flat areas with some detail, closer to a real UI than noise is
+    im = Image.effect_mandelbrot(size, (-2.0, -1.5, 1.0, 1.5), 50).convert("RGBA")
+    im.paste((250, 250, 250, 255), (0, 0, size[0], size[1] // 3))
+    return im
+
+
+def bench_encode(size, repeat):
+    im = _synthetic_screenshot(size)
+    expected = im.tobytes()
+    settings = [("level %d" % level, {"compress_level": level}) for level in range(10)]
+    settings.append(("optimize", {"optimize": True}))
+
+    print("encode %dx%d:" % size)
+    for label, options in settings:
+        def encode():
+            out = io.BytesIO()
+            im.save(out, "PNG", **options)
+            return out
+
+        seconds = _time(encode, repeat)
+        out = encode()
+        out.seek(0)
+        with Image.open(out) as decoded:
+            identical = decoded.tobytes() == expected
+        print("  %-10s %8.1f ms %10d bytes%s" % (
+            label, seconds * 1000, len(out.getvalue()), "" if identical else "  PIXELS DIFFER"))
+
+
+def _synthetic_bundle(path, size, count):
+    # The bundle is written by a ZipOutputStream on the device, which puts
+    # sizes in data descriptors since it cannot seek back
+    with open(path, "wb") as f:
+        with zipfile.ZipFile(f if sys.version_info < (3, 5) else _Unseekable(f), "w", zipfile.ZIP_DEFLATED) as z:
+            for i in range(count):
+                im = _synthetic_screenshot(size)
+                im.putpixel((i, i), (255, 0, 0, 255))
+                out = io.BytesIO()
+                im.save(out, "PNG")
+                z.writestr("com.foo.Test_screenshot%d.png" % i, out.getvalue())
+
+
+class _Unseekable(io.RawIOBase):
+    def __init__(self, f):
+        self._f = f
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self._f.write(b)
+
+
+def _disk_usage(dir):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(dir) for name in names)
+
+
+def _pull_then_extract(bundle, dest):
+    # what pull_images does without --stream-bundle
+    local_bundle = os.path.join(dest, "screenshot_bundle.zip")
+    with open(bundle, "rb") as src, open(local_bundle, "wb") as out:
+        shutil.copyfileobj(src, out)
+    with zipfile.ZipFile(local_bundle) as z:
+        z.extractall(dest)
+    peak = _disk_usage(dest)
+    os.remove(local_bundle)
+    return peak
+
+
+def _stream_extract(bundle, dest):
+    with open(bundle, "rb") as src:
+        zip_stream.extract(src, dest)
+    return _disk_usage(dest)
+
+
+def bench_bundle(size, repeat, count=40):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        bundle = os.path.join(tmpdir, "bundle.zip")
+        _synthetic_bundle(bundle, size, count)
+        print("bundle of %d %dx%d screenshots (%.1f MB):" % (
+            count, size[0], size[1], os.path.getsize(bundle) / (1024.0 * 1024)))
+
+        for label, extract in [("pull + extractall", _pull_then_extract),
+                               ("streaming", _stream_extract)]:
+            best = None
+            for _ in range(repeat):
+                dest = tempfile.mkdtemp(dir=tmpdir)
+                start = time.time()
+                peak = extract(bundle, dest)
+                seconds = time.time() - start
+                best = seconds if best is None else min(best, seconds)
+                shutil.rmtree(dest)
+            print("  %-18s %8.1f ms, peak disk %.1f MB" % (label, best * 1000, peak / (1024.0 * 1024)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _synthetic_report_dir(dir, count):
+    # Every screenshot has a tile, and every tenth a view hierarchy
+    node = lambda i, children: {"class": "android.widget.View%d" % i, "left": i, "top": i,
+                                "width": 100, "height": 50, "children": children}
+    hierarchy = node(0, [node(i, [node(10 * i + j, []) for j in range(5)]) for i in range(1, 6)])
+    with codecs.open(os.path.join(dir, "metadata.xml"), "w", encoding="utf-8") as f:
+        f.write("<screenshots>")
+        for i in range(count):
+            name = "com.foo.Test%d_screenshot%d" % (i // 100, i)
+            f.write("<screenshot><name>%s</name><test_class>com.foo.Test%d</test_class>"
+                    "<test_name>screenshot%d</test_name><tile_width>1</tile_width>"
+                    "<tile_height>2</tile_height><description/></screenshot>" % (name, i // 100, i))
+            open(os.path.join(dir, name + ".png"), "w").close()
+            if i % 10 == 0:
+                with open(os.path.join(dir, name + "_dump.json"), "w") as dump:
+                    json.dump({"viewHierarchy": hierarchy, "axHierarchy": hierarchy}, dump)
+        f.write("</screenshots>")
+
+
+def _unbuffered_report(dir, screenshots):
+    # what generate_html did before, every fragment encoded on its own
+    with codecs.open(os.path.join(dir, "index.html"), mode="w", encoding="utf-8") as html:
+        pull_screenshots.write_report(html, dir, screenshots)
+
+
+def _buffered_report(dir, screenshots):
+    pull_screenshots.generate_html(dir, screenshots=screenshots)
+
+
+def _paged_report(dir, screenshots):
+    pull_screenshots.generate_paged_html(dir, screenshots=screenshots)
+
+
+def bench_report(size, repeat, count=10000):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _synthetic_report_dir(tmpdir, count)
+        screenshots = metadata.parse(os.path.join(tmpdir, "metadata.xml"))
+        print("report of %d screenshots:" % count)
+        for label, generate in [("unbuffered", _unbuffered_report), ("buffered", _buffered_report),
+                                ("paged", _paged_report)]:
+            seconds = _time(lambda: generate(tmpdir, screenshots), repeat)
+            peak = ""
+            if tracemalloc is not None:
+                tracemalloc.start()
+                generate(tmpdir, screenshots)
+                peak = ", peak memory %.1f MB" % (tracemalloc.get_traced_memory()[1] / (1024.0 * 1024))
+                tracemalloc.stop()
+            print("  %-10s %8.1f ms, %.1f MB index.html%s" % (
+                label, seconds * 1000, os.path.getsize(os.path.join(tmpdir, "index.html")) / (1024.0 * 1024),
+                peak))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def main(argv):
+    try:
+        opt_list, rest_args = getopt.gnu_getopt(argv[1:], "", ["size=", "repeat=", "count="])
+    except getopt.GetoptError:
+        usage()
+        return 2
+
+    benchmarks = {"compare": bench_compare, "encode": bench_encode, "bundle": bench_bundle,
+                  "report": bench_report}
+    if len(rest_args) != 1 or rest_args[0] not in benchmarks:
+        usage()
+        return 2
+
+    opts = dict(opt_list)
+    size = _parse_size(opts.get("--size", "1080x1920"))
+    repeat = int(opts.get("--repeat", "3"))
+    kwargs = {"count": int(opts["--count"])} if "--count" in opts else {}
+    if kwargs and rest_args[0] not in ("bundle", "report"):
+        usage()
+        return 2
+    benchmarks[rest_args[0]](size, repeat, **kwargs)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,10 +1,16 @@
 #!/usr/bin/env python
 
+import json
 import os
 import re
+import struct
 import subprocess
 import sys
 
+from . import adb_client
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
 def get_image_file_name(name, x, y):
     image_file = name
     if x != 0 or y != 0:
@@ -13,6 +19,43 @@ def get_image_file_name(name, x, y):
     image_file += ".png"
     return image_file
 
+def get_png_size(path):
+    """Reads the (width, height) of a PNG from its IHDR chunk without
+    decoding it, or returns None if the file is not a PNG"""
+    with open(path, 'rb') as f:
+        header = f.read(24)
+    if len(header) < 24 or header[:8] != PNG_SIGNATURE or header[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', header[16:24])
+
+def ensure_dir(path):
+    """os.makedirs() that tolerates the directory already existing, even
+    when it is created concurrently by another process"""
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+def write_json(path, obj):
+    """Writes obj to path as json, replacing it atomically so that
+    concurrent readers never see half a file"""
+    ensure_dir(os.path.dirname(path))
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(obj, f)
+    if hasattr(os, "replace"):
+        os.replace(tmp, path)
+    else:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+
+def get_cache_dir():
+    """Where caches that outlive a single run are kept"""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'screenshot-tests-for-android')
+
 def get_android_sdk():
     android_sdk = os.environ.get('ANDROID_SDK_ROOT') or os.environ.get('ANDROID_HOME')
 
@@ -36,6 +79,10 @@ def assertRegex(testcase, regex, string):
         testcase.assertRegexpMatches(regex, string)
 
 def get_connected_devices():
+    client = adb_client.get_client()
+    if client:
+        return [serial for serial, state in client.devices() if state == "device"]
+
     try:
         output = check_output([get_adb(), "devices"]).splitlines()
         target_pattern = re.compile(r"\b(device|emulator)\b")
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from PIL import Image, ImageChops
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Maximum difference, as a percentage of all RGB components, that is
+# still considered to be the same image.
+THRESHOLD_PERCENT = 0.05
+
+# Rows compared at a time when images can be compared block by block
+DEFAULT_BLOCK_ROWS = 64
+
+# Modes whose tobytes() is one byte per band of every pixel
+_BLOCK_MODES = ("L", "LA", "RGB", "RGBA")
+
+
+class Comparison:
+    """The outcome of comparing two images"""
+
+    def __init__(self, difference, ncomponents, bbox, rows_scanned=None):
+        self.difference = difference
+        self.ncomponents = ncomponents
+        self.bbox = bbox
+        # how many rows were looked at before the result was known
+        self.rows_scanned = rows_scanned
+
+    @property
+    def difference_percent(self):
+        if not self.ncomponents:
+            return 0.0
+        return (self.difference / 255.0 * 100) / self.ncomponents
+
+    def is_same(self, threshold=THRESHOLD_PERCENT):
+        return not (self.difference_percent > threshold)
+
+
+def difference_budget(im, threshold=THRESHOLD_PERCENT):
+    """The largest difference with which an image the size of im is still
+    the same, see Comparison.is_same()"""
+    return threshold / 100 * 255.0 * _ncomponents(im)
+
+
+def union_bbox(bbox1, bbox2):
+    if bbox1 is None:
+        return bbox2
+    if bbox2 is None:
+        return bbox1
+    return (min(bbox1[0], bbox2[0]), min(bbox1[1], bbox2[1]),
+            max(bbox1[2], bbox2[2]), max(bbox1[3], bbox2[3]))
+
+
+def compare(im1, im2, stop_above=None, with_bbox=True, block_rows=DEFAULT_BLOCK_ROWS):
+    """Computes the difference between two images.
+
+    The difference is the sum of the absolute differences of every
+    channel, normalized by the number of RGB components of im1, which is
+    what the original per-pixel loop in Recorder computed. The bbox is
+    the bounding box of the changed pixels, as ImageChops.difference()
+    would report it, or None if there are none.
+
+    Images of the same size and mode are compared in blocks of rows,
+    skipping blocks whose bytes are equal. If the difference grows past
+    stop_above, the comparison stops early, and both the difference and
+    the bbox only cover the rows scanned so far."""
+    if im1.size == im2.size and im1.mode == im2.mode and im1.mode in _BLOCK_MODES:
+        return _compare_blocks(im1, im2, stop_above, with_bbox, block_rows)
+
+    if numpy is not None:
+        comparison = _compare_numpy(im1, im2)
+    else:
+        comparison = _compare_pil(im1, im2)
+    comparison.rows_scanned = im1.size[1]
+    return comparison
+
+
+def _compare_blocks(im1, im2, stop_above, with_bbox, block_rows):
+    width, height = im1.size
+    data1 = im1.tobytes()
+    data2 = im2.tobytes()
+    stride = len(data1) // height if height else 0
+
+    difference = 0
+    bbox = None
+    rows_scanned = 0
+    for top in range(0, height, block_rows):
+        bottom = min(height, top + block_rows)
+        rows_scanned = bottom
+        # comparing bytes is a memcmp, comparing memoryviews goes item by item
+        block1 = data1[top * stride:bottom * stride]
+        block2 = data2[top * stride:bottom * stride]
+        if block1 == block2:
+            continue
+
+        size = (width, bottom - top)
+        if numpy is not None:
+            block = _compare_numpy_bytes(block1, block2, size, with_bbox)
+        else:
+            block = _compare_pil(Image.frombytes(im1.mode, size, block1),
+                                 Image.frombytes(im2.mode, size, block2),
+                                 with_bbox)
+
+        difference += block.difference
+        if block.bbox:
+            x0, y0, x1, y1 = block.bbox
+            bbox = union_bbox(bbox, (x0, y0 + top, x1, y1 + top))
+        if stop_above is not None and difference > stop_above:
+            break
+
+    return Comparison(difference, _ncomponents(im1), bbox, rows_scanned)
+
+
+def _ncomponents(im):
+    return im.size[0] * im.size[1] * 3
+
+
+def _as_array(im):
+    if im.mode == "1":
+        im = im.convert("L")
+    array = numpy.asarray(im)
+    if array.ndim == 2:
+        array = array[:, :, None]
+    return array
+
+
+def _absolute_difference(a, b):
+    # stays in the input dtype, unlike abs(a - b) which would overflow
+    return numpy.maximum(a, b) - numpy.minimum(a, b)
+
+
+def _bbox_of(diff):
+    mask = diff.any(axis=2)
+    rows = numpy.flatnonzero(mask.any(axis=1))
+    if not len(rows):
+        return None
+    cols = numpy.flatnonzero(mask.any(axis=0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+
+def _compare_numpy_bytes(data1, data2, size, with_bbox):
+    shape = (size[1], size[0], -1)
+    a = numpy.frombuffer(data1, dtype=numpy.uint8).reshape(shape)
+    b = numpy.frombuffer(data2, dtype=numpy.uint8).reshape(shape)
+    diff = _absolute_difference(a, b)
+    difference = int(diff.sum(dtype=numpy.uint64))
+    bbox = _bbox_of(diff) if difference and with_bbox else None
+    return Comparison(difference, size[0] * size[1] * 3, bbox)
+
+
+def _compare_numpy(im1, im2):
+    a = _as_array(im1)
+    b = _as_array(im2)
+    channels = min(a.shape[2], b.shape[2])
+
+    if a.shape[:2] == b.shape[:2]:
+        diff = _absolute_difference(a[:, :, :channels], b[:, :, :channels])
+        difference = int(diff.sum(dtype=numpy.uint64))
+        bbox = _bbox_of(diff) if difference else None
+        return Comparison(difference, _ncomponents(im1), bbox)
+
+    # Images of different sizes were compared pixel by pixel in data
+    # order, and the bbox was taken from the top-left aligned overlap.
+    flat_a = a.reshape(-1, a.shape[2])
+    flat_b = b.reshape(-1, b.shape[2])
+    npixels = min(len(flat_a), len(flat_b))
+    difference = int(_absolute_difference(
+        flat_a[:npixels, :channels],
+        flat_b[:npixels, :channels]).sum(dtype=numpy.uint64))
+
+    height = min(a.shape[0], b.shape[0])
+    width = min(a.shape[1], b.shape[1])
+    bbox = _bbox_of(_absolute_difference(
+        a[:height, :width, :channels],
+        b[:height, :width, :channels]))
+    return Comparison(difference, _ncomponents(im1), bbox)
+
+
+def _compare_pil(im1, im2, with_bbox=True):
+    if im1.mode != im2.mode:
+        im2 = im2.convert(im1.mode)
+    diff = ImageChops.difference(im1, im2)
+    try:
+        histogram = diff.histogram()
+        difference = sum((i % 256) * count for i, count in enumerate(histogram))
+        bbox = None
+        if difference and with_bbox:
+            # getbbox() on the whole image may only look at the alpha
+            # band, so union the per-band boxes instead
+            for band in diff.split():
+                bbox = union_bbox(bbox, band.getbbox())
+        return Comparison(difference, _ncomponents(im1), bbox)
+    finally:
+        diff.close()
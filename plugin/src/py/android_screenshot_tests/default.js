@@ -1,5 +1,17 @@
+// Handlers are delegated from the document, since a paged report
+// (--paged-report) inserts screenshots after the page has loaded
+function screenshotReportPage(page, bodies) {
+    $('.screenshot.lazy[data-page="' + page + '"]').each(function () {
+        var body = bodies[$(this).data("index")];
+        if (body !== null) {
+            $(this).find(".screenshot_body").html(body);
+        }
+        $(this).removeClass("lazy");
+    });
+}
+
 $(function () {
-    $(".extra").click(function () {
+    $(document).on("click", ".extra", function () {
             var str = $(this).attr('data');
             $('<pre></pre>').dialog({
                 modal: true,
@@ -19,22 +31,66 @@ $(function () {
             });
         });
 
-    $(".toggle_dark").click(function() {
+    $(document).on("click", ".toggle_dark", function() {
         $(this).closest(".screenshot").find(".img-wrapper").toggleClass("dark");
     })
 
-    $(".toggle_hierarchy").click(function() {
+    $(document).on("click", ".toggle_hierarchy", function() {
         $(this).closest(".screenshot").find(".hierarchy-overlay").toggle();
     })
 
-    $(".view-hierarchy")
-        .mousemove(
+    $(document)
+        .on("mousemove", ".view-hierarchy",
             function(e) {
                 $(".hierarchy-node").removeClass('highlight');
                 $($(e.target).closest("details").attr('target')).addClass('highlight');
             })
-        .mouseout(
+        .on("mouseout", ".view-hierarchy",
             function() {
                 $(".hierarchy-node").removeClass('highlight');
             });
+
+    // A paged report loads report/page-N.js, which calls
+    // screenshotReportPage(), once a screenshot of page N is close to view.
+    // They are scripts since file:// pages cannot fetch json.
+    var requestedPages = {};
+    function loadPage(page) {
+        if (requestedPages[page]) {
+            return;
+        }
+        requestedPages[page] = true;
+        var script = document.createElement("script");
+        script.src = "report/page-" + page + ".js";
+        document.body.appendChild(script);
+    }
+
+    var lazy = $(".screenshot.lazy");
+    if (!lazy.length) {
+        return;
+    }
+    if ("IntersectionObserver" in window) {
+        var observer = new IntersectionObserver(function (entries) {
+            entries.forEach(function (entry) {
+                if (entry.isIntersecting) {
+                    observer.unobserve(entry.target);
+                    loadPage($(entry.target).data("page"));
+                }
+            });
+        }, {rootMargin: "1000px"});
+        lazy.each(function () {
+            observer.observe(this);
+        });
+    } else {
+        var loadVisible = function () {
+            var bottom = $(window).scrollTop() + $(window).height() + 1000;
+            $(".screenshot.lazy").each(function () {
+                if ($(this).offset().top > bottom) {
+                    return false;
+                }
+                loadPage($(this).data("page"));
+            });
+        };
+        $(window).on("scroll resize", loadVisible);
+        loadVisible();
+    }
 });
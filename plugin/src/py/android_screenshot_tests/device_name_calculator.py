@@ -1,15 +1,138 @@
+import json
+import os
 import re
 import subprocess
+import threading
+import time
 
+from . import common
 from .adb_executor import AdbExecutor
 
+# Cheap to run, and they tell whether the device rebooted
+_PROPERTY_COMMANDS = [
+    ['shell', 'getprop', 'ro.build.version.sdk'],
+    ['shell', 'getprop', 'ro.product.cpu.abi'],
+    ['shell', 'getprop', 'persist.sys.locale'],
+    ['shell', 'getprop', 'ro.product.locale'],
+    ['shell', 'getprop', 'ro.serialno'],
+    ['shell', 'cat', '/proc/sys/kernel/random/boot_id'],
+]
+
+# These start a VM on the device each, so their output is cached per boot
+_SLOW_COMMANDS = [
+    ['shell', 'wm', 'density'],
+    ['shell', 'wm', 'size'],
+    ['shell', 'pm', 'path', 'com.google.android.gms'],
+]
+
+_BATCH_MARKER = '__device_name_calculator_status__'
+
+CACHE_FILE_NAME = 'device_properties.json'
+
+# Boots remembered in the cache
+_MAX_CACHE_ENTRIES = 64
+
+_cache_lock = threading.Lock()
+
 
 class DeviceNameCalculator:
 
-    def __init__(self, executor=AdbExecutor()):
+    def __init__(self, executor=AdbExecutor(), cache_dir=None):
         self.executor = executor
+        self._cache_dir = cache_dir
+        # {command: (output, exit status)} fetched ahead of time
+        self._outputs = {}
+
+    def _execute(self, command):
+        if tuple(command) in self._outputs:
+            output, status = self._outputs[tuple(command)]
+            if status:
+                raise subprocess.CalledProcessError(status, command, output)
+            return output
+        return self.executor.execute(command)
+
+    def _execute_batch(self, commands):
+        """Runs commands in a single adb shell, and returns {command:
+        (output, exit status)}, or None if that did not work out, in which
+        case they have to be run one by one"""
+        script = "".join("%s 2>/dev/null; echo %s $?; " % (" ".join(command[1:]), _BATCH_MARKER)
+                         for command in commands)
+        try:
+            output = self.executor.execute(['shell', script])
+        except subprocess.CalledProcessError:
+            return None
+        if not output:
+            return None
+
+        parts = re.split(_BATCH_MARKER + r' (\d+)\r?\n', output)
+        if len(parts) != 2 * len(commands) + 1:
+            return None
+        return dict((tuple(command), (parts[2 * i], int(parts[2 * i + 1])))
+                    for i, command in enumerate(commands))
+
+    def _get_cache_file(self):
+        return os.path.join(self._cache_dir or common.get_cache_dir(), CACHE_FILE_NAME)
+
+    def _read_cache(self):
+        try:
+            with open(self._get_cache_file()) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _boot_key(self, outputs):
+        serial, _ = outputs[('shell', 'getprop', 'ro.serialno')]
+        boot_id, status = outputs[('shell', 'cat', '/proc/sys/kernel/random/boot_id')]
+        if status or not boot_id.strip():
+            return None
+        return "%s %s" % (serial.strip(), boot_id.strip())
+
+    def _prefetch(self):
+        """Fetches everything name() needs in one adb shell, or two the
+        first time after the device booted.
+
+        The outputs of the slow commands are cached on disk for the boot,
+        so changing the density or size with wm without rebooting is not
+        noticed."""
+        outputs = self._execute_batch(_PROPERTY_COMMANDS)
+        if outputs is None:
+            return
+        self._outputs.update(outputs)
+
+        key = self._boot_key(outputs)
+        if key is not None:
+            with _cache_lock:
+                entry = self._read_cache().get(key)
+            if entry is not None:
+                for command, output, status in entry["outputs"]:
+                    self._outputs[tuple(command)] = (output, status)
+                return
+
+        slow_outputs = self._execute_batch(_SLOW_COMMANDS)
+        if slow_outputs is None:
+            return
+        self._outputs.update(slow_outputs)
+        if key is None:
+            return
+
+        try:
+            with _cache_lock:
+                cache = self._read_cache()
+                cache[key] = {
+                    "time": time.time(),
+                    "outputs": [[list(command), output, status]
+                                for command, (output, status) in sorted(slow_outputs.items())],
+                }
+                for old_key in sorted(cache, key=lambda k: cache[k].get("time", 0))[:-_MAX_CACHE_ENTRIES]:
+                    del cache[old_key]
+                common.write_json(self._get_cache_file(), cache)
+        except (IOError, OSError):
+            # it is only a cache
+            pass
 
     def name(self):
+        self._prefetch()
+
         api_version_text = self._api_version_text()
         play_services_text = self._play_services_text()
         screen_density_text = self._screen_density_text()
@@ -50,20 +173,20 @@ class DeviceNameCalculator:
         return 'XXXHDPI'
 
     def _screen_density(self):
-        result = self.executor.execute(['shell', 'wm', 'density'])
+        result = self._execute(['shell', 'wm', 'density'])
         density = re.search('[0-9]+', result)
         if density:
             return density.group(0)
 
     def _screen_size_text(self):
-        result = self.executor.execute(['shell', 'wm', 'size'])
+        result = self._execute(['shell', 'wm', 'size'])
         density = re.search('[0-9]+x[0-9]+', result)
         if density:
             return density.group(0)
 
     def _has_play_services(self):
         try:
-            output = self.executor.execute(['shell', 'pm', 'path', 'com.google.android.gms'])
+            output = self._execute(['shell', 'pm', 'path', 'com.google.android.gms'])
             return True if output else False
         except subprocess.CalledProcessError:
             return False
@@ -73,16 +196,16 @@ class DeviceNameCalculator:
         return 'GP' if play_services else 'NO_GP'
 
     def _api_version(self):
-        return self.executor.execute(['shell', 'getprop', 'ro.build.version.sdk'])
+        return self._execute(['shell', 'getprop', 'ro.build.version.sdk'])
 
     def _api_version_text(self):
         return 'API_{0}'.format(int(self._api_version()))
 
     def _architecture_text(self):
-        architecture = self.executor.execute(['shell', 'getprop', 'ro.product.cpu.abi'])
+        architecture = self._execute(['shell', 'getprop', 'ro.product.cpu.abi'])
         return architecture.rstrip()
 
     def _locale(self):
-        persist_locale = self.executor.execute(['shell', 'getprop', 'persist.sys.locale'])
-        product_locale = self.executor.execute(['shell', 'getprop', 'ro.product.locale'])
+        persist_locale = self._execute(['shell', 'getprop', 'persist.sys.locale'])
+        product_locale = self._execute(['shell', 'getprop', 'ro.product.locale'])
         return persist_locale.rstrip() if persist_locale else product_locale.rstrip()
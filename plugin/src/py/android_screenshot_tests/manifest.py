@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import os
+
+from os.path import join
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+# Hashes of tile files that were left on the device because they matched
+# the references, written next to the pulled screenshots
+DEVICE_HASHES_FILE_NAME = "device_hashes.json"
+
+
+class PixelHash:
+    """Hashes an image fed in horizontal strips, from top to bottom, to the
+    same value hash_image() gives for the whole image"""
+
+    def __init__(self, mode, size):
+        self._digest = hashlib.sha1(("%s %dx%d\n" % (mode, size[0], size[1])).encode("utf-8"))
+
+    def update(self, strip):
+        self._digest.update(strip.tobytes())
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+
+def hash_image(im):
+    """A hash of the decoded pixels, their dimensions and mode"""
+    pixel_hash = PixelHash(im.mode, im.size)
+    pixel_hash.update(im)
+    return pixel_hash.hexdigest()
+
+
+def describe_image(im):
+    return {
+        "hash": hash_image(im),
+        "width": im.size[0],
+        "height": im.size[1],
+        "mode": im.mode,
+    }
+
+
+def hash_file(path):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_device_hashes(directory):
+    """Returns {tile file name: md5} of the tiles that were not pulled into
+    directory, see write_device_hashes()"""
+    try:
+        with open(join(directory, DEVICE_HASHES_FILE_NAME)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_device_hashes(directory, hashes):
+    with open(join(directory, DEVICE_HASHES_FILE_NAME), "w") as f:
+        json.dump(hashes, f, indent=2, sort_keys=True)
+
+
+class ReferenceManifest:
+    """Describes the pixels of every reference image in a record directory,
+    and the hashes of the tile files it was stitched from, so that verify
+    can skip decoding references that did not change.
+
+    Entries remember the size and file hash of the PNG they were computed
+    from, and are ignored once the PNG no longer matches. Nothing machine
+    specific such as mtimes is kept, since the manifest is checked in with
+    the references, and hashing the file is far cheaper than decoding it."""
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._path = join(directory, MANIFEST_FILE_NAME)
+        self._entries = {}
+        self._dirty = False
+        if os.path.exists(self._path):
+            try:
+                with open(self._path, "r") as f:
+                    self._entries = json.load(f)
+                for entry in self._entries.values():
+                    # written by earlier versions, dropped on the next save
+                    entry.pop("mtime", None)
+            except ValueError:
+                # a corrupt manifest is rebuilt as references are compared
+                self._dirty = True
+
+    def _key(self, test_class, test_name):
+        return test_class + "/" + test_name
+
+    def reference_path(self, test_class, test_name):
+        return join(self._directory, test_class, test_name + ".png")
+
+    def lookup(self, test_class, test_name):
+        """Returns the entry for a reference, or None if it is missing or stale"""
+        entry = self._entries.get(self._key(test_class, test_name))
+        if entry is None:
+            return None
+
+        path = self.reference_path(test_class, test_name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        if entry.get("size") != stat.st_size or entry.get("file_hash") != hash_file(path):
+            return None
+        return entry
+
+    def peek(self, test_class, test_name):
+        """Returns the entry for a reference without checking whether it is
+        stale, which is good enough for estimates"""
+        return self._entries.get(self._key(test_class, test_name))
+
+    def update(self, test_class, test_name, description):
+        """Records the description of the reference image as it is on disk now"""
+        path = self.reference_path(test_class, test_name)
+        entry = dict(description)
+        entry["size"] = os.path.getsize(path)
+        entry["file_hash"] = hash_file(path)
+        key = self._key(test_class, test_name)
+        if self._entries.get(key) != entry:
+            self._entries[key] = entry
+            self._dirty = True
+
+    def remove(self, test_class, test_name):
+        if self._entries.pop(self._key(test_class, test_name), None) is not None:
+            self._dirty = True
+
+    def add_tiles(self, test_class, test_name, tiles):
+        """Remembers the hashes of tile files known to stitch into the
+        current reference image"""
+        entry = self._entries.get(self._key(test_class, test_name))
+        if entry is not None and entry.get("tiles") != tiles:
+            entry["tiles"] = tiles
+            self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._entries, f, indent=1, sort_keys=True)
+        getattr(os, "replace", os.rename)(tmp_path, self._path)
+        self._dirty = False
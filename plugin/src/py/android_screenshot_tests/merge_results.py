@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import getopt
+import sys
+
+from os.path import abspath, join
+
+from . import sharding
+
+
+def usage():
+    print("usage: python -m android_screenshot_tests.merge_results --output DIR SHARD_FAILURE_DIR...",
+          file=sys.stderr)
+
+
+def main(argv):
+    """Merges the --failure-dir of every shard of a sharded verify.
+    Exits with 1 if a screenshot failed or a shard is missing."""
+    try:
+        opt_list, rest_args = getopt.gnu_getopt(argv[1:], "", ["output="])
+    except getopt.GetoptError:
+        usage()
+        return 2
+
+    opts = dict(opt_list)
+    if "--output" not in opts or not rest_args:
+        usage()
+        return 2
+
+    try:
+        merged = sharding.merge(rest_args, opts["--output"])
+    except ValueError as e:
+        print("Cannot merge shards: %s" % e, file=sys.stderr)
+        return 2
+
+    if not merged:
+        print("No %s found in %s" % (sharding.RESULTS_FILE_NAME, " ".join(rest_args)), file=sys.stderr)
+        return 1
+
+    ok = True
+    for relative, results in sorted(merged.items()):
+        failed = [s for s in results["screenshots"] if not s["passed"]]
+        print("%s: verified %d screenshots in %d of %d shards, %d failed" % (
+            relative, len(results["screenshots"]),
+            results["shard_count"] - len(results["missing_shards"]), results["shard_count"],
+            len(failed)))
+        for screenshot in failed:
+            print("  %s.%s" % (screenshot["test_class"], screenshot["test_name"]))
+        if results["missing_shards"]:
+            print("  missing shards: %s" % ", ".join(str(i) for i in results["missing_shards"]))
+        print("  file://%s" % abspath(join(opts["--output"], relative, sharding.REPORT_FILE_NAME)))
+        ok = ok and not failed and not results["missing_shards"]
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -7,19 +7,152 @@ from __future__ import unicode_literals
 import unittest
 import tempfile
 import shutil
+import fnmatch
+import io
 import os
 import xml.etree.ElementTree as ET
 import re
 
+class Screenshot(object):
+    """What a <screenshot> element of metadata.xml says. Optional values
+    are None when their element is missing, and "" when it is empty."""
+
+    __slots__ = ("name", "group", "test_class", "test_name", "tile_width", "tile_height",
+                 "relative_file_names", "view_hierarchy", "description", "extras", "error")
+
+    def __init__(self, element):
+        self.name = _text(element, "name")
+        self.group = _text(element, "group")
+        self.test_class = _text(element, "test_class")
+        self.test_name = _text(element, "test_name")
+        self.tile_width = _int(element, "tile_width")
+        self.tile_height = _int(element, "tile_height")
+        self.relative_file_names = [node.text for node in element.findall("relative_file_name")]
+        self.view_hierarchy = _text(element, "view_hierarchy")
+        self.description = _text(element, "description")
+        extras = element.find("extras")
+        # (tag, text) of every child of <extras>
+        self.extras = None if extras is None else [(node.tag, node.text) for node in extras]
+        self.error = _text(element, "error")
+
+
+def _text(element, tag):
+    node = element.find(tag)
+    if node is None:
+        return None
+    return node.text or ""
+
+
+def _int(element, tag):
+    text = _text(element, tag)
+    return int(text) if text else None
+
+
+def parse(metadata_file):
+    """Returns a Screenshot for every <screenshot> in metadata_file, in
+    order. Raises ET.ParseError if it is not well formed."""
+    screenshots = []
+    root = None
+    # Elements are dropped from the root as soon as they are read, so that
+    # the whole tree is never in memory at once
+    for event, element in ET.iterparse(metadata_file, events=(str("start"), str("end"))):
+        if root is None:
+            root = element
+        elif event == "end" and element.tag == "screenshot":
+            screenshots.append(Screenshot(element))
+            root.clear()
+    return screenshots
+
+
+def _compile_globs(globs):
+    if not globs:
+        return None
+    return re.compile("|".join("(?:%s)" % fnmatch.translate(glob) for glob in globs))
+
+
+def _to_set(values):
+    return frozenset(values) if values is not None else None
+
+
+class Selector(object):
+    """Picks a subset of the screenshots. A screenshot is selected if it
+    matches every include that is given, and none of the excludes.
+
+    name_regex is searched for in the name, like --filter-name-regex,
+    name_globs are shell style patterns for the whole name, and names,
+    test_classes and groups have to match exactly. Patterns are compiled
+    once, here."""
+
+    def __init__(self, name_regex=None, names=None, name_globs=None, test_classes=None,
+                 groups=None, exclude_names=None, exclude_name_globs=None,
+                 exclude_test_classes=None, exclude_groups=None):
+        self._name_regex = re.compile(name_regex) if name_regex else None
+        self._names = _to_set(names)
+        self._name_globs = _compile_globs(name_globs)
+        self._test_classes = _to_set(test_classes)
+        self._groups = _to_set(groups)
+        self._exclude_names = _to_set(exclude_names)
+        self._exclude_name_globs = _compile_globs(exclude_name_globs)
+        self._exclude_test_classes = _to_set(exclude_test_classes)
+        self._exclude_groups = _to_set(exclude_groups)
+
+    def selects_everything(self):
+        return all(criterion is None for criterion in [
+            self._name_regex, self._names, self._name_globs, self._test_classes, self._groups,
+            self._exclude_names, self._exclude_name_globs, self._exclude_test_classes,
+            self._exclude_groups])
+
+    def matches(self, screenshot):
+        name = screenshot.name
+        if self._name_regex is not None and not self._name_regex.search(name):
+            return False
+        if self._names is not None and name not in self._names:
+            return False
+        if self._name_globs is not None and not self._name_globs.match(name):
+            return False
+        if self._test_classes is not None and screenshot.test_class not in self._test_classes:
+            return False
+        if self._groups is not None and screenshot.group not in self._groups:
+            return False
+        if self._exclude_names is not None and name in self._exclude_names:
+            return False
+        if self._exclude_name_globs is not None and self._exclude_name_globs.match(name):
+            return False
+        if self._exclude_test_classes is not None and screenshot.test_class in self._exclude_test_classes:
+            return False
+        if self._exclude_groups is not None and screenshot.group in self._exclude_groups:
+            return False
+        return True
+
+    def select(self, screenshots):
+        """Returns the selected screenshots, in order"""
+        if self.selects_everything():
+            return list(screenshots)
+        return [screenshot for screenshot in screenshots if self.matches(screenshot)]
+
+
+def read_names(names_file):
+    """Reads screenshot names from a file with one name per line, where
+    blank lines and lines starting with # are ignored"""
+    with io.open(names_file, encoding="utf-8") as f:
+        names = [line.strip() for line in f]
+    return [name for name in names if name and not name.startswith("#")]
+
+
 # Given a metadata file locally, this transforms it (in-place), to
 # remove any screenshot elements that don't satisfy the given filter
-# criteria
+# criteria. Use a Selector on the parsed screenshots instead to leave
+# the file alone.
 def filter_screenshots(metadata_file, name_regex=None):
+    if not name_regex:
+        return
+
+    pattern = re.compile(name_regex)
     parsed = ET.parse(metadata_file)
     root = parsed.getroot()
     to_remove = []
     for s in root.iter('screenshot'):
-        if name_regex and not (re.search(name_regex, s.find('name').text)):
+        if not pattern.search(s.find('name').text):
             to_remove.append(s)
 
     for s in to_remove:
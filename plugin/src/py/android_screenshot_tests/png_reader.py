@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import struct
+import zlib
+
+from PIL import Image
+
+from . import common
+
+_MODES = {
+    # PNG color type: (mode, bytes per pixel)
+    0: ("L", 1),
+    4: ("LA", 2),
+    2: ("RGB", 3),
+    6: ("RGBA", 4),
+}
+
+
+class UnsupportedPng(ValueError):
+    """The PNG can only be read whole, with PIL"""
+
+
+def _chunk(chunk_type, data):
+    return (struct.pack(">I", len(data)) + chunk_type + data +
+            struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff))
+
+
+class PngReader:
+    """Reads a PNG one horizontal strip at a time, so that the whole image
+    never needs to be in memory, like PngWriter writes them.
+
+    Only non-interlaced 8 bit PNGs without a palette or transparency chunk
+    can be read like this, others raise UnsupportedPng. PIL still does the
+    unfiltering: every strip is handed to it as a small PNG of its own, led
+    by the last row of the strip before, which the filters refer to."""
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        try:
+            self._read_header()
+        except BaseException:
+            self._file.close()
+            raise
+        self._decompressor = zlib.decompressobj()
+        self._buffer = bytearray()
+        # the row above the first one counts as all zeros
+        self._prior = b"\0" * self._stride
+        self._rows_read = 0
+
+    def _read_chunk(self):
+        header = self._file.read(8)
+        if len(header) != 8:
+            raise ValueError("PNG ends without an IEND chunk")
+        length, chunk_type = struct.unpack(">I4s", header)
+        data = self._file.read(length)
+        crc = self._file.read(4)
+        if len(data) != length or len(crc) != 4:
+            raise ValueError("PNG ends in the middle of a chunk")
+        if struct.unpack(">I", crc)[0] != zlib.crc32(chunk_type + data) & 0xffffffff:
+            raise ValueError("Bad CRC in PNG chunk %r" % chunk_type)
+        return chunk_type, data
+
+    def _read_header(self):
+        if self._file.read(len(common.PNG_SIGNATURE)) != common.PNG_SIGNATURE:
+            raise UnsupportedPng("Not a PNG")
+        chunk_type, data = self._read_chunk()
+        if chunk_type != b"IHDR":
+            raise ValueError("PNG does not start with IHDR")
+        width, height, depth, self._color_type, _, _, interlace = struct.unpack(">IIBBBBB", data)
+        if depth != 8 or interlace or self._color_type not in _MODES:
+            raise UnsupportedPng("Cannot read a PNG with bit depth %d, color type %d and interlace %d "
+                                 "in strips" % (depth, self._color_type, interlace))
+        self.mode, bpp = _MODES[self._color_type]
+        self.size = (width, height)
+        self._stride = width * bpp
+
+        while True:
+            chunk_type, data = self._read_chunk()
+            if chunk_type == b"IDAT":
+                self._pending = data
+                return
+            if chunk_type == b"tRNS":
+                raise UnsupportedPng("Cannot read a PNG with a tRNS chunk in strips")
+            if chunk_type == b"IEND":
+                raise ValueError("PNG has no image data")
+
+    def _take(self, length):
+        """The next length bytes of filtered rows"""
+        while len(self._buffer) < length:
+            if not self._pending:
+                chunk_type, self._pending = self._read_chunk()
+                if chunk_type != b"IDAT":
+                    raise ValueError("PNG image data ends early")
+            # max_length keeps a highly compressed chunk from being
+            # inflated whole
+            self._buffer += self._decompressor.decompress(self._pending, length - len(self._buffer))
+            self._pending = self._decompressor.unconsumed_tail
+        data = bytes(self._buffer[:length])
+        del self._buffer[:length]
+        return data
+
+    def read(self, nrows):
+        """Returns an image of the next nrows rows, or fewer at the end"""
+        width, height = self.size
+        nrows = min(nrows, height - self._rows_read)
+        if nrows <= 0:
+            return Image.new(self.mode, (width, 0))
+
+        raw = b"\0" + self._prior + self._take(nrows * (self._stride + 1))
+        png = b"".join([
+            common.PNG_SIGNATURE,
+            _chunk(b"IHDR", struct.pack(">IIBBBBB", width, nrows + 1, 8, self._color_type, 0, 0, 0)),
+            _chunk(b"IDAT", zlib.compress(raw, 0)),
+            _chunk(b"IEND", b""),
+        ])
+        with Image.open(io.BytesIO(png)) as im:
+            strip = im.crop((0, 1, width, nrows + 1))
+        self._prior = strip.crop((0, nrows - 1, width, nrows)).tobytes()
+        self._rows_read += nrows
+        return strip
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import struct
+import zlib
+
+from . import common
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_COLOR_TYPES = {
+    # mode: (PNG color type, bytes per pixel)
+    "L": (0, 1),
+    "LA": (4, 2),
+    "RGB": (2, 3),
+    "RGBA": (6, 4),
+}
+
+DEFAULT_COMPRESS_LEVEL = 6
+
+
+def _paeth(a, b, c):
+    a = a.astype(numpy.int16)
+    b = b.astype(numpy.int16)
+    c = c.astype(numpy.int16)
+    pa = numpy.abs(b - c)
+    pb = numpy.abs(a - c)
+    pc = numpy.abs(a + b - 2 * c)
+    return numpy.where((pa <= pb) & (pa <= pc), a,
+                       numpy.where(pb <= pc, b, c)).astype(numpy.uint8)
+
+
+def _filter_rows(rows, prior, bpp):
+    """Filters each row with whichever PNG filter yields the smallest sum
+    of absolute values, like libpng's adaptive heuristic. Every row only
+    depends on unfiltered data, so the whole strip is filtered at once."""
+    up = numpy.vstack([prior[None, :], rows[:-1]])
+    left = numpy.zeros_like(rows)
+    left[:, bpp:] = rows[:, :-bpp]
+    upleft = numpy.zeros_like(rows)
+    upleft[:, bpp:] = up[:, :-bpp]
+    average = ((left.astype(numpy.uint16) + up) // 2).astype(numpy.uint8)
+
+    # uint8 arithmetic wraps around, which is exactly modulo 256
+    candidates = numpy.stack([rows, rows - left, rows - up, rows - average,
+                              rows - _paeth(left, up, upleft)])
+    scores = numpy.abs(candidates.view(numpy.int8).astype(numpy.int32)).sum(axis=2)
+    choice = numpy.argmin(scores, axis=0)
+
+    filtered = numpy.empty((rows.shape[0], rows.shape[1] + 1), dtype=numpy.uint8)
+    filtered[:, 0] = choice
+    filtered[:, 1:] = candidates[choice, numpy.arange(rows.shape[0])]
+    return filtered.tobytes()
+
+
+class PngWriter:
+    """Writes a PNG one horizontal strip at a time, so that the whole image
+    never needs to be in memory"""
+
+    def __init__(self, path, size, mode="RGBA", compress_level=DEFAULT_COMPRESS_LEVEL):
+        if mode not in _COLOR_TYPES:
+            raise ValueError("Unsupported mode for PngWriter: " + mode)
+        color_type, self._bpp = _COLOR_TYPES[mode]
+        self._mode = mode
+        self._width, self._height = size
+        self._stride = self._width * self._bpp
+        self._rows_written = 0
+        self._prior = None
+        self._compressor = zlib.compressobj(compress_level)
+        self._file = open(path, "wb")
+        self._file.write(common.PNG_SIGNATURE)
+        self._write_chunk(b"IHDR", struct.pack(">IIBBBBB", self._width, self._height,
+                                               8, color_type, 0, 0, 0))
+
+    def _write_chunk(self, chunk_type, data):
+        self._file.write(struct.pack(">I", len(data)))
+        self._file.write(chunk_type)
+        self._file.write(data)
+        self._file.write(struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    def _filter(self, raw, nrows):
+        if numpy is None:
+            # filter type 0 (None) on every row
+            return b"".join(b"\0" + raw[i * self._stride:(i + 1) * self._stride]
+                            for i in range(nrows))
+
+        rows = numpy.frombuffer(raw, dtype=numpy.uint8).reshape(nrows, self._stride)
+        prior = self._prior if self._prior is not None else numpy.zeros(self._stride, dtype=numpy.uint8)
+        self._prior = rows[-1].copy()
+        return _filter_rows(rows, prior, self._bpp)
+
+    def write(self, strip):
+        """Appends the rows of strip, which must be as wide as the image"""
+        if strip.mode != self._mode:
+            strip = strip.convert(self._mode)
+        if strip.size[0] != self._width:
+            raise ValueError("Strip is %d pixels wide, expected %d" % (strip.size[0], self._width))
+
+        nrows = strip.size[1]
+        if not nrows:
+            return
+        data = self._compressor.compress(self._filter(strip.tobytes(), nrows))
+        if data:
+            self._write_chunk(b"IDAT", data)
+        self._rows_written += nrows
+
+    def close(self):
+        try:
+            if self._rows_written != self._height:
+                raise ValueError("Wrote %d rows, expected %d" % (self._rows_written, self._height))
+            self._write_chunk(b"IDAT", self._compressor.flush())
+            self._write_chunk(b"IEND", b"")
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if args[0] is None:
+            self.close()
+        else:
+            self._file.close()
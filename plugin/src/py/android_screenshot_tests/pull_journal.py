@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from . import adb_client
+
+JOURNAL_FILE_NAME = ".pull_journal"
+
+# Attempts after the first one, and the delay before the first of them,
+# which doubles after every attempt
+RETRIES = 3
+RETRY_DELAY = 1.0
+
+try:
+    _CONNECTION_ERRORS = (socket.timeout, ConnectionError)
+except NameError:
+    # Python 2, where socket.error is not an alias of every OSError
+    _CONNECTION_ERRORS = (socket.error,)
+
+# Failures that pulling again will not fix
+_PERMANENT_FAILURES = ("no such file", "does not exist", "permission denied", "not a directory")
+
+# What the adb binary prints when the connection to the device went away
+_TRANSPORT_FAILURES = ("device offline", "not found", "no devices",
+                       "connection reset", "protocol fault", "closed", "broken pipe")
+
+
+def is_transfer_error(e):
+    """Whether e looks like a flaky connection to the device, which pulling
+    again may get past. Local failures such as a full disk, and files that
+    are missing on the device, are not."""
+    if isinstance(e, _CONNECTION_ERRORS):
+        return True
+    if not isinstance(e, (subprocess.CalledProcessError, adb_client.AdbError)):
+        return False
+
+    if isinstance(e, adb_client.AdbError):
+        message = str(e)
+    else:
+        # not str(e), which holds the command line and so the file name
+        message = e.output or ""
+        if isinstance(message, bytes):
+            message = message.decode("utf-8", "replace")
+    message = message.lower()
+    if any(failure in message for failure in _PERMANENT_FAILURES):
+        return False
+    if isinstance(e, adb_client.AdbError):
+        # a dropped connection, or a FAIL from the device
+        return True
+    # all the adb binary gives is its output
+    return any(failure in message for failure in _TRANSPORT_FAILURES)
+
+
+def with_retries(fn, *args):
+    """Calls fn(*args), retrying transfer errors with exponential backoff"""
+    for attempt in range(RETRIES + 1):
+        try:
+            return fn(*args)
+        except Exception as e:
+            if attempt == RETRIES or not is_transfer_error(e):
+                raise
+            delay = RETRY_DELAY * 2 ** attempt
+            print("Transfer failed (%s), retrying in %.1fs" % (str(e).strip(), delay), file=sys.stderr)
+            time.sleep(delay)
+
+
+class PullJournal:
+    """Remembers which files were pulled into a directory intact, so that a
+    pull that failed half way can be resumed.
+
+    A file counts as pulled if the device still lists it with the size and
+    mtime it had when it was pulled, and the local copy has that size.
+    Files the device did not list are always pulled again. Entries are
+    appended one line at a time, so a crash loses at most the last one."""
+
+    def __init__(self, directory):
+        self._path = os.path.join(directory, JOURNAL_FILE_NAME)
+        self._entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self._path):
+            with io.open(self._path, encoding="utf-8") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        # cut off by a crash
+                        break
+                    size, mtime, relative = line.rstrip("\n").split(" ", 2)
+                    self._entries[relative] = (int(size), int(mtime))
+        self._file = io.open(self._path, "a", encoding="utf-8")
+
+    def is_pulled(self, relative, dest, remote_info):
+        if remote_info is None or self._entries.get(relative) != tuple(remote_info):
+            return False
+        return os.path.exists(dest) and os.path.getsize(dest) == remote_info[0]
+
+    def record(self, relative, remote_info):
+        if remote_info is None:
+            return
+        with self._lock:
+            self._entries[relative] = tuple(remote_info)
+            self._file.write("%d %d %s\n" % (remote_info[0], remote_info[1], relative))
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
@@ -5,31 +5,37 @@ from __future__ import unicode_literals
 
 import codecs
 import getopt
+import io
 import json
 import os
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import traceback
 import urllib
 import xml.etree.ElementTree as ET
 import zipfile
 
 from . import aapt
 from . import common
+from . import manifest
 from . import metadata
+from . import sharding
+from . import zip_stream
 from .device_name_calculator import DeviceNameCalculator
 from .no_op_device_name_calculator import NoOpDeviceNameCalculator
+from .adb_executor import AdbExecutor
+from .pull_journal import PullJournal, with_retries
 from .simple_puller import SimplePuller
 
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from os.path import join
 from os.path import abspath
 
-try:
-    from Queue import Queue
-except ImportError:
-    from queue import Queue
-
 
 OLD_ROOT_SCREENSHOT_DIR = '/data/data/'
 KEY_VIEW_HIERARCHY = 'viewHierarchy'
@@ -42,19 +48,18 @@ KEY_HEIGHT = 'height'
 KEY_CHILDREN = 'children'
 DEFAULT_VIEW_CLASS = 'android.view.View'
 
+# Concurrent pulls per device when there is no screenshot bundle
+DEFAULT_PULL_JOBS = 4
+
 
 def usage():
-    print("usage: ./scripts/screenshot_tests/pull_screenshots com.facebook.apk.name.tests [--generate-png]", file=sys.stderr)
+    print("usage: ./scripts/screenshot_tests/pull_screenshots com.facebook.apk.name.tests [--generate-png] [--jobs N] [--strip-budget MB] [--png-compression 0-9] [--png-optimize] [--pull-jobs N] [--pull-directory] [--stream-bundle] [--pull-changed-only] [--filter-name-regex REGEX] [--filter-name-glob GLOB,...] [--exclude-name-glob GLOB,...] [--filter-names-file FILE] [--filter-test-class CLASS,...] [--exclude-test-class CLASS,...] [--filter-group GROUP,...] [--exclude-group GROUP,...] [--shard-index I --shard-count N [--shard-by-cost]] [--paged-report]", file=sys.stderr)
     return
 
 
 def sort_screenshots(screenshots):
     def sort_key(screenshot):
-        group = screenshot.find('group')
-
-        group = group.text if group is not None else ""
-
-        return (group, screenshot.find('name').text)
+        return (screenshot.group or "", screenshot.name)
 
     return sorted(list(screenshots), key=sort_key)
 
@@ -88,131 +93,257 @@ def get_old_screenshot_url(test_name, test_img_api, old_imgs_data):
     return response['url']
 
 
+# Screenshots rendered between two writes to index.html, which bounds the
+# memory the report takes however many screenshots there are
+REPORT_CHUNK_SCREENSHOTS = 200
+
+# Screenshots per file a paged report loads at a time, and where the files go
+REPORT_PAGE_SIZE = 25
+REPORT_PAGES_DIR = 'report'
+
+_REPORT_HEAD = (
+    '<!DOCTYPE html>'
+    '<html>'
+    '<head>'
+    '<title>Screenshot Test Results</title>'
+    '<script src="https://ajax.googleapis.com/ajax/libs/jquery/2.1.3/jquery.min.js"></script>'
+    '<script src="https://ajax.googleapis.com/ajax/libs/jqueryui/1.11.3/jquery-ui.min.js"></script>'
+    '<script src="default.js"></script>'
+    '<link rel="stylesheet" href="https://ajax.googleapis.com/ajax/libs/jqueryui/1.11.3/themes/smoothness/jquery-ui.css" />'
+    '<link rel="stylesheet" href="default.css"></head>'
+    '<body>')
+
+_SCREENSHOT_HEAD = ('<div class="screenshot %s">'
+                    '<div class="screenshot_name">'
+                    '<span class="demphasize">%s</span>%s'
+                    '</div>')
+
+# for --paged-report, see generate_paged_html()
+_LAZY_SCREENSHOT_HEAD = ('<div class="screenshot %s lazy" data-page="%d" data-index="%d">'
+                         '<div class="screenshot_name">'
+                         '<span class="demphasize">%s</span>%s'
+                         '</div>')
+
+_SCREENSHOT_TAIL = '</div><div class="clearfix"></div><hr/>'
+
+_COMMANDS = ('<button class="toggle_dark">Toggle Dark Background</button>'
+             '<button class="toggle_hierarchy">Toggle View Hierarchy Overlay</button>')
+
+_OVERLAY_NODE = """
+        <div
+          class="hierarchy-node"
+          style="left:%dpx;top:%dpx;width:%dpx;height:%dpx;"
+          id="%s-%s"></div>
+        """
+
+
+class _HtmlBuffer(object):
+    """Collects the fragments the writers below produce, a few characters
+    at a time, and hands them to out in large chunks"""
+
+    def __init__(self, out):
+        self._out = out
+        self._parts = []
+        # the hot path, without a call of our own in between
+        self.write = self._parts.append
+
+    def flush(self):
+        self._out.write(self.getvalue())
+        del self._parts[:]
+
+    def getvalue(self):
+        return "".join(self._parts)
+
+
 def generate_html(
     output_dir,
     test_img_api=None,
     old_imgs_data=None,
     diff=False,
+    screenshots=None,
 ):
     # Take in:
     # output_dir a directory with imgs and data outputted by the just-run test,
     # test_img_api a url that takes in the name of the test and a dict w/ data,
     #   and returns a url to an image from a previous run of the test,
     # old_imgs_data a dict that will be used in the test_img_api url.
+    # screenshots the metadata.Screenshots of output_dir, if already parsed.
     # Creates the html for showing a before and after comparison of the images.
-    output_root = ET.parse(join(output_dir, 'metadata.xml')).getroot()
+    if screenshots is None:
+        screenshots = _read_metadata(output_dir)
+    index_html = abspath(join(output_dir, "index.html"))
+    with io.open(index_html, mode="w", encoding="utf-8") as out:
+        html = _HtmlBuffer(out)
+        write_report(html, output_dir, screenshots, test_img_api, old_imgs_data, diff)
+        html.flush()
+    return index_html
+
+
+def write_report(html, output_dir, screenshots, test_img_api=None, old_imgs_data=None, diff=False):
+    """Writes the report of generate_html() to html, flushing it every
+    REPORT_CHUNK_SCREENSHOTS screenshots"""
+    # one listing instead of a stat for every tile
+    existing_files = set(os.listdir(output_dir))
+    unchanged_files = set(manifest.read_device_hashes(output_dir))
     alternate = False
+
+    html.write(_REPORT_HEAD)
+
+    screenshot_num = 0
+    for screenshot in sort_screenshots(screenshots):
+        screenshot_num += 1
+        alternate = not alternate
+        package, name = _split_name(screenshot.name)
+        html.write(_SCREENSHOT_HEAD % ('alternate' if alternate else '', package, name))
+        _write_screenshot_details(html, screenshot)
+
+        if screenshot.error is not None:
+            html.write('<div class="screenshot_error">%s</div>' % screenshot.error)
+        else:
+            _write_screenshot_body(html, output_dir, screenshot, screenshot_num, existing_files,
+                                   test_img_api, old_imgs_data, diff, unchanged_files=unchanged_files)
+
+        html.write(_SCREENSHOT_TAIL)
+        if screenshot_num % REPORT_CHUNK_SCREENSHOTS == 0:
+            html.flush()
+
+    html.write('</body></html>')
+
+
+def generate_paged_html(output_dir, test_img_api=None, old_imgs_data=None, diff=False,
+                        screenshots=None, page_size=REPORT_PAGE_SIZE):
+    """Like generate_html(), but index.html only lists the screenshots.
+    Their images and view hierarchies are rendered into a script per
+    page_size screenshots in REPORT_PAGES_DIR, which default.js loads as
+    the page scrolls into view, so that opening the report takes the same
+    time however large the suite is. The pages are scripts rather than
+    json since browsers do not let file:// pages fetch files."""
+    if screenshots is None:
+        screenshots = _read_metadata(output_dir)
+    existing_files = set(os.listdir(output_dir))
+    unchanged_files = set(manifest.read_device_hashes(output_dir))
+    pages_dir = join(output_dir, REPORT_PAGES_DIR)
+    if os.path.exists(pages_dir):
+        shutil.rmtree(pages_dir)
+    os.makedirs(pages_dir)
+
     index_html = abspath(join(output_dir, "index.html"))
-    with codecs.open(index_html, mode="w", encoding="utf-8") as html:
-        html.write('<!DOCTYPE html>')
-        html.write('<html>')
-        html.write('<head>')
-        html.write('<title>Screenshot Test Results</title>')
-        html.write(
-            '<script src="https://ajax.googleapis.com/ajax/libs/jquery/2.1.3/jquery.min.js"></script>')
-        html.write(
-            '<script src="https://ajax.googleapis.com/ajax/libs/jqueryui/1.11.3/jquery-ui.min.js"></script>')
-        html.write('<script src="default.js"></script>')
-        html.write(
-            '<link rel="stylesheet" href="https://ajax.googleapis.com/ajax/libs/jqueryui/1.11.3/themes/smoothness/jquery-ui.css" />')
-        html.write('<link rel="stylesheet" href="default.css"></head>')
-        html.write('<body>')
-
-        screenshot_num = 0
-        for screenshot in sort_screenshots(output_root.iter('screenshot')):
-            screenshot_num += 1
-            alternate = not alternate
-            canonical_name = screenshot.find('name').text
-            package = ""
-            name = canonical_name
-            if '.' in canonical_name:
-                last_seperator = canonical_name.rindex('.') + 1
-                package = canonical_name[:last_seperator]
-                name = canonical_name[last_seperator:]
-
-            html.write('<div class="screenshot %s">' % ('alternate' if alternate else ''))
-            html.write('<div class="screenshot_name">')
-            html.write('<span class="demphasize">%s</span>%s' % (package, name))
-            html.write('</div>')
-
-            group = screenshot.find('group')
-            if group:
-                html.write('<div class="screenshot_group">%s</div>' % group.text)
-
-            extras = screenshot.find('extras')
-            if extras is not None:
-                str = ""
-                for node in extras:
-                    if node.text is not None:
-                        str = str + "*****" + node.tag + "*****\n\n" + node.text + "\n\n\n"
-                if str != "":
-                    extra_html = '<button class="extra" data="%s">Extra info</button>' % str
-                    html.write(extra_html.encode('utf-8').strip())
-
-            description = screenshot.find('description')
-            if description is not None:
-                html.write('<div class="screenshot_description">%s</div>' % description.text)
-
-            error = screenshot.find('error')
-            if error is not None:
-                html.write('<div class="screenshot_error">%s</div>' % error.text)
-            else:
-                hierarchy_data = get_view_hierarchy(output_dir, screenshot)
-                if hierarchy_data and KEY_VIEW_HIERARCHY in hierarchy_data:
-                    hierarchy = hierarchy_data[KEY_VIEW_HIERARCHY]
-                    ax_hierarchy = hierarchy_data[KEY_AX_HIERARCHY]
+    with io.open(index_html, mode="w", encoding="utf-8") as out:
+        html = _HtmlBuffer(out)
+        html.write(_REPORT_HEAD)
+        alternate = False
+        screenshots = sort_screenshots(screenshots)
+        for page, start in enumerate(range(0, len(screenshots), page_size)):
+            bodies = []
+            for index, screenshot in enumerate(screenshots[start:start + page_size]):
+                alternate = not alternate
+                package, name = _split_name(screenshot.name)
+                html.write(_LAZY_SCREENSHOT_HEAD % ('alternate' if alternate else '', page, index,
+                                                    package, name))
+                _write_screenshot_details(html, screenshot)
+
+                if screenshot.error is not None:
+                    html.write('<div class="screenshot_error">%s</div>' % screenshot.error)
+                    bodies.append(None)
                 else:
-                    hierarchy = hierarchy_data
-                    ax_hierarchy = None
-
-                html.write('<div class="flex-wrapper">')
-                comparing = test_img_api is not None and old_imgs_data is not None
-                if comparing:
-                    show_old_result(
-                        canonical_name,
-                        html,
-                        screenshot,
-                        test_img_api,
-                        old_imgs_data,
-                    )
-                write_image(
-                    hierarchy,
-                    output_dir,
-                    html,
-                    screenshot,
-                    screenshot_num,
-                    comparing,
-                )
-                if comparing and diff:
-                    try:
-                        old_screenshot_url = get_old_screenshot_url(canonical_name, test_img_api, old_imgs_data)
-                        write_image_diff(
-                            old_screenshot_url,
-                            output_dir,
-                            html,
-                            screenshot
-                        )
-                    except Exception:
-                        # Do nothing
-                        pass
-                html.write('<div class="command-wrapper">')
-                write_commands(html)
-                write_view_hierarchy(hierarchy, html, screenshot_num)
-                write_ax_hierarchy(ax_hierarchy, html, screenshot_num)
-                html.write('</div>')
-                html.write('</div>')
-
-            html.write('</div>')
-            html.write('<div class="clearfix"></div>')
-            html.write('<hr/>')
+                    html.write('<div class="screenshot_body"></div>')
+                    body = _HtmlBuffer(None)
+                    _write_screenshot_body(body, output_dir, screenshot, start + index + 1, existing_files,
+                                           test_img_api, old_imgs_data, diff, lazy=True,
+                                           unchanged_files=unchanged_files)
+                    bodies.append(body.getvalue())
+                html.write(_SCREENSHOT_TAIL)
+
+            with io.open(join(pages_dir, "page-%d.js" % page), mode="w", encoding="utf-8") as f:
+                f.write("screenshotReportPage(%d, %s);\n" % (page, json.dumps(bodies)))
+            html.flush()
 
         html.write('</body></html>')
-        return index_html
+        html.flush()
+    return index_html
+
+
+def _split_name(canonical_name):
+    """Splits a screenshot name into the package, which is shown
+    demphasized, and the rest"""
+    if '.' in canonical_name:
+        last_seperator = canonical_name.rindex('.') + 1
+        return canonical_name[:last_seperator], canonical_name[last_seperator:]
+    return "", canonical_name
+
+
+def _write_screenshot_details(html, screenshot):
+    if screenshot.group:
+        html.write('<div class="screenshot_group">%s</div>' % screenshot.group)
+
+    if screenshot.extras is not None:
+        str = ""
+        for tag, text in screenshot.extras:
+            if text is not None:
+                str = str + "*****" + tag + "*****\n\n" + text + "\n\n\n"
+        if str != "":
+            extra_html = '<button class="extra" data="%s">Extra info</button>' % str
+            html.write(extra_html.strip())
+
+    if screenshot.description is not None:
+        html.write('<div class="screenshot_description">%s</div>' % screenshot.description)
+
+
+def _write_screenshot_body(html, output_dir, screenshot, screenshot_num, existing_files,
+                           test_img_api, old_imgs_data, diff, lazy=False, unchanged_files=None):
+    """The images and view hierarchies of a screenshot without an error"""
+    canonical_name = screenshot.name
+    comparing = test_img_api is not None and old_imgs_data is not None
+    hierarchy_data = get_view_hierarchy(output_dir, screenshot)
+    if hierarchy_data and KEY_VIEW_HIERARCHY in hierarchy_data:
+        hierarchy = hierarchy_data[KEY_VIEW_HIERARCHY]
+        ax_hierarchy = hierarchy_data[KEY_AX_HIERARCHY]
+    else:
+        hierarchy = hierarchy_data
+        ax_hierarchy = None
+
+    html.write('<div class="flex-wrapper">')
+    if comparing:
+        show_old_result(
+            canonical_name,
+            html,
+            screenshot,
+            test_img_api,
+            old_imgs_data,
+        )
+    write_image(
+        hierarchy,
+        output_dir,
+        html,
+        screenshot,
+        screenshot_num,
+        comparing,
+        existing_files,
+        lazy,
+        unchanged_files,
+    )
+    if comparing and diff:
+        try:
+            old_screenshot_url = get_old_screenshot_url(canonical_name, test_img_api, old_imgs_data)
+            write_image_diff(
+                old_screenshot_url,
+                output_dir,
+                html,
+                screenshot
+            )
+        except Exception:
+            # Do nothing
+            pass
+    html.write('<div class="command-wrapper">')
+    write_commands(html)
+    write_view_hierarchy(hierarchy, html, screenshot_num)
+    write_ax_hierarchy(ax_hierarchy, html, screenshot_num)
+    html.write('</div>')
+    html.write('</div>')
 
 
 def write_commands(html):
-    html.write('<button class="toggle_dark">Toggle Dark Background</button>')
-    html.write('<button class="toggle_hierarchy">Toggle View Hierarchy Overlay</button>')
+    html.write(_COMMANDS)
 
 
 def write_view_hierarchy(hierarchy, html, parent_id):
@@ -236,49 +367,44 @@ def write_ax_hierarchy(hierarchy, html, parent_id):
 
 
 def write_view_hierarchy_tree_node(node, html, parent_id, with_overlay_target):
-    if with_overlay_target:
-        html.write('<details target="#%s-%s">' % (parent_id, get_view_hierarchy_overlay_node_id(node)))
-    else:
-        html.write('<details>')
-    html.write('<summary>%s</summary>' % node.get(KEY_CLASS, DEFAULT_VIEW_CLASS))
-    html.write('<ul>')
-    for item in sorted(node):
-        if item == KEY_CHILDREN or item == KEY_CLASS:
+    # the tree is written depth first without recursing, since hierarchies
+    # can be deeper than the interpreter's stack; None closes a node
+    write = html.write
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node is None:
+            write('</details>')
             continue
-        html.write('<li><strong>%s:</strong> %s</li>' % (item, node[item]))
-
-    html.write('</ul>')
-    if KEY_CHILDREN in node and node[KEY_CHILDREN]:
-        for child in node[KEY_CHILDREN]:
-            write_view_hierarchy_tree_node(child, html, parent_id, with_overlay_target)
-
-    html.write('</details>')
+        if with_overlay_target:
+            write('<details target="#%s-%s">' % (parent_id, get_view_hierarchy_overlay_node_id(node)))
+        else:
+            write('<details>')
+        write('<summary>%s</summary><ul>' % node.get(KEY_CLASS, DEFAULT_VIEW_CLASS))
+        write("".join('<li><strong>%s:</strong> %s</li>' % (item, node[item])
+                      for item in sorted(node) if item != KEY_CHILDREN and item != KEY_CLASS))
+        write('</ul>')
+        stack.append(None)
+        if KEY_CHILDREN in node and node[KEY_CHILDREN]:
+            stack.extend(reversed(node[KEY_CHILDREN]))
 
 
 def write_view_hierarchy_overlay_nodes(hierarchy, html, parent_id):
     if not hierarchy:
         return
 
-    to_output = Queue()
-    to_output.put(hierarchy)
-    while not to_output.empty():
-        node = to_output.get()
+    to_output = deque([hierarchy])
+    while to_output:
+        node = to_output.popleft()
         left = node[KEY_LEFT]
         top = node[KEY_TOP]
         width = node[KEY_WIDTH] - 4
         height = node[KEY_HEIGHT] - 4
         id = get_view_hierarchy_overlay_node_id(node)
-        node_html = """
-        <div
-          class="hierarchy-node"
-          style="left:%dpx;top:%dpx;width:%dpx;height:%dpx;"
-          id="%s-%s"></div>
-        """
-        html.write(node_html % (left, top, width, height, parent_id, id))
+        html.write(_OVERLAY_NODE % (left, top, width, height, parent_id, id))
 
         if KEY_CHILDREN in node:
-            for child in node[KEY_CHILDREN]:
-                to_output.put(child)
+            to_output.extend(node[KEY_CHILDREN])
 
 
 def get_view_hierarchy_overlay_node_id(node):
@@ -291,31 +417,42 @@ def get_view_hierarchy_overlay_node_id(node):
 
 
 def get_view_hierarchy(dir, screenshot):
-    json_path = join(dir, screenshot.find('name').text + "_dump.json")
+    json_path = join(dir, screenshot.name + "_dump.json")
     if not os.path.exists(json_path):
         return None
     with codecs.open(json_path, mode="r", encoding='utf-8') as dump:
         return json.loads(dump.read())
 
 
-def write_image(hierarchy, dir, html, screenshot, parent_id, comparing):
+def write_image(hierarchy, dir, html, screenshot, parent_id, comparing, existing_files=None, lazy=False,
+                unchanged_files=None):
+    """existing_files are the names of the files in dir, if known. With
+    lazy, the browser only loads the tiles once they are close to view.
+    unchanged_files are the tiles --pull-changed-only left on the device,
+    which are shown as such instead of as a blank image."""
+    img = '<td><img src="./%s" loading="lazy" /></td>' if lazy else '<td><img src="./%s" /></td>'
     html.write('<div class="img-block">')
     if comparing:
         html.write('New Output')
     html.write('<div class="img-wrapper">')
-    html.write('<table>')
-    for y in range(int(screenshot.find('tile_height').text)):
-        html.write('<tr>')
-        for x in range(int(screenshot.find('tile_width').text)):
-            html.write('<td>')
-            image_file = "./" + common.get_image_file_name(screenshot.find('name').text, x, y)
-
-            if os.path.exists(join(dir, image_file)):
-                html.write('<img src="%s" />' % image_file)
-
-            html.write('</td>')
-        html.write('</tr>')
-    html.write('</table>')
+    tiles = [[common.get_image_file_name(screenshot.name, x, y) for x in range(screenshot.tile_width)]
+             for y in range(screenshot.tile_height)]
+    if unchanged_files and all(os.path.basename(file_name) in unchanged_files
+                               for row in tiles for file_name in row):
+        rows = ['<div class="not_pulled">Unchanged from its reference, not pulled from the device</div>']
+    else:
+        rows = ['<table>']
+        for row in tiles:
+            rows.append('<tr>')
+            for file_name in row:
+                if existing_files is not None and os.sep not in file_name:
+                    exists = file_name in existing_files
+                else:
+                    exists = os.path.exists(join(dir, file_name))
+                rows.append(img % file_name if exists else '<td></td>')
+            rows.append('</tr>')
+        rows.append('</table>')
+    html.write("".join(rows))
     html.write('<div class="hierarchy-overlay">')
     write_view_hierarchy_overlay_nodes(hierarchy, html, parent_id)
     html.write('</div></div></div>')
@@ -333,9 +470,9 @@ def write_image_diff(old_screenshot_url, dir, html, screenshot):
 
     # combine all tiles back into one image to ease the comparison
     x_offset = y_offset = height = 0
-    for y in range(int(screenshot.find('tile_height').text)):
-        for x in range(int(screenshot.find('tile_width').text)):
-            image_file = join(dir, "./" + common.get_image_file_name(screenshot.find('name').text, x, y))
+    for y in range(screenshot.tile_height):
+        for x in range(screenshot.tile_width):
+            image_file = join(dir, "./" + common.get_image_file_name(screenshot.name, x, y))
             if os.path.exists(image_file):
                 img = Image.open(image_file)
                 new_image.paste(img, (x_offset, y_offset))
@@ -421,6 +558,12 @@ def android_path_join(a, *args):
 
 
 def pull_metadata(package, dir, adb_puller):
+    # One round trip that answers every existence check below, and the
+    # one for the bundle in pull_images()
+    adb_puller.list_remote([
+        android_path_join("$EXTERNAL_STORAGE", "screenshots", package, "screenshots-default"),
+        android_path_join(OLD_ROOT_SCREENSHOT_DIR, package, "app_screenshots-default")])
+
     root_screenshot_dir = android_path_join(adb_puller.get_external_data_dir(), "screenshots")
     metadata_file = android_path_join(
         root_screenshot_dir,
@@ -433,9 +576,9 @@ def pull_metadata(package, dir, adb_puller):
         'app_screenshots-default/metadata.xml')
 
     if adb_puller.remote_file_exists(metadata_file):
-        adb_puller.pull(metadata_file, join(dir, 'metadata.xml'))
+        with_retries(adb_puller.pull, metadata_file, join(dir, 'metadata.xml'))
     elif adb_puller.remote_file_exists(old_metadata_file):
-        adb_puller.pull(old_metadata_file, join(dir, 'metadata.xml'))
+        with_retries(adb_puller.pull, old_metadata_file, join(dir, 'metadata.xml'))
         metadata_file = old_metadata_file
     else:
         create_empty_metadata_file(dir)
@@ -452,15 +595,36 @@ def create_empty_metadata_file(dir):
         </screenshots>""")
 
 
-def pull_images(dir, device_dir, adb_puller):
+def pull_images(dir, device_dir, adb_puller, pull_jobs=1, pull_directory=False,
+                stream_bundle=False, only_referenced=False, reference_dir=None,
+                on_screenshot_pulled=None, screenshots=None):
+    """Pulls the screenshots metadata.xml in dir refers to, whose
+    metadata.Screenshots are screenshots if they were already parsed. If
+    given, on_screenshot_pulled(name) is called as soon as every tile of a
+    screenshot is in dir, possibly from another thread."""
     bundle_name = 'screenshot_bundle.zip'
-    if adb_puller.remote_file_exists(android_path_join(device_dir, bundle_name)):
+    device_hashes_file = join(dir, manifest.DEVICE_HASHES_FILE_NAME)
+    if os.path.exists(device_hashes_file):
+        # left over from an earlier pull into the same directory
+        os.remove(device_hashes_file)
+
+    if screenshots is None:
+        screenshots = _read_metadata(dir)
+
+    has_bundle = adb_puller.remote_file_exists(android_path_join(device_dir, bundle_name))
+    if has_bundle and stream_bundle:
+        # Extract members as they arrive instead of storing the bundle first
+        wanted = _get_referenced_files(screenshots) if only_referenced else None
+        with adb_puller.open_remote(android_path_join(device_dir, bundle_name)) as stream:
+            names = zip_stream.extract(stream, dir, wanted)
+        print("Pulled %d files from device" % len(names))
+    elif has_bundle:
         bundle_name_local_file = join(dir, os.path.basename(bundle_name))
 
         # Optimization to pull down all the screenshots in a single pull.
         # If this file exists, we assume all of the screenshots are inside it.
-        adb_puller.pull(android_path_join(device_dir, bundle_name),
-                                bundle_name_local_file)
+        with_retries(adb_puller.pull, android_path_join(device_dir, bundle_name),
+                     bundle_name_local_file)
         # Now unzip, to maintain normal behavior
         with zipfile.ZipFile(bundle_name_local_file, 'r') as zipObj:
             zipObj.extractall(dir)
@@ -469,47 +633,214 @@ def pull_images(dir, device_dir, adb_puller):
         # and clean up
         os.remove(bundle_name_local_file)
     else:
-        root = ET.parse(join(dir, 'metadata.xml')).getroot()
-        for s in root.iter('screenshot'):
-            filename_nodes = s.findall('relative_file_name')
-            for filename_node in filename_nodes:
-                class_name = s.find('test_class').text
-                class_path = join(dir, class_name)
-                if not os.path.exists(class_path):
-                    os.makedirs(class_path)
-                adb_puller.pull(
-                    android_path_join(device_dir, filename_node.text),
-                    join(class_path, os.path.basename(filename_node.text)))
-            dump_node = s.find('view_hierarchy')
-            if dump_node is not None:
-                adb_puller.pull(android_path_join(device_dir, dump_node.text),
-                                join(dir, os.path.basename(dump_node.text)))
-
-
-def pull_all(package, dir, adb_puller):
-    device_dir = pull_metadata(package, dir, adb_puller=adb_puller)
-    pull_images(dir, device_dir, adb_puller=adb_puller)
-
+        pulls = _get_image_pulls(dir, screenshots)
+        if reference_dir:
+            pulls = _skip_unchanged(dir, device_dir, pulls, adb_puller, reference_dir, screenshots)
+        start = time.time()
+        if pull_directory:
+            _pull_directory(dir, device_dir, pulls, adb_puller)
+        else:
+            on_pulled = None
+            if on_screenshot_pulled:
+                tracker = _ScreenshotTracker(screenshots, pulls, on_screenshot_pulled)
+                tracker.start()
+                on_pulled = tracker.done
+            _pull_files(dir, device_dir, pulls, adb_puller, pull_jobs, on_pulled)
+        _report_throughput(pulls, time.time() - start)
+
+
+def _get_referenced_files(screenshots):
+    referenced = set()
+    for s in screenshots:
+        referenced.update(s.relative_file_names)
+        if s.view_hierarchy is not None:
+            referenced.add(s.view_hierarchy)
+    return referenced
+
+
+def _get_image_pulls(dir, screenshots):
+    """Returns (relative name on the device, local path) of every file
+    screenshots refer to, creating the directories they go into. A file
+    several screenshots refer to is only pulled once."""
+    pulls = []
+    seen = set()
+
+    def add(relative, dest):
+        if relative not in seen:
+            seen.add(relative)
+            pulls.append((relative, dest))
+
+    for s in screenshots:
+        for relative_file_name in s.relative_file_names:
+            class_path = join(dir, s.test_class)
+            if not os.path.exists(class_path):
+                os.makedirs(class_path)
+            add(relative_file_name, join(class_path, os.path.basename(relative_file_name)))
+        if s.view_hierarchy is not None:
+            add(s.view_hierarchy, join(dir, os.path.basename(s.view_hierarchy)))
+    return pulls
+
+
+def _skip_unchanged(dir, device_dir, pulls, adb_puller, reference_dir, screenshots):
+    """Hashes the files on the device, and drops the pulls of screenshots
+    whose tiles all have the hashes recorded for their reference. Their
+    hashes are written to dir instead, which is all the Recorder needs."""
+    device_hashes = adb_puller.md5sums(device_dir)
+    reference_manifest = manifest.ReferenceManifest(reference_dir)
+
+    unchanged = {}
+    skipped = 0
+    for s in screenshots:
+        entry = reference_manifest.lookup(s.test_class, s.test_name)
+        if not entry or not entry.get("tiles"):
+            continue
+        tiles = [os.path.basename(relative) for relative in s.relative_file_names]
+        if sorted(tiles) != sorted(entry["tiles"]):
+            continue
+        if all(device_hashes.get(tile) == entry["tiles"][tile] for tile in tiles):
+            for tile in tiles:
+                unchanged[tile] = entry["tiles"][tile]
+            skipped += 1
+
+    manifest.write_device_hashes(dir, unchanged)
+    print("Skipping %d screenshots that are unchanged on the device, "
+          "the report shows them as not pulled" % skipped)
+    return [(relative, dest) for relative, dest in pulls
+            if os.path.basename(relative) not in unchanged]
+
+
+class _ScreenshotTracker:
+    """Calls on_ready(name) once every tile of a screenshot was pulled"""
+
+    def __init__(self, screenshots, pulls, on_ready):
+        self._on_ready = on_ready
+        self._lock = threading.Lock()
+        self._screenshot_of = {}
+        self._remaining = {}
+
+        pending = set(relative for relative, _ in pulls)
+        for s in screenshots:
+            tiles = [relative for relative in s.relative_file_names if relative in pending]
+            for tile in tiles:
+                self._screenshot_of[tile] = s.name
+            self._remaining[s.name] = len(tiles)
+
+    def start(self):
+        # e.g. left on the device by --pull-changed-only
+        for name, remaining in self._remaining.items():
+            if not remaining:
+                self._on_ready(name)
+
+    def done(self, relative):
+        name = self._screenshot_of.get(relative)
+        if name is None:
+            return
+        with self._lock:
+            self._remaining[name] -= 1
+            ready = self._remaining[name] == 0
+        if ready:
+            self._on_ready(name)
+
+
+def _pull_files(dir, device_dir, pulls, adb_puller, jobs, on_pulled=None):
+    journal = PullJournal(dir)
+
+    def pull(relative_and_dest):
+        relative, dest = relative_and_dest
+        src = android_path_join(device_dir, relative)
+        remote_info = adb_puller.get_remote_file_info(src)
+        pulled = not journal.is_pulled(relative, dest, remote_info)
+        if pulled:
+            with_retries(adb_puller.pull, src, dest)
+            journal.record(relative, remote_info)
+        if on_pulled:
+            on_pulled(relative)
+        return pulled
 
-def pull_filtered(package, dir, adb_puller, filter_name_regex=None):
+    try:
+        if jobs <= 1 or len(pulls) <= 1:
+            pulled = [pull(relative_and_dest) for relative_and_dest in pulls]
+        else:
+            # the time goes into waiting on the device, so threads are enough
+            pool = ThreadPool(min(jobs, len(pulls)))
+            try:
+                pulled = list(pool.imap_unordered(pull, pulls))
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        journal.close()
+
+    resumed = pulled.count(False)
+    if resumed:
+        print("Resumed an earlier pull, %d files were already there" % resumed)
+
+
+def _pull_directory(dir, device_dir, pulls, adb_puller):
+    # Pull everything next to dir so that the wanted files can be renamed
+    # into place, and whatever was filtered out is deleted with the rest
+    staging_dir = tempfile.mkdtemp(prefix='pull', dir=dir)
+    try:
+        with_retries(adb_puller.pull_directory, device_dir, staging_dir)
+        for relative, dest in pulls:
+            # replaces what an earlier pull left, which os.rename() does
+            # not on Windows
+            if os.path.exists(dest):
+                os.remove(dest)
+            shutil.move(join(staging_dir, relative), dest)
+    finally:
+        shutil.rmtree(staging_dir)
+
+
+def _report_throughput(pulls, seconds):
+    size = sum(os.path.getsize(dest) for _, dest in pulls)
+    print("Pulled %d files (%.1f MB) from device in %.1fs, %.1f files/s" % (
+        len(pulls), size / (1024.0 * 1024), seconds, len(pulls) / max(seconds, 0.001)))
+
+
+def pull_all(package, dir, adb_puller, pull_jobs=1, pull_directory=False, stream_bundle=False,
+             reference_dir=None):
+    """Returns the metadata.Screenshots that were pulled"""
     device_dir = pull_metadata(package, dir, adb_puller=adb_puller)
-    _validate_metadata(dir)
-    metadata.filter_screenshots(join(dir, 'metadata.xml'), name_regex=filter_name_regex)
-    pull_images(dir, device_dir, adb_puller=adb_puller)
+    screenshots = _read_metadata(dir)
+    pull_images(dir, device_dir, adb_puller=adb_puller,
+                pull_jobs=pull_jobs, pull_directory=pull_directory,
+                stream_bundle=stream_bundle, reference_dir=reference_dir,
+                screenshots=screenshots)
+    return screenshots
+
+
+def pull_filtered(package, dir, adb_puller, filter_name_regex=None, pull_jobs=1, pull_directory=False,
+                  stream_bundle=False, reference_dir=None, on_screenshot_pulled=None, selector=None):
+    """Pulls the screenshots selector, or filter_name_regex, selects.
+    Returns their metadata.Screenshots."""
+    selector = selector or metadata.Selector(name_regex=filter_name_regex)
+    device_dir = pull_metadata(package, dir, adb_puller=adb_puller)
+    screenshots = _read_metadata(dir, selector)
+    # a filtered bundle still holds every screenshot, skip the rest
+    pull_images(dir, device_dir, adb_puller=adb_puller,
+                pull_jobs=pull_jobs, pull_directory=pull_directory,
+                stream_bundle=stream_bundle, only_referenced=not selector.selects_everything(),
+                reference_dir=reference_dir, on_screenshot_pulled=on_screenshot_pulled,
+                screenshots=screenshots)
+    return screenshots
 
 
-def _summary(dir):
-    root = ET.parse(join(dir, 'metadata.xml')).getroot()
-    count = len(root.findall('screenshot'))
-    print("Found %d screenshots" % count)
+def _summary(dir, screenshots=None):
+    if screenshots is None:
+        screenshots = _read_metadata(dir)
+    print("Found %d screenshots" % len(screenshots))
 
 
-def _validate_metadata(dir):
+def _read_metadata(dir, selector=None):
+    """Returns the metadata.Screenshots of metadata.xml in dir that
+    selector selects. The file itself is left as it is."""
     try:
-        ET.parse(join(dir, 'metadata.xml'))
+        screenshots = metadata.parse(join(dir, 'metadata.xml'))
     except ET.ParseError:
         raise RuntimeError(
             "Unable to parse metadata file, this commonly happens if you did not call ScreenshotRunner.onDestroy() from your instrumentation")
+    return selector.select(screenshots) if selector else screenshots
 
 
 def pull_screenshots(process,
@@ -520,58 +851,185 @@ def pull_screenshots(process,
                      filter_name_regex=None,
                      record=None,
                      keep_old_record=None,
+                     incremental_record=None,
                      verify=None,
                      opt_generate_png=None,
                      test_img_api=None,
                      old_imgs_data=None,
                      failure_dir=None,
-                     diff=False):
+                     diff=False,
+                     jobs=None,
+                     strip_budget=None,
+                     png_compress_level=None,
+                     png_optimize=False,
+                     pull_jobs=1,
+                     pull_directory=False,
+                     stream_bundle=False,
+                     pull_changed_only=False,
+                     selector=None,
+                     shard_index=None,
+                     shard_count=None,
+                     shard_by_cost=False,
+                     paged_report=False):
     if not perform_pull and temp_dir is None:
         raise RuntimeError("""You must supply a directory for temp_dir if --no-pull is present""")
 
     temp_dir = temp_dir or tempfile.mkdtemp(prefix='screenshots')
+    # everything below only sees the selected screenshots
+    selector = selector or metadata.Selector(name_regex=filter_name_regex)
 
     if not os.path.exists(temp_dir):
         os.makedirs(temp_dir)
 
     copy_assets(temp_dir)
 
-    if perform_pull is True:
-        pull_filtered(process, adb_puller=adb_puller, dir=temp_dir,
-                      filter_name_regex=filter_name_regex)
-
-    _validate_metadata(temp_dir)
-
-    path_to_html = generate_html(temp_dir, test_img_api, old_imgs_data, diff)
     device_name = device_name_calculator.name() if device_name_calculator else None
     record_dir = join(record, device_name) if record and device_name else record
     verify_dir = join(verify, device_name) if verify and device_name else verify
 
+    # Screenshots can only be left on the device if nothing but their hash
+    # is needed, which is not the case when every reference is rewritten
+    reference_dir = None
+    if pull_changed_only:
+        reference_dir = verify_dir or (record_dir if incremental_record else None)
+
     if failure_dir:
         failure_dir = join(failure_dir, device_name) if device_name else failure_dir
         if not os.path.exists(failure_dir):
             os.makedirs(failure_dir)
 
+    # metadata.xml is parsed once, and the result shared by everything below
+    device_dir = None
+    if perform_pull is True:
+        device_dir = pull_metadata(process, temp_dir, adb_puller=adb_puller)
+    screenshots = _read_metadata(temp_dir, selector)
+    if shard_count:
+        costs = None
+        if shard_by_cost and (record_dir or verify_dir):
+            costs = sharding.reference_costs(record_dir or verify_dir, screenshots)
+        screenshots = sharding.split(screenshots, shard_index, shard_count, costs)
+    partial = bool(shard_count) or not selector.selects_everything()
+
+    recorder = None
     if record or verify:
         # don't import this early, since we need PIL to import this
         from .recorder import Recorder
-        recorder = Recorder(temp_dir, record_dir or verify_dir, failure_dir)
-        if verify:
-            recorder.verify()
-        else:
-            recorder.record(keep_old_record is None)
+        recorder = Recorder(temp_dir, record_dir or verify_dir, failure_dir, workers=jobs,
+                            strip_budget=strip_budget,
+                            compress_level=png_compress_level,
+                            optimize=png_optimize)
+
+    # Verify screenshots while the rest are still being pulled, which
+    # only pays off with more than one worker
+    verify_pipeline = None
+    if verify and perform_pull is True and jobs and jobs > 1:
+        verify_pipeline = recorder.start_verify(screenshots)
+
+    try:
+        if perform_pull is True:
+            # a filtered bundle still holds every screenshot, skip the rest
+            pull_images(temp_dir, device_dir, adb_puller=adb_puller,
+                        pull_jobs=pull_jobs, pull_directory=pull_directory,
+                        stream_bundle=stream_bundle, only_referenced=partial,
+                        reference_dir=reference_dir,
+                        on_screenshot_pulled=verify_pipeline.submit if verify_pipeline else None,
+                        screenshots=screenshots)
+
+        report = generate_paged_html if paged_report else generate_html
+        path_to_html = report(temp_dir, test_img_api, old_imgs_data, diff, screenshots)
+    except BaseException:
+        # finish() will not run, so stop the workers here
+        if verify_pipeline:
+            verify_pipeline.abort()
+        raise
+
+    try:
+        if verify_pipeline:
+            verify_pipeline.finish()
+        elif verify:
+            recorder.verify(screenshots)
+        elif record:
+            # references outside the selection or shard are not ours to remove
+            recorder.record(keep_old_record is None and not partial,
+                            incremental=bool(incremental_record), screenshots=screenshots)
+    finally:
+        if failure_dir and recorder and recorder.results is not None:
+            # for merge_results, whether or not this is a shard
+            sharding.write_results(failure_dir, shard_index or 0, shard_count or 1,
+                                   recorder.stats, recorder.results)
 
     if opt_generate_png:
         generate_png(path_to_html, opt_generate_png)
         shutil.rmtree(temp_dir)
     else:
         print("\n\n")
-        _summary(temp_dir)
+        _summary(temp_dir, screenshots)
         print('Open the following url in a browser to view the results: ')
         print('  file://%s' % path_to_html)
         print("\n\n")
 
 
+def _get_serial(puller_args):
+    if "-s" in puller_args:
+        return puller_args[puller_args.index("-s") + 1]
+    return None
+
+
+def pull_devices(puller_args_list, pull, concurrent=True):
+    """Calls pull(puller_args) for every device, each on its own thread
+    since most of the time is spent waiting on adb. Devices that share
+    an output directory must set concurrent=False to be pulled one after
+    another. Returns a list of (puller_args, error) in the same order,
+    where error is None if the device succeeded."""
+
+    def pull_device(puller_args):
+        try:
+            pull(puller_args)
+            return None
+        except Exception as e:
+            traceback.print_exc()
+            return e
+
+    if len(puller_args_list) == 1 or not concurrent:
+        return [(puller_args, pull_device(puller_args)) for puller_args in puller_args_list]
+
+    pool = ThreadPool(len(puller_args_list))
+    try:
+        errors = pool.map(pull_device, puller_args_list, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return list(zip(puller_args_list, errors))
+
+
+def _print_device_summary(results):
+    print("Device summary:")
+    for puller_args, error in results:
+        status = "OK" if error is None else "FAILED (%s: %s)" % (type(error).__name__, str(error).strip())
+        print("  %s: %s" % (_get_serial(puller_args) or "default device", status))
+
+
+def _split_option(opts, name):
+    """The comma separated values of a list option, or None if not given"""
+    if name not in opts:
+        return None
+    return [value for value in opts[name].split(",") if value]
+
+
+def _get_selector(opts):
+    names = None
+    if "--filter-names-file" in opts:
+        names = metadata.read_names(opts["--filter-names-file"])
+    return metadata.Selector(name_regex=opts.get("--filter-name-regex"),
+                             names=names,
+                             name_globs=_split_option(opts, "--filter-name-glob"),
+                             exclude_name_globs=_split_option(opts, "--exclude-name-glob"),
+                             test_classes=_split_option(opts, "--filter-test-class"),
+                             exclude_test_classes=_split_option(opts, "--exclude-test-class"),
+                             groups=_split_option(opts, "--filter-group"),
+                             exclude_groups=_split_option(opts, "--exclude-group"))
+
+
 def setup_paths():
     android_home = common.get_android_sdk()
     os.environ['PATH'] = os.environ['PATH'] + ":" + android_home + "/platform-tools/"
@@ -584,7 +1042,12 @@ def main(argv):
             argv[1:],
             "eds:",
             ["generate-png=", "filter-name-regex=", "apk", "record=", "verify=", "failure-dir=",
-             "temp-dir=", "no-pull", "multiple-devices=", "keep-old-record"])
+             "temp-dir=", "no-pull", "multiple-devices=", "keep-old-record", "incremental-record", "jobs=",
+             "strip-budget=", "png-compression=", "png-optimize", "pull-jobs=", "pull-directory",
+             "stream-bundle", "pull-changed-only", "filter-names-file=", "filter-name-glob=",
+             "exclude-name-glob=", "filter-test-class=", "exclude-test-class=", "filter-group=",
+             "exclude-group=", "shard-index=", "shard-count=", "shard-by-cost",
+             "paged-report"])
     except getopt.GetoptError:
         usage()
         return 2
@@ -604,7 +1067,18 @@ def main(argv):
     should_perform_pull = ("--no-pull" not in opts)
 
     multiple_devices = opts.get('--multiple-devices')
-    device_calculator = DeviceNameCalculator() if multiple_devices else NoOpDeviceNameCalculator()
+
+    selector = _get_selector(opts)
+
+    shard_count = int(opts["--shard-count"]) if "--shard-count" in opts else None
+    shard_index = int(opts["--shard-index"]) if "--shard-index" in opts else None
+    if (shard_count is None) != (shard_index is None) or (
+            shard_count is not None and not 0 <= shard_index < shard_count):
+        usage()
+        return 2
+
+    # --strip-budget is in megabytes
+    strip_budget = int(float(opts["--strip-budget"]) * 1024 * 1024) if "--strip-budget" in opts else None
 
     base_puller_args = []
     if "-e" in opts:
@@ -625,18 +1099,56 @@ def main(argv):
     else:
         puller_args_list = [base_puller_args]
 
-    for puller_args in puller_args_list:
+    # With --multiple-devices every device has its own output directories,
+    # and so its own subdirectory of --temp-dir, which --no-pull reads back
+    per_device = bool(multiple_devices) and len(puller_args_list) > 1
+
+    if not should_perform_pull and not per_device:
+        # every device would verify the same local directory
+        puller_args_list = puller_args_list[:1]
+
+    def pull(puller_args):
+        temp_dir = opts.get('--temp-dir')
+        if temp_dir and per_device:
+            temp_dir = join(temp_dir, _get_serial(puller_args))
+
+        if multiple_devices:
+            device_calculator = DeviceNameCalculator(AdbExecutor(puller_args))
+        else:
+            device_calculator = NoOpDeviceNameCalculator()
+
         pull_screenshots(process,
                          perform_pull=should_perform_pull,
-                         temp_dir=opts.get('--temp-dir'),
-                         filter_name_regex=opts.get('--filter-name-regex'),
+                         temp_dir=temp_dir,
+                         selector=selector,
+                         shard_index=shard_index,
+                         shard_count=shard_count,
+                         shard_by_cost="--shard-by-cost" in opts,
+                         paged_report="--paged-report" in opts,
                          opt_generate_png=opts.get('--generate-png'),
                          record=opts.get('--record'),
                          keep_old_record=opts.get('--keep-old-record'),
+                         incremental_record="--incremental-record" in opts,
                          verify=opts.get('--verify'),
                          adb_puller=SimplePuller(puller_args),
                          device_name_calculator=device_calculator,
-                         failure_dir=opts.get("--failure-dir"))
+                         failure_dir=opts.get("--failure-dir"),
+                         jobs=int(opts.get("--jobs", 1)),
+                         strip_budget=strip_budget,
+                         png_compress_level=int(opts["--png-compression"]) if "--png-compression" in opts else None,
+                         png_optimize="--png-optimize" in opts,
+                         pull_jobs=int(opts.get("--pull-jobs", DEFAULT_PULL_JOBS)),
+                         pull_directory="--pull-directory" in opts,
+                         stream_bundle="--stream-bundle" in opts,
+                         pull_changed_only="--pull-changed-only" in opts)
+
+    # without --multiple-devices every device writes to the same record,
+    # verify and failure directories, so they have to take turns
+    results = pull_devices(puller_args_list, pull, concurrent=per_device)
+    if len(results) > 1:
+        _print_device_summary(results)
+
+    return 0 if all(error is None for _, error in results) else 1
 
 
 if __name__ == '__main__':
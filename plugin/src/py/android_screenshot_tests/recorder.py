@@ -1,149 +1,649 @@
 #!/usr/bin/env python
 
-import xml.etree.ElementTree as ET
+import multiprocessing
 import os
 import sys
+import threading
 
 from os.path import join
-from PIL import Image, ImageChops, ImageDraw
+from PIL import Image, ImageDraw
 
 from . import common
+from . import comparator
+from . import manifest
+from . import metadata
+from . import png_writer
+from .png_reader import PngReader, UnsupportedPng
+from .png_writer import PngWriter
 import shutil
-import tempfile
 
 
 class VerifyError(Exception):
     pass
 
 
+def _make_pool(processes):
+    """A process pool that is safe to start while other threads run, such
+    as the device threads of --multiple-devices. A forked worker could
+    inherit a lock that one of them holds, so workers are started from a
+    fork server, or spawned where there is none."""
+    if not hasattr(multiprocessing, "get_context"):
+        # Python 2 can only fork
+        return multiprocessing.Pool(processes)
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(method).Pool(processes)
+
+
+def _verify_screenshot(args):
+    # module level so that it can be pickled into pool workers
+    recorder, screenshot, expected_entry = args
+    return recorder._verify_screenshot(screenshot, expected_entry)
+
+
+def _copy_screenshot(args):
+    recorder, screenshot = args
+    return recorder._copy(*screenshot)
+
+
+def _record_screenshot(args):
+    recorder, screenshot, expected_entry = args
+    return recorder._record_screenshot(screenshot, expected_entry)
+
+
+class _VerifyResult:
+    """What verifying one screenshot found out"""
+
+    def __init__(self, failure=None, rows=0, rows_scanned=0, matched_by=None,
+                 reference=None, tiles=None):
+        # (expected, actual) if the screenshot does not match its reference
+        self.failure = failure
+        self.rows = rows
+        self.rows_scanned = rows_scanned
+        # "tiles" or "pixels" when a hash proved the screenshot unchanged
+        self.matched_by = matched_by
+        # a description of the reference, if it had to be decoded
+        self.reference = reference
+        # tile hashes that are now known to stitch into the reference
+        self.tiles = tiles
+
+
+class _TileLayout:
+    """Where each tile of a screenshot goes on the stitched canvas. tiles is
+    indexed [x][y], and lefts and tops have a trailing entry for the far edge"""
+
+    def __init__(self, tiles, lefts, tops):
+        self.tiles = tiles
+        self.lefts = lefts
+        self.tops = tops
+
+    @property
+    def size(self):
+        return (self.lefts[-1], self.tops[-1])
+
+
+class _CroppingReader:
+    """Reads strips of an image that PngReader cannot read, by cropping
+    the whole decoded image"""
+
+    def __init__(self, im):
+        self._im = im
+        self._top = 0
+
+    def read(self, nrows):
+        width, height = self._im.size
+        bottom = min(height, self._top + nrows)
+        strip = self._im.crop((0, self._top, width, bottom))
+        self._top = bottom
+        return strip
+
+    def close(self):
+        pass
+
+
+class _VerifyPipeline:
+    """Verifies screenshots on a worker pool as soon as their tiles are
+    available, see Recorder.start_verify()"""
+
+    def __init__(self, recorder, screenshots=None):
+        self._recorder = recorder
+        self._metadata = screenshots
+        self._manifest = manifest.ReferenceManifest(recorder._output)
+        self._screenshots = None
+        self._pending = None
+        self._pool = _make_pool(recorder._workers)
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # device_hashes.json, and metadata.xml unless it was given, are
+        # only final once the first screenshot has been pulled
+        self._recorder._device_hashes = manifest.read_device_hashes(self._recorder._input)
+        self._screenshots = self._recorder._get_screenshots(self._metadata)
+        self._pending = [None] * len(self._screenshots)
+        self._index = dict((screenshot[0], i) for i, screenshot in enumerate(self._screenshots))
+
+    def submit(self, name):
+        """Queues the screenshot called name, whose tiles were all pulled"""
+        with self._lock:
+            if self._screenshots is None:
+                self._start()
+            i = self._index.get(name)
+            if i is None or self._pending[i] is not None:
+                return
+            screenshot = self._screenshots[i]
+            expected_entry = self._manifest.lookup(screenshot[1], screenshot[2])
+            self._pending[i] = self._pool.apply_async(
+                _verify_screenshot, ((self._recorder, screenshot, expected_entry),))
+
+    def finish(self):
+        """Verifies whatever was not submitted, waits for everything, and
+        reports like Recorder.verify()"""
+        try:
+            with self._lock:
+                if self._screenshots is None:
+                    self._start()
+                names = [screenshot[0] for screenshot, pending in zip(self._screenshots, self._pending)
+                         if pending is None]
+            for name in names:
+                self.submit(name)
+            results = [pending.get() for pending in self._pending]
+        finally:
+            self._pool.close()
+            self._pool.join()
+        self._recorder._report_verify(self._manifest, self._screenshots, results)
+
+    def abort(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
 class Recorder:
-    def __init__(self, input, output, failure_output):
+    def __init__(self, input, output, failure_output, workers=1, strip_budget=None,
+                 compress_level=None, optimize=False):
         self._input = input
         self._output = output
-        self._realoutput = output
         self._failure_output = failure_output
+        self._workers = max(1, workers or 1)
+        # When set, screenshots are stitched and compared a few tile rows
+        # at a time, with at most this many bytes of stitched pixels each
+        self._strip_budget = strip_budget
+        # PNG encoding options for recorded references, none of which
+        # change the decoded pixels
+        self._compress_level = compress_level
+        self._optimize = optimize
+        # tiles that were not pulled since the device had the same file,
+        # read again by record() and verify() since the pull may only
+        # write them after the Recorder was made
+        self._device_hashes = manifest.read_device_hashes(input)
+        # what the last verify found, see _report_verify()
+        self.stats = None
+        self.results = None
 
     def _get_image_size(self, file_name):
+        size = common.get_png_size(file_name)
+        if size is not None:
+            return size
         with Image.open(file_name) as im:
             return im.size
 
-    def _copy(self, name, classname, method, w, h):
-        tilewidth, tileheight = self._get_image_size(
-            join(self._input,
-                 common.get_image_file_name(name, 0, 0)))
-
-        canvaswidth = 0
+    def _get_tile_dir(self, name, classname):
+        """Tiles are pulled into a directory per test class, but may also
+        sit directly in the input directory"""
+        class_dir = join(self._input, classname)
+        if os.path.exists(join(class_dir, common.get_image_file_name(name, 0, 0))):
+            return class_dir
+        return self._input
 
+    def _hash_tiles(self, name, classname, w, h):
+        """Hashes the raw bytes of every tile file of a screenshot"""
+        tile_dir = self._get_tile_dir(name, classname)
+        tiles = {}
         for i in range(w):
-            input_file = common.get_image_file_name(name, i, 0)
-            canvaswidth += self._get_image_size(join(self._input, input_file))[0]
+            for j in range(h):
+                tile = common.get_image_file_name(name, i, j)
+                path = join(tile_dir, tile)
+                if tile in self._device_hashes and not os.path.exists(path):
+                    tiles[tile] = self._device_hashes[tile]
+                else:
+                    tiles[tile] = manifest.hash_file(path)
+        return tiles
 
-        canvasheight = 0
+    def _get_layout(self, name, classname, w, h):
+        tile_dir = self._get_tile_dir(name, classname)
+        tiles = [[join(tile_dir, common.get_image_file_name(name, i, j))
+                  for j in range(h)]
+                 for i in range(w)]
 
-        for j in range(h):
-            input_file = common.get_image_file_name(name, 0, j)
-            canvasheight += self._get_image_size(join(self._input, input_file))[1]
+        # Only the first row and column are probed: every tile in a column
+        # has the same width, and every tile in a row the same height, but
+        # the last ones may be smaller than the rest.
+        sizes = {}
 
-        im = Image.new("RGBA", (canvaswidth, canvasheight))
+        def size_of(path):
+            if path not in sizes:
+                sizes[path] = self._get_image_size(path)
+            return sizes[path]
 
+        lefts = [0]
         for i in range(w):
-            for j in range(h):
-                input_file = common.get_image_file_name(name, i, j)
-                with Image.open(join(self._input, input_file)) as input_image:
-                    im.paste(input_image, (i * tilewidth, j * tileheight))
-                    input_image.close()
+            lefts.append(lefts[-1] + size_of(tiles[i][0])[0])
+
+        tops = [0]
+        for j in range(h):
+            tops.append(tops[-1] + size_of(tiles[0][j])[1])
+
+        return _TileLayout(tiles, lefts, tops)
+
+    def _stitch(self, name, classname, w, h):
+        """Returns a new image with all the tiles of a screenshot pasted together"""
+        if w == 1 and h == 1:
+            tile = join(self._get_tile_dir(name, classname), common.get_image_file_name(name, 0, 0))
+            with Image.open(tile) as input_image:
+                return input_image.convert("RGBA")
+
+        layout = self._get_layout(name, classname, w, h)
+        im = Image.new("RGBA", layout.size)
+
+        for i, column in enumerate(layout.tiles):
+            for j, tile in enumerate(column):
+                with Image.open(tile) as input_image:
+                    im.paste(input_image, (layout.lefts[i], layout.tops[j]))
+
+        return im
+
+    def _iter_strips(self, layout):
+        """Yields (top, strip) for horizontal strips of the stitched image,
+        each made of as many whole tile rows as fit in the strip budget"""
+        width, height = layout.size
+        rows = len(layout.tops) - 1
+        j = 0
+        while j < rows:
+            top = layout.tops[j]
+            end = j + 1
+            while end < rows and (layout.tops[end + 1] - top) * width * 4 <= self._strip_budget:
+                end += 1
+
+            strip = Image.new("RGBA", (width, layout.tops[end] - top))
+            for i, column in enumerate(layout.tiles):
+                for row in range(j, end):
+                    with Image.open(column[row]) as input_image:
+                        strip.paste(input_image, (layout.lefts[i], layout.tops[row] - top))
+            yield top, strip
+            j = end
+
+    def _hash_strips(self, layout):
+        pixel_hash = manifest.PixelHash("RGBA", layout.size)
+        for top, strip in self._iter_strips(layout):
+            pixel_hash.update(strip)
+            strip.close()
+        return pixel_hash.hexdigest()
 
+    def _open_reference(self, path, im1):
+        """A reader of the reference im1, opened from path, that only
+        decodes a strip at a time if the PNG allows"""
+        try:
+            return PngReader(path)
+        except UnsupportedPng:
+            return _CroppingReader(im1)
+
+    def _describe_in_strips(self, path, im1):
+        """manifest.describe_image(im1), a strip at a time"""
+        width, height = im1.size
+        pixel_hash = manifest.PixelHash(im1.mode, im1.size)
+        reader = self._open_reference(path, im1)
+        try:
+            rows = max(1, self._strip_budget // max(1, width * 4))
+            for top in range(0, height, rows):
+                strip = reader.read(rows)
+                pixel_hash.update(strip)
+                strip.close()
+        finally:
+            reader.close()
+        return {
+            "hash": pixel_hash.hexdigest(),
+            "width": width,
+            "height": height,
+            "mode": im1.mode,
+        }
+
+    def _compare_strips(self, path, im1, layout, stop_above, with_bbox):
+        """Compares the reference im1, opened from path, with the stitched
+        tiles one strip at a time"""
+        width, height = layout.size
+        difference = 0
+        bbox = None
+        rows_scanned = 0
+        reader = self._open_reference(path, im1)
+        try:
+            for top, strip in self._iter_strips(layout):
+                part = reader.read(strip.size[1])
+                remaining = stop_above - difference if stop_above is not None else None
+                comparison = self._compare(part, strip, remaining, with_bbox)
+                part.close()
+                strip.close()
+
+                difference += comparison.difference
+                rows_scanned = top + comparison.rows_scanned
+                if comparison.bbox:
+                    x0, y0, x1, y1 = comparison.bbox
+                    bbox = comparator.union_bbox(bbox, (x0, y0 + top, x1, y1 + top))
+                if stop_above is not None and difference > stop_above:
+                    break
+        finally:
+            reader.close()
+        return comparator.Comparison(difference, width * height * 3, bbox, rows_scanned)
+
+    def _save_png(self, im, path):
+        options = {}
+        if self._compress_level is not None:
+            options["compress_level"] = self._compress_level
+        if self._optimize:
+            options["optimize"] = True
+        im.save(path, "PNG", **options)
+
+    def _copy(self, name, classname, method, w, h, im=None):
+        """Writes the stitched screenshot into the output directory, and
+        returns its manifest description. im may be the already stitched
+        screenshot, which is then closed."""
         output_path = join(self._output, classname)
-        if not os.path.exists(output_path):
-            os.makedirs(output_path)
-        im.save(join(output_path, method + ".png"))
-        im.close()
-
-    def _get_metadata_root(self):
-        return ET.parse(join(self._input, "metadata.xml")).getroot()
-
-    def _record(self):
-        root = self._get_metadata_root()
-        for screenshot in root.iter("screenshot"):
-            test_class = screenshot.find('test_class').text
-            test_method = screenshot.find('test_name').text
-            self._copy(screenshot.find('name').text,
-                       test_class,
-                       test_method,
-                       int(screenshot.find('tile_width').text),
-                       int(screenshot.find('tile_height').text))
+        common.ensure_dir(output_path)
+        output_file = join(output_path, method + ".png")
+
+        if self._strip_budget:
+            layout = self._get_layout(name, classname, w, h)
+            pixel_hash = manifest.PixelHash("RGBA", layout.size)
+            compress_level = 9 if self._optimize else self._compress_level
+            if compress_level is None:
+                compress_level = png_writer.DEFAULT_COMPRESS_LEVEL
+            with PngWriter(output_file, layout.size, compress_level=compress_level) as writer:
+                for top, strip in self._iter_strips(layout):
+                    writer.write(strip)
+                    pixel_hash.update(strip)
+                    strip.close()
+            description = {
+                "hash": pixel_hash.hexdigest(),
+                "width": layout.size[0],
+                "height": layout.size[1],
+                "mode": "RGBA",
+            }
+        else:
+            if im is None:
+                im = self._stitch(name, classname, w, h)
+            self._save_png(im, output_file)
+            description = manifest.describe_image(im)
+            im.close()
+
+        description["tiles"] = self._hash_tiles(name, classname, w, h)
+        return description
+
+    def _get_screenshots(self, screenshots=None):
+        """(name, test_class, test_name, tile_width, tile_height) of the
+        given metadata.Screenshots, or of those in the input metadata.xml"""
+        if screenshots is None:
+            screenshots = metadata.parse(join(self._input, "metadata.xml"))
+        return [(s.name, s.test_class, s.test_name, s.tile_width, s.tile_height)
+                for s in screenshots]
+
+    def _record(self, screenshots=None):
+        reference_manifest = manifest.ReferenceManifest(self._output)
+        screenshots = self._get_screenshots(screenshots)
+        descriptions = self._map(_copy_screenshot,
+                                 [(self, screenshot) for screenshot in screenshots])
+        for screenshot, description in zip(screenshots, descriptions):
+            reference_manifest.update(screenshot[1], screenshot[2], description)
+        reference_manifest.save()
+
+    def _record_screenshot(self, screenshot, expected_entry):
+        """Records one screenshot, unless the existing reference already has
+        the same pixels. Returns a (status, description) pair, where status
+        is "added", "updated" or "unchanged"."""
+        name, test_class, test_method, w, h = screenshot
+        reference = join(join(self._output, test_class), test_method + ".png")
+        tiles = self._hash_tiles(name, test_class, w, h)
+
+        if expected_entry is not None and expected_entry.get("tiles") == tiles:
+            return "unchanged", None
+
+        if expected_entry is None and os.path.exists(reference):
+            # e.g. recorded before there was a manifest
+            with Image.open(reference) as im:
+                expected_entry = manifest.describe_image(im)
+
+        im = None
+        if expected_entry is not None:
+            if self._strip_budget:
+                actual_hash = self._hash_strips(self._get_layout(name, test_class, w, h))
+            else:
+                im = self._stitch(name, test_class, w, h)
+                actual_hash = manifest.hash_image(im)
+            if actual_hash == expected_entry["hash"]:
+                if im is not None:
+                    im.close()
+                description = dict(expected_entry)
+                description["tiles"] = tiles
+                return "unchanged", description
+
+        status = "updated" if os.path.exists(reference) else "added"
+        return status, self._copy(name, test_class, test_method, w, h, im)
+
+    def _remove_stale(self, screenshots, reference_manifest):
+        """Removes references of screenshots that are not in the metadata"""
+        recorded = set((test_class, test_method) for _, test_class, test_method, _, _ in screenshots)
+        removed = 0
+        for test_class in os.listdir(self._output):
+            class_dir = join(self._output, test_class)
+            if not os.path.isdir(class_dir):
+                continue
+            for file_name in os.listdir(class_dir):
+                test_method, extension = os.path.splitext(file_name)
+                if extension != ".png" or (test_class, test_method) in recorded:
+                    continue
+                os.remove(join(class_dir, file_name))
+                reference_manifest.remove(test_class, test_method)
+                removed += 1
+            if not os.listdir(class_dir):
+                os.rmdir(class_dir)
+        return removed
+
+    def _record_incrementally(self, remove_stale, screenshots=None):
+        common.ensure_dir(self._output)
+        reference_manifest = manifest.ReferenceManifest(self._output)
+        screenshots = self._get_screenshots(screenshots)
+        results = self._map(_record_screenshot,
+                            [(self, screenshot, reference_manifest.lookup(screenshot[1], screenshot[2]))
+                             for screenshot in screenshots])
+
+        counts = {"added": 0, "updated": 0, "unchanged": 0, "removed": 0}
+        for screenshot, (status, description) in zip(screenshots, results):
+            counts[status] += 1
+            if description is not None:
+                reference_manifest.update(screenshot[1], screenshot[2], description)
+
+        if remove_stale:
+            counts["removed"] = self._remove_stale(screenshots, reference_manifest)
+        reference_manifest.save()
+
+        print("Recorded %d screenshots: %d added, %d updated, %d removed, %d unchanged" % (
+            len(screenshots), counts["added"], counts["updated"], counts["removed"], counts["unchanged"]))
+        return counts
+
+    def _map(self, fn, items):
+        """Like map(), but fanned out over the worker pool, in order"""
+        if self._workers == 1 or len(items) <= 1:
+            return [fn(item) for item in items]
+
+        pool = _make_pool(min(self._workers, len(items)))
+        try:
+            return pool.map(fn, items, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
 
     def _clean(self):
         if os.path.exists(self._output):
             shutil.rmtree(self._output)
         os.makedirs(self._output)
 
+    def _compare(self, im1, im2, stop_above=None, with_bbox=True):
+        return comparator.compare(im1, im2, stop_above=stop_above, with_bbox=with_bbox)
+
+    def _write_diff(self, im, comparison, failure_folder, failure_file):
+        """Draws the changed area onto im, and saves it as failure_file"""
+        common.ensure_dir(failure_folder)
+        if comparison.bbox:
+            draw = ImageDraw.Draw(im)
+            draw.rectangle(list(comparison.bbox), outline=(255, 0, 0))
+        im.save(join(failure_folder, failure_file))
+
     def _is_image_same(self, name, file1, file2, failure_folder, failure_file):
         with Image.open(file1) as im1, Image.open(file2) as im2:
-            pairs = zip(im1.getdata(), im2.getdata())
-            if len(im1.getbands()) == 1:
-                dif = sum(abs(p1 - p2) for p1, p2 in pairs)
-            else:
-                dif = sum(abs(c1 - c2) for p1, p2 in pairs for c1, c2 in zip(p1, p2))
-
-            ncomponents = im1.size[0] * im1.size[1] * 3
-            difference_percent = (dif / 255.0 * 100) / ncomponents
-            is_passed = not (difference_percent > 0.05)
+            comparison = self._compare(im1, im2)
 
-            if is_passed:
+            if comparison.is_same():
                 return True
             else:
                 if failure_file:
-                    if not os.path.exists(failure_folder):
-                        os.makedirs(failure_folder)
-                    try:
-                        diff_image = ImageChops.difference(im1, im2)
-                        diff = diff_image.getbbox()
-                        diff_list = list(diff) if diff else []
-                        draw = ImageDraw.Draw(im2)
-                        draw.rectangle(diff_list, outline=(255, 0, 0))
-                        im2.save(join(failure_folder, failure_file))
-                    finally:
-                        diff_image.close()
+                    self._write_diff(im2, comparison, failure_folder, failure_file)
                 return False
 
-    def record(self, clean_record=True):
+    def record(self, clean_record=True, incremental=False, screenshots=None):
+        """Records the reference screenshots.
+
+        With incremental, existing references are only rewritten if their
+        pixels changed, and clean_record only removes the references of
+        screenshots that are gone, instead of the whole directory.
+
+        screenshots are the metadata.Screenshots of the input directory,
+        if they were already parsed."""
+        self._device_hashes = manifest.read_device_hashes(self._input)
+        if incremental:
+            return self._record_incrementally(remove_stale=clean_record, screenshots=screenshots)
+
         if clean_record:
             self._clean()
-        self._record()
+        self._record(screenshots)
+
+    def _verify_screenshot(self, screenshot, expected_entry):
+        """Verifies one screenshot, and returns a _VerifyResult"""
+        name, test_class, test_method, w, h = screenshot
+        expected = join(join(self._output, test_class), test_method + ".png")
+        # there is no single file of the actual pixels unless the failure
+        # artifacts stitch one, a tile would only be part of them
+        actual = "screenshot %s (not written without a failure directory)" % name
+        failure_folder = failure_file = None
+        if self._failure_output:
+            failure_folder = join(self._failure_output, test_class)
+            failure_file = name + "_diff.png"
+            actual = join(failure_folder, name + "_actual.png")
+
+        # Identical tile files stitch into the same image as last time, so
+        # most screenshots never need to be decoded at all
+        tiles = self._hash_tiles(name, test_class, w, h)
+        if expected_entry is not None and expected_entry.get("tiles") == tiles:
+            return _VerifyResult(rows=expected_entry["height"], matched_by="tiles")
 
-    def verify(self):
-        self._output = tempfile.mkdtemp()
-        self._record()
+        im2 = layout = None
+        try:
+            if expected_entry is not None:
+                if self._strip_budget:
+                    layout = self._get_layout(name, test_class, w, h)
+                    actual_hash = self._hash_strips(layout)
+                else:
+                    im2 = self._stitch(name, test_class, w, h)
+                    actual_hash = manifest.hash_image(im2)
+                if expected_entry["hash"] == actual_hash:
+                    return _VerifyResult(rows=expected_entry["height"], matched_by="pixels", tiles=tiles)
 
-        root = self._get_metadata_root()
+            with Image.open(expected) as im1:
+                reference = None
+                if expected_entry is None:
+                    if self._strip_budget:
+                        reference = self._describe_in_strips(expected, im1)
+                    else:
+                        reference = manifest.describe_image(im1)
+                # Without failure artifacts there is no need for a bbox, and
+                # the comparison can stop once the image is known to differ
+                if self._failure_output:
+                    stop_above, with_bbox = None, True
+                else:
+                    stop_above, with_bbox = comparator.difference_budget(im1), False
+
+                if self._strip_budget and layout is None:
+                    layout = self._get_layout(name, test_class, w, h)
+                if layout is not None and im1.size == layout.size:
+                    comparison = self._compare_strips(expected, im1, layout, stop_above, with_bbox)
+                else:
+                    if im2 is None:
+                        im2 = self._stitch(name, test_class, w, h)
+                    comparison = self._compare(im1, im2, stop_above, with_bbox)
+                is_passed = comparison.is_same()
+
+                if not is_passed and self._failure_output:
+                    # the failure artifacts need the whole stitched image
+                    if im2 is None:
+                        im2 = self._stitch(name, test_class, w, h)
+                    common.ensure_dir(failure_folder)
+                    im2.save(actual)
+                    shutil.copy(expected, join(failure_folder, name + "_expected.png"))
+                    self._write_diff(im2, comparison, failure_folder, failure_file)
+        finally:
+            if im2 is not None:
+                im2.close()
+
+        return _VerifyResult(failure=None if is_passed else (expected, actual),
+                             rows=im1.size[1],
+                             rows_scanned=comparison.rows_scanned,
+                             reference=reference)
+
+    def verify(self, screenshots=None):
+        self._device_hashes = manifest.read_device_hashes(self._input)
+        reference_manifest = manifest.ReferenceManifest(self._output)
+        screenshots = self._get_screenshots(screenshots)
+        results = self._map(_verify_screenshot,
+                            [(self, screenshot, reference_manifest.lookup(screenshot[1], screenshot[2]))
+                             for screenshot in screenshots])
+        self._report_verify(reference_manifest, screenshots, results)
+
+    def start_verify(self, screenshots=None):
+        """Starts verifying while the screenshots are still being pulled.
+        Call submit(name) on the result once every tile of a screenshot is
+        in the input directory, and finish() after the pull, which raises
+        VerifyError like verify() does."""
+        return _VerifyPipeline(self, screenshots)
+
+    def _report_verify(self, reference_manifest, screenshots, results):
         failures = []
-        for screenshot in root.iter("screenshot"):
-            name = screenshot.find('name').text + ".png"
-            test_class = screenshot.find('test_class').text
-            test_method = screenshot.find('test_name').text
-            actual = join(join(self._output, test_class), test_method + ".png")
-            expected = join(join(self._realoutput, test_class), test_method + ".png")
-            if self._failure_output:
-                diff_name = screenshot.find('name').text + "_diff.png"
-                diff = join(self._failure_output, test_class)
-                is_passed = self._is_image_same(test_method, expected, actual, diff, diff_name)
-                if not is_passed:
-                    expected_name = screenshot.find('name').text + "_expected.png"
-                    actual_name = screenshot.find('name').text + "_actual.png"
-
-                    shutil.copy(actual, join(diff, actual_name))
-                    shutil.copy(expected, join(diff, expected_name))
-
-                    failures.append((expected, actual))
-            else:
-                if not self._is_image_same("", expected, actual, None, None):
-                    raise VerifyError("Image %s is not same as %s" % (expected, actual))
+        self.stats = {"screenshots": len(screenshots), "tile_matches": 0, "hash_matches": 0,
+                      "rows_scanned": 0, "rows": 0}
+        # one {name, test_class, test_name, passed} per screenshot
+        self.results = []
+        for screenshot, result in zip(screenshots, results):
+            test_class, test_method = screenshot[1], screenshot[2]
+            self.results.append({"name": screenshot[0], "test_class": test_class,
+                                 "test_name": test_method, "passed": not result.failure})
+            if result.failure:
+                failures.append(result.failure)
+            if result.reference is not None:
+                reference_manifest.update(test_class, test_method, result.reference)
+            if result.tiles is not None:
+                reference_manifest.add_tiles(test_class, test_method, result.tiles)
+            if result.matched_by == "tiles":
+                self.stats["tile_matches"] += 1
+            elif result.matched_by == "pixels":
+                self.stats["hash_matches"] += 1
+            self.stats["rows_scanned"] += result.rows_scanned
+            self.stats["rows"] += result.rows
+
+        print("Verified %(screenshots)d screenshots, %(tile_matches)d matched by tile hashes, "
+              "%(hash_matches)d by pixel hash, compared %(rows_scanned)d of %(rows)d rows" % self.stats)
+
+        try:
+            reference_manifest.save()
+        except (IOError, OSError):
+            # the manifest is only a cache, references may be read-only
+            pass
 
         if failures:
             reason = ''
             for expected, actual in failures:
                 reason = reason + "\nImage %s is not same as %s" % (expected, actual)
             raise VerifyError(reason)
-
-        shutil.rmtree(self._output)
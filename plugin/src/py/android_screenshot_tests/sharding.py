@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import codecs
+import hashlib
+import json
+import os
+import shutil
+
+from os.path import join
+from xml.sax.saxutils import escape
+
+from . import common
+from . import manifest
+
+# Splits the screenshots of a run between CI nodes, each of which runs
+# pull_screenshots with --shard-index i --shard-count n, and merges what
+# the nodes found back into one result. A screenshot always lands in the
+# same shard, on every node and in every run, so nodes never have to talk
+# to each other.
+
+RESULTS_FILE_NAME = "results.json"
+REPORT_FILE_NAME = "report.html"
+
+
+def _stable_hash(name):
+    # hash() is randomized per process on Python 3
+    return int(hashlib.md5(name.encode("utf-8")).hexdigest()[:8], 16)
+
+
+def shard_of(name, shard_count):
+    return _stable_hash(name) % shard_count
+
+
+def reference_costs(reference_dir, screenshots):
+    """Estimates the cost of verifying each of screenshots, in pixels of
+    its reference as the manifest last saw it. Screenshots without one
+    cost the average."""
+    reference_manifest = manifest.ReferenceManifest(reference_dir)
+    costs = []
+    for screenshot in screenshots:
+        entry = reference_manifest.peek(screenshot.test_class, screenshot.test_name)
+        costs.append(entry["width"] * entry["height"] if entry and "width" in entry else None)
+    known = [cost for cost in costs if cost is not None]
+    average = sum(known) // len(known) if known else 1
+    return [average if cost is None else cost for cost in costs]
+
+
+def split(screenshots, shard_index, shard_count, costs=None):
+    """Returns the screenshots of shard shard_index out of shard_count, in
+    their original order.
+
+    Without costs every screenshot goes to the shard its name hashes to.
+    With costs, a list parallel to screenshots, the most expensive ones
+    are handed out first, each to the shard with the least work so far,
+    which only gives every node the same split if they all see the same
+    costs."""
+    if not 0 <= shard_index < shard_count:
+        raise ValueError("Shard index %d is not in [0, %d)" % (shard_index, shard_count))
+
+    if costs is None:
+        return [s for s in screenshots if shard_of(s.name, shard_count) == shard_index]
+
+    order = sorted(range(len(screenshots)),
+                   key=lambda i: (-costs[i], _stable_hash(screenshots[i].name), screenshots[i].name))
+    loads = [0] * shard_count
+    mine = set()
+    for i in order:
+        shard = min(range(shard_count), key=lambda k: (loads[k], k))
+        loads[shard] += costs[i]
+        if shard == shard_index:
+            mine.add(i)
+    return [s for i, s in enumerate(screenshots) if i in mine]
+
+
+def write_results(directory, shard_index, shard_count, stats, results):
+    """Writes what verifying one shard found, see Recorder.results"""
+    common.write_json(join(directory, RESULTS_FILE_NAME), {
+        "shard_index": shard_index,
+        "shard_count": shard_count,
+        "stats": stats,
+        "screenshots": results,
+    })
+
+
+def _merge_group(shard_results):
+    shard_count = shard_results[0]["shard_count"]
+    if any(results["shard_count"] != shard_count for results in shard_results):
+        raise ValueError("The shards disagree on the shard count")
+
+    indices = sorted(results["shard_index"] for results in shard_results)
+    if len(set(indices)) != len(indices):
+        raise ValueError("Shards %s were given more than once" % indices)
+
+    stats = {}
+    screenshots = []
+    for results in shard_results:
+        for key, value in results["stats"].items():
+            stats[key] = stats.get(key, 0) + value
+        screenshots.extend(results["screenshots"])
+    screenshots.sort(key=lambda s: (s["test_class"], s["test_name"]))
+    return {
+        "shard_count": shard_count,
+        "missing_shards": sorted(set(range(shard_count)) - set(indices)),
+        "stats": stats,
+        "screenshots": screenshots,
+    }
+
+
+def _write_report(directory, merged):
+    failed = [s for s in merged["screenshots"] if not s["passed"]]
+    with codecs.open(join(directory, REPORT_FILE_NAME), mode="w", encoding="utf-8") as html:
+        html.write('<!DOCTYPE html><html><head><title>Screenshot Test Results</title></head><body>')
+        html.write('<h3>%d of %d screenshots failed</h3>' % (len(failed), len(merged["screenshots"])))
+        if merged["missing_shards"]:
+            html.write('<p>Missing shards: %s</p>' % ", ".join(str(i) for i in merged["missing_shards"]))
+        for screenshot in failed:
+            html.write('<div class="screenshot"><h4>%s.%s</h4>' % (
+                escape(screenshot["test_class"]), escape(screenshot["test_name"])))
+            for suffix in ["_expected.png", "_actual.png", "_diff.png"]:
+                image = screenshot["test_class"] + "/" + screenshot["name"] + suffix
+                if os.path.exists(join(directory, image)):
+                    html.write('<img src="%s" />' % escape(image, {'"': "&quot;"}))
+            html.write('</div>')
+        html.write('</body></html>')
+
+
+def merge(shard_dirs, output_dir):
+    """Merges the failure directories of every shard into output_dir, with
+    one results.json and report.html for every directory the shards wrote
+    results into (one per device with --multiple-devices). Returns
+    {relative directory: merged results}."""
+    groups = {}
+    for shard_dir in shard_dirs:
+        for root, _, files in os.walk(shard_dir):
+            relative = os.path.relpath(root, shard_dir)
+            target = os.path.normpath(join(output_dir, relative))
+            common.ensure_dir(target)
+            for name in files:
+                if name == RESULTS_FILE_NAME:
+                    with open(join(root, name)) as f:
+                        groups.setdefault(relative, []).append(json.load(f))
+                elif name != REPORT_FILE_NAME:
+                    shutil.copyfile(join(root, name), join(target, name))
+
+    merged = {}
+    for relative, shard_results in sorted(groups.items()):
+        target = os.path.normpath(join(output_dir, relative))
+        merged[relative] = _merge_group(shard_results)
+        common.write_json(join(target, RESULTS_FILE_NAME), merged[relative])
+        _write_report(target, merged[relative])
+    return merged
@@ -5,28 +5,158 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import contextlib
+import re
 import subprocess
+from . import adb_client
 from . import common
 from .common import get_adb
 
 class SimplePuller:
-    """Pulls a given file from the device"""
+    """Pulls a given file from the device
+
+    Talks to the adb server directly when it is running, and falls back to
+    the adb binary otherwise."""
 
     def __init__(self, adb_args=[]):
         self._adb_args = list(adb_args)
+        # filled in by list_remote()
+        self._external_data_dir = None
+        self._listed_dirs = {}
+        self._remote_files = {}
+
+    def _client(self):
+        return adb_client.get_client(self._adb_args)
+
+    def _shell(self, command):
+        client = self._client()
+        if client:
+            return client.shell(command)
+        return common.check_output([get_adb()] + self._adb_args + ["shell", command])
+
+    def list_remote(self, dirs):
+        """Lists every file under dirs on the device, in a single shell
+        command, and answers remote_file_exists() and
+        get_external_data_dir() from that listing from then on.
+
+        dirs are expanded by the device shell, so they may use
+        $EXTERNAL_STORAGE. Returns {path: (size, mtime)} of the files."""
+        command = (
+            "echo \"E $EXTERNAL_STORAGE\"; "
+            # without a usable find and stat, nothing is known
+            "find / -maxdepth 0 >/dev/null 2>&1 && stat -c %%s / >/dev/null 2>&1 && "
+            "for d in %s; do "
+            "if [ -d $d ]; then echo \"D $d\"; "
+            "find $d -type f -exec stat -c 'F %%s %%Y %%n' {} + 2>/dev/null; "
+            "else echo \"M $d\"; fi; "
+            "done; true") % " ".join(dirs)
+
+        files = {}
+        for line in self._shell(command).splitlines():
+            kind, _, rest = line.rstrip("\r").partition(" ")
+            if kind == "E" and rest:
+                self._external_data_dir = rest
+            elif kind in ("D", "M"):
+                self._listed_dirs[rest.rstrip("/")] = kind == "D"
+            elif kind == "F":
+                size, mtime, path = rest.split(" ", 2)
+                files[path] = (int(size), int(mtime))
+        self._remote_files.update(files)
+        return files
+
+    def get_remote_file_info(self, src):
+        """(size, mtime) of src if list_remote() saw it, else None"""
+        return self._remote_files.get(src)
+
+    def _find_in_listing(self, src):
+        """True or False if the listing knows whether src exists, None if
+        src is outside of the listed directories"""
+        src = src.rstrip("/")
+        for listed_dir, exists in self._listed_dirs.items():
+            if src == listed_dir:
+                return exists
+            if src.startswith(listed_dir + "/"):
+                if not exists:
+                    return False
+                return src in self._remote_files or any(
+                    path.startswith(src + "/") for path in self._remote_files)
+        return None
 
     def remote_file_exists(self, src):
+        listed = self._find_in_listing(src)
+        if listed is not None:
+            return listed
+
+        client = self._client()
+        if client:
+            mode, _, _ = client.stat(src)
+            return mode != 0
+
         output = common.check_output(
             [get_adb()] + self._adb_args + ["shell",
                                         "ls %s && echo EXISTS || echo DOES_NOT_EXIST" % src])
         return "EXISTS" in output
 
     def pull(self, src, dest):
-        subprocess.check_call(
+        client = self._client()
+        if client:
+            client.pull(src, dest)
+            return
+
+        # the output tells a dropped connection from a missing file, see
+        # pull_journal.is_transfer_error()
+        subprocess.check_output(
             [get_adb()] + self._adb_args + ["pull", src, dest],
             stderr=subprocess.STDOUT)
 
+    @contextlib.contextmanager
+    def open_remote(self, src):
+        """Streams the contents of src without storing it on the host"""
+        client = self._client()
+        if client:
+            with contextlib.closing(client.open_remote(src)) as f:
+                yield f
+            return
+
+        command = [get_adb()] + self._adb_args + ["exec-out", "cat", src]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        try:
+            yield process.stdout
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        process.stdout.close()
+        if process.wait():
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+    def pull_directory(self, src, dest):
+        """Pulls the contents of the directory src into the existing
+        directory dest"""
+        client = self._client()
+        if client:
+            client.pull_directory(src, dest)
+            return
+
+        # pulling dir/. copies the contents of dir instead of dir itself
+        subprocess.check_output(
+            [get_adb()] + self._adb_args + ["pull", src.rstrip("/") + "/.", dest],
+            stderr=subprocess.STDOUT)
+
+    def md5sums(self, src):
+        """Returns {file name: md5} of the files in the directory src on the
+        device, without pulling them. Devices without md5sum return none."""
+        output = self._shell("cd %s && md5sum * 2>/dev/null; true" % src)
+
+        hashes = {}
+        for line in output.splitlines():
+            match = re.match(r"([0-9a-f]{32}) [ *](.+)$", line.strip())
+            if match:
+                hashes[match.group(2)] = match.group(1)
+        return hashes
+
     def get_external_data_dir(self):
-        output = common.check_output(
-            [get_adb()] + self._adb_args + ["shell", "echo", "$EXTERNAL_STORAGE"])
+        if self._external_data_dir is not None:
+            return self._external_data_dir
+        output = self._shell("echo $EXTERNAL_STORAGE")
         return output.strip().split()[-1]
@@ -6,11 +6,19 @@ from __future__ import unicode_literals
 import unittest
 from . import aapt
 import os
+import struct
+import sys
 import tempfile
 import shutil
+import zipfile
 from os.path import join, dirname
 from .common import assertRegex
 
+if sys.version_info >= (3,):
+    from unittest.mock import patch
+else:
+    from mock import patch
+
 CURDIR = dirname(__file__)
 
 class TestAapt(unittest.TestCase):
@@ -75,4 +83,71 @@ class TestAapt(unittest.TestCase):
 
     def test_get_package_name(self):
         self.assertEqual('com.facebook.testing.screenshot.examples',
-                          aapt.get_package(join(CURDIR, "example.apk")))
+                          aapt.get_package(join(CURDIR, "example.apk"), cache_dir=self.android_sdk))
+
+def _utf8_manifest(package):
+    """A binary AndroidManifest.xml like aapt2 writes, with a utf-8 string
+    pool and the package as a typed value only"""
+    strings = [s.encode("utf-8") for s in ["manifest", "package", package]]
+    pool_data = b""
+    offsets = []
+    for s in strings:
+        offsets.append(len(pool_data))
+        pool_data += struct.pack("<BB", len(s), len(s)) + s + b"\0"
+    pool_data += b"\0" * (-len(pool_data) % 4)
+    header_size = 28 + 4 * len(strings)
+    pool = struct.pack("<HHIIIIII", 0x0001, 28, header_size + len(pool_data),
+                       len(strings), 0, 0x100, header_size, 0)
+    pool += struct.pack("<%dI" % len(strings), *offsets) + pool_data
+
+    attribute = struct.pack("<IIIHBBI", 0xffffffff, 1, 0xffffffff, 8, 0, 0x03, 2)
+    element = struct.pack("<IIHHHHHH", 0xffffffff, 0, 20, 20, 1, 0, 0, 0) + attribute
+    element = struct.pack("<HHIII", 0x0102, 16, 16 + len(element), 1, 0xffffffff) + element
+    return struct.pack("<HHI", 0x0003, 8, 8 + len(pool) + len(element)) + pool + element
+
+class TestManifestPackage(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _apk(self, manifest):
+        apk = join(self.tmpdir, "foo.apk")
+        with zipfile.ZipFile(apk, "w") as z:
+            z.writestr(aapt.MANIFEST, manifest)
+        return apk
+
+    def _get_package(self, apk):
+        return aapt.get_package(apk, cache_dir=self.tmpdir)
+
+    def test_does_not_need_aapt(self):
+        with patch.object(aapt, "_get_package_from_aapt", side_effect=AssertionError("used aapt")):
+            self.assertEqual('com.facebook.testing.screenshot.examples',
+                             self._get_package(join(CURDIR, "example.apk")))
+
+    def test_utf8_string_pool(self):
+        self.assertEqual("com.foo.bar", aapt.parse_manifest_package(_utf8_manifest("com.foo.bar")))
+
+    def test_falls_back_to_aapt(self):
+        apk = self._apk(b"<manifest package='com.foo'/>")
+        self.assertRaises(aapt.BadManifest, aapt.parse_manifest_package, b"<manifest package='com.foo'/>")
+        with patch.object(aapt, "_get_package_from_aapt", return_value="com.foo") as from_aapt:
+            self.assertEqual("com.foo", self._get_package(apk))
+            from_aapt.assert_called_once_with(apk)
+
+    def test_truncated_manifest(self):
+        manifest = _utf8_manifest("com.foo.bar")
+        self.assertRaises(aapt.BadManifest, aapt.parse_manifest_package, manifest[:60])
+
+    def test_package_is_cached(self):
+        apk = self._apk(_utf8_manifest("com.foo.bar"))
+        self.assertEqual("com.foo.bar", self._get_package(apk))
+
+        with patch.object(aapt, "_get_package_from_apk", side_effect=AssertionError("not cached")):
+            self.assertEqual("com.foo.bar", self._get_package(apk))
+
+        # a rebuilt apk is read again
+        apk = self._apk(_utf8_manifest("com.foo.baz"))
+        os.utime(apk, (0, 0))
+        self.assertEqual("com.foo.baz", self._get_package(apk))
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import socket
+import struct
+import sys
+import subprocess
+import tempfile
+import threading
+import unittest
+
+if sys.version_info >= (3,):
+    from unittest.mock import patch
+else:
+    from mock import patch
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from . import adb_client
+from .adb_client import AdbClient, AdbError
+
+
+def _read_exactly(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise EOFError()
+    return data
+
+
+class FakeAdbHandler(socketserver.StreamRequestHandler):
+    """Implements just enough of the adb server to serve a single device,
+    whose files and shell commands are dicts on the server"""
+
+    def _okay(self):
+        self.wfile.write(b"OKAY")
+
+    def _fail(self, message):
+        message = message.encode("utf-8")
+        self.wfile.write(b"FAIL" + ("%04x" % len(message)).encode("ascii") + message)
+
+    def _read_request(self):
+        return _read_exactly(self.rfile, int(_read_exactly(self.rfile, 4), 16)).decode("utf-8")
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        try:
+            while True:
+                request = self._read_request()
+                server.requests.append(request)
+                if request == "host:version":
+                    self._okay()
+                    self.wfile.write(b"0004" + b"0029")
+                    return
+                if request == "host:devices":
+                    self._okay()
+                    data = "".join("%s\t%s\n" % device for device in server.devices).encode("utf-8")
+                    self.wfile.write(("%04x" % len(data)).encode("ascii") + data)
+                    return
+                if request.startswith("host:transport"):
+                    if request not in ("host:transport-any", "host:transport:" + server.serial):
+                        self._fail("device not found")
+                        return
+                    self._okay()
+                    continue
+                if request.startswith("shell:"):
+                    self._shell(request[len("shell:"):])
+                    return
+                if request == "sync:":
+                    self._okay()
+                    self._sync()
+                    return
+                self._fail("unknown request")
+                return
+        except EOFError:
+            pass
+
+    def _shell(self, command):
+        command, _, _ = command.partition("; printf")
+        output, status = self.server.shell.get(command, ("sh: %s: not found\n" % command, 127))
+        self._okay()
+        self.wfile.write(("%s\n%s%d" % (output, adb_client._EXIT_MARKER, status)).encode("utf-8"))
+
+    def _sync(self):
+        while True:
+            request_id = _read_exactly(self.rfile, 4)
+            length = struct.unpack("<I", _read_exactly(self.rfile, 4))[0]
+            path = _read_exactly(self.rfile, length).decode("utf-8")
+            data = self.server.files.get(path)
+            if request_id == b"QUIT":
+                return
+            if request_id == b"STAT":
+                if data is None:
+                    self.wfile.write(b"STAT" + struct.pack("<III", 0, 0, 0))
+                else:
+                    self.wfile.write(b"STAT" + struct.pack("<III", 0o100644, len(data), 0))
+            elif request_id == b"LIST":
+                prefix = path.rstrip("/") + "/"
+                for name in [".", ".."] + sorted(p[len(prefix):] for p in self.server.files
+                                                 if p.startswith(prefix) and "/" not in p[len(prefix):]):
+                    encoded = name.encode("utf-8")
+                    self.wfile.write(b"DENT" + struct.pack("<IIII", 0o100644, 0, 0, len(encoded)) + encoded)
+                self.wfile.write(b"DONE" + struct.pack("<IIII", 0, 0, 0, 0))
+            elif request_id == b"RECV":
+                if data is None:
+                    message = b"No such file or directory"
+                    self.wfile.write(b"FAIL" + struct.pack("<I", len(message)) + message)
+                    continue
+                for i in range(0, len(data), 3):
+                    chunk = data[i:i + 3]
+                    self.wfile.write(b"DATA" + struct.pack("<I", len(chunk)) + chunk)
+                self.wfile.write(b"DONE" + struct.pack("<I", 0))
+
+
+class FakeAdbServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), FakeAdbHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        self.serial = "emulator-5554"
+        self.devices = [(self.serial, "device"), ("0123456789", "offline")]
+        self.files = {}
+        self.shell = {}
+
+
+class TestAdbClient(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeAdbServer()
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.port = self.server.server_address[1]
+        self.client = AdbClient(["-s", self.server.serial], host="127.0.0.1", port=self.port)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_transport_request(self):
+        self.assertEqual("host:transport:foo", adb_client.transport_request(["-e", "-s", "foo"]))
+        self.assertEqual("host:transport-usb", adb_client.transport_request(["-d"]))
+        self.assertEqual("host:transport-local", adb_client.transport_request(["-e"]))
+        self.assertEqual("host:transport-any", adb_client.transport_request([]))
+
+    def test_devices(self):
+        self.assertEqual([("emulator-5554", "device"), ("0123456789", "offline")],
+                         self.client.devices())
+
+    def test_shell(self):
+        self.server.shell["echo $EXTERNAL_STORAGE"] = ("/sdcard\n", 0)
+        self.assertEqual("/sdcard\n", self.client.shell("echo $EXTERNAL_STORAGE"))
+
+    def test_shell_failure(self):
+        self.server.shell["pm path foo"] = ("", 1)
+        self.assertRaises(subprocess.CalledProcessError, self.client.shell, "pm path foo")
+
+    def test_unknown_device(self):
+        client = AdbClient(["-s", "nope"], host="127.0.0.1", port=self.port)
+        self.assertRaises(AdbError, client.shell, "true")
+
+    def test_pull_reuses_connection(self):
+        self.server.files["/sdcard/foo"] = b"foobar\n"
+        self.server.files["/sdcard/bar"] = b""
+        foo = os.path.join(self.tmpdir, "foo")
+        bar = os.path.join(self.tmpdir, "bar")
+
+        self.assertNotEqual(0, self.client.stat("/sdcard/foo")[0])
+        self.assertEqual(0, self.client.stat("/sdcard/baz")[0])
+        self.client.pull("/sdcard/foo", foo)
+        self.client.pull("/sdcard/bar", bar)
+
+        with open(foo, "rb") as f:
+            self.assertEqual(b"foobar\n", f.read())
+        with open(bar, "rb") as f:
+            self.assertEqual(b"", f.read())
+        self.assertEqual(1, self.server.requests.count("sync:"))
+
+    def test_pull_directory(self):
+        self.server.files["/sdcard/dir/foo"] = b"foo"
+        self.server.files["/sdcard/dir/bar"] = b"bar"
+        self.server.files["/sdcard/other"] = b"other"
+
+        self.client.pull_directory("/sdcard/dir/", self.tmpdir)
+        self.assertEqual(["bar", "foo"], sorted(os.listdir(self.tmpdir)))
+        self.assertEqual(1, self.server.requests.count("sync:"))
+
+    def test_pull_missing_file(self):
+        self.server.files["/sdcard/foo"] = b"foo"
+        dest = os.path.join(self.tmpdir, "missing")
+
+        self.assertRaises(AdbError, self.client.pull, "/sdcard/missing", dest)
+        self.assertFalse(os.path.exists(dest))
+
+        # and the connection is still good
+        self.client.pull("/sdcard/foo", dest)
+        self.assertEqual(1, self.server.requests.count("sync:"))
+
+    def test_get_client_without_server(self):
+        # a port nothing listens on
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        with patch.dict(os.environ, {"ANDROID_ADB_SERVER_ADDRESS": "127.0.0.1",
+                                     "ANDROID_ADB_SERVER_PORT": str(port)}):
+            self.assertIsNone(adb_client.get_client(["-s", "foo"]))
+
+    def test_get_client_is_shared(self):
+        with patch.dict(os.environ, {"ANDROID_ADB_SERVER_ADDRESS": "127.0.0.1",
+                                     "ANDROID_ADB_SERVER_PORT": str(self.port)}):
+            client = adb_client.get_client(["-s", "foo"])
+            self.assertIsNotNone(client)
+            self.assertIs(client, adb_client.get_client(["-s", "foo"]))
+            self.assertIsNot(client, adb_client.get_client(["-s", "bar"]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,7 @@ import os
 from . import common
 import subprocess
 import sys
+import tempfile
 
 class TestCommon(unittest.TestCase):
     def setUp(self):
@@ -34,3 +35,17 @@ class TestCommon(unittest.TestCase):
     def test_get_adb_can_run_in_subprocess(self):
         os.environ['ANDROID_SDK'] = self.android_sdk
         subprocess.check_call([common.get_adb(), "devices"])
+
+
+class TestPngSize(unittest.TestCase):
+    def test_get_png_size(self):
+        with tempfile.NamedTemporaryFile(suffix=".png") as f:
+            f.write(common.PNG_SIGNATURE + b'\x00\x00\x00\x0dIHDR\x00\x00\x04\x38\x00\x00\x07\x80')
+            f.flush()
+            self.assertEqual((1080, 1920), common.get_png_size(f.name))
+
+    def test_get_png_size_not_a_png(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'GIF89a')
+            f.flush()
+            self.assertIsNone(common.get_png_size(f.name))
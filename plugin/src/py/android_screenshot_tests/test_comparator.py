@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from PIL import Image
+
+from . import comparator
+from .benchmark import _legacy_difference
+
+
+class TestComparator(unittest.TestCase):
+    def setUp(self):
+        self.numpy = comparator.numpy
+
+    def tearDown(self):
+        comparator.numpy = self.numpy
+
+    def _engines(self):
+        engines = [None]
+        if self.numpy is not None:
+            engines.append(self.numpy)
+        return engines
+
+    def test_identical_images(self):
+        im = Image.new("RGBA", (10, 10), "blue")
+        for engine in self._engines():
+            comparator.numpy = engine
+            comparison = comparator.compare(im, im.copy())
+            self.assertEqual(0, comparison.difference)
+            self.assertIsNone(comparison.bbox)
+            self.assertTrue(comparison.is_same())
+
+    def test_matches_legacy_difference(self):
+        im1 = Image.new("RGBA", (20, 10), "blue")
+        im2 = im1.copy()
+        im2.putpixel((3, 4), (10, 20, 30, 40))
+        im2.putpixel((15, 7), (255, 255, 255, 255))
+        for engine in self._engines():
+            comparator.numpy = engine
+            comparison = comparator.compare(im1, im2)
+            self.assertEqual(_legacy_difference(im1, im2), comparison.difference)
+            self.assertEqual((3, 4, 16, 8), comparison.bbox)
+
+    def test_single_band(self):
+        im1 = Image.new("L", (10, 10), 0)
+        im2 = im1.copy()
+        im2.putpixel((9, 9), 200)
+        for engine in self._engines():
+            comparator.numpy = engine
+            comparison = comparator.compare(im1, im2)
+            self.assertEqual(200, comparison.difference)
+            self.assertEqual((9, 9, 10, 10), comparison.bbox)
+
+    def test_threshold(self):
+        im1 = Image.new("RGB", (100, 100), "black")
+        im2 = im1.copy()
+        # 0.05% of 30000 components is 15 full-intensity components
+        for x in range(5):
+            im2.putpixel((x, 0), (255, 255, 255))
+        self.assertTrue(comparator.compare(im1, im2).is_same())
+
+        im2.putpixel((5, 0), (255, 0, 0))
+        self.assertFalse(comparator.compare(im1, im2).is_same())
+
+    @unittest.skipIf(comparator.numpy is None, "only the numpy engine compares in data order")
+    def test_different_sizes(self):
+        im1 = Image.new("RGBA", (10, 10), "blue")
+        im2 = Image.new("RGBA", (11, 11), "green")
+        comparison = comparator.compare(im1, im2)
+        self.assertEqual(_legacy_difference(im1, im2), comparison.difference)
+        self.assertEqual((0, 0, 10, 10), comparison.bbox)
+        self.assertFalse(comparison.is_same())
+
+    def test_stops_once_over_budget(self):
+        im1 = Image.new("RGBA", (10, 100), "blue")
+        im2 = im1.copy()
+        for y in range(10, 100):
+            im2.putpixel((0, y), (255, 255, 255, 255))
+        for engine in self._engines():
+            comparator.numpy = engine
+            comparison = comparator.compare(im1, im2, stop_above=255 * 3, with_bbox=False, block_rows=8)
+            self.assertEqual(16, comparison.rows_scanned)
+            self.assertIsNone(comparison.bbox)
+
+    def test_identical_blocks_are_skipped(self):
+        im1 = Image.new("RGBA", (10, 100), "blue")
+        im2 = im1.copy()
+        im2.putpixel((4, 50), (0, 0, 0, 255))
+        im2.putpixel((6, 90), (0, 0, 0, 255))
+        for engine in self._engines():
+            comparator.numpy = engine
+            comparison = comparator.compare(im1, im2, block_rows=8)
+            self.assertEqual(100, comparison.rows_scanned)
+            self.assertEqual(_legacy_difference(im1, im2), comparison.difference)
+            self.assertEqual((4, 50, 7, 91), comparison.bbox)
+
+    def test_difference_budget(self):
+        im = Image.new("RGB", (100, 100))
+        self.assertAlmostEqual(15 * 255, comparator.difference_budget(im))
+
+
+if __name__ == '__main__':
+    unittest.main()
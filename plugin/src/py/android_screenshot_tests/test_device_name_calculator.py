@@ -1,7 +1,10 @@
+import shutil
 import subprocess
 import sys
+import tempfile
 import unittest
 
+from . import device_name_calculator
 from .device_name_calculator import DeviceNameCalculator
 
 if sys.version_info >= (3,):
@@ -179,3 +182,80 @@ class TestDeviceNameCalculator(unittest.TestCase):
         result = device_calculator._has_play_services()
 
         assert not result
+
+
+class FakeShellExecutor:
+    """Answers adb shell commands from a dict, including the batches
+    DeviceNameCalculator sends"""
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+        self.commands = []
+
+    def _run(self, command):
+        command = command.replace(" 2>/dev/null", "")
+        if command not in self.outputs:
+            return "", 127
+        return self.outputs[command]
+
+    def execute(self, parameters):
+        self.commands.append(parameters)
+        script = " ".join(parameters[1:])
+        separator = "; echo %s $?; " % device_name_calculator._BATCH_MARKER
+        if separator not in script:
+            output, status = self._run(script)
+            if status:
+                raise subprocess.CalledProcessError(status, parameters, output)
+            return output
+
+        result = ""
+        for command in script.split(separator)[:-1]:
+            output, status = self._run(command)
+            result += "%s%s %d\n" % (output, device_name_calculator._BATCH_MARKER, status)
+        return result
+
+
+class TestBatchedDeviceName(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.outputs = {
+            "getprop ro.build.version.sdk": ("28\n", 0),
+            "getprop ro.product.cpu.abi": ("x86\n", 0),
+            "getprop persist.sys.locale": ("\n", 0),
+            "getprop ro.product.locale": ("en-US\n", 0),
+            "getprop ro.serialno": ("EMULATOR28X0X0X0\n", 0),
+            "cat /proc/sys/kernel/random/boot_id": ("c9a3a6a4-4a0b-4b38-8a8c-9e8d3a1f5a2b\n", 0),
+            "wm density": ("Physical density: 420\n", 0),
+            "wm size": ("Physical size: 1080x1920\n", 0),
+            "pm path com.google.android.gms": ("", 1),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _name(self, executor):
+        return DeviceNameCalculator(executor, cache_dir=self.cache_dir).name()
+
+    def test_same_name_as_one_command_at_a_time(self):
+        executor = FakeShellExecutor(self.outputs)
+        name = self._name(executor)
+
+        one_at_a_time = FakeShellExecutor(self.outputs)
+        one_at_a_time.execute = MagicMock(side_effect=lambda parameters: FakeShellExecutor.execute(
+            one_at_a_time, parameters) if len(parameters) > 2 else None)
+        self.assertEqual(name, DeviceNameCalculator(one_at_a_time, cache_dir=self.cache_dir).name())
+        self.assertEqual("API_28_NO_GP_XXHDPI_1080x1920_x86_", name)
+        self.assertEqual(2, len(executor.commands))
+
+    def test_slow_commands_are_cached_until_reboot(self):
+        self._name(FakeShellExecutor(self.outputs))
+
+        executor = FakeShellExecutor(self.outputs)
+        self.assertEqual("API_28_NO_GP_XXHDPI_1080x1920_x86_", self._name(executor))
+        self.assertEqual(1, len(executor.commands))
+
+        self.outputs["cat /proc/sys/kernel/random/boot_id"] = ("another boot\n", 0)
+        self.outputs["wm density"] = ("Physical density: 160\n", 0)
+        executor = FakeShellExecutor(self.outputs)
+        self.assertEqual("API_28_NO_GP_MDPI_1080x1920_x86_", self._name(executor))
+        self.assertEqual(2, len(executor.commands))
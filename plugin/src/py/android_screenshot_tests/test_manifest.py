@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from . import manifest
+
+
+class TestReferenceManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.image = Image.new("RGBA", (10, 10), "blue")
+        self._save_reference(self.image)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _save_reference(self, im):
+        path = os.path.join(self.tmpdir, "Foo")
+        if not os.path.exists(path):
+            os.makedirs(path)
+        im.save(os.path.join(path, "bar.png"))
+
+    def _record(self):
+        reference_manifest = manifest.ReferenceManifest(self.tmpdir)
+        reference_manifest.update("Foo", "bar", manifest.describe_image(self.image))
+        reference_manifest.save()
+
+    def test_hash_depends_on_pixels_size_and_mode(self):
+        hashes = set([
+            manifest.hash_image(self.image),
+            manifest.hash_image(Image.new("RGBA", (10, 10), "red")),
+            manifest.hash_image(Image.new("RGBA", (5, 20), "blue")),
+            manifest.hash_image(Image.new("RGB", (10, 10), "blue")),
+        ])
+        self.assertEqual(4, len(hashes))
+
+    def test_lookup_after_save(self):
+        self._record()
+
+        entry = manifest.ReferenceManifest(self.tmpdir).lookup("Foo", "bar")
+        self.assertEqual(manifest.hash_image(self.image), entry["hash"])
+        self.assertEqual(10, entry["width"])
+        self.assertEqual("RGBA", entry["mode"])
+
+    def test_missing_entry(self):
+        self.assertIsNone(manifest.ReferenceManifest(self.tmpdir).lookup("Foo", "bar"))
+
+    def test_edited_reference_is_stale(self):
+        self._record()
+        self._save_reference(Image.new("RGBA", (10, 10), "red"))
+        os.utime(os.path.join(self.tmpdir, "Foo", "bar.png"), (0, 0))
+
+        self.assertIsNone(manifest.ReferenceManifest(self.tmpdir).lookup("Foo", "bar"))
+
+    def test_touched_reference_is_still_valid(self):
+        self._record()
+        os.utime(os.path.join(self.tmpdir, "Foo", "bar.png"), (0, 0))
+
+        entry = manifest.ReferenceManifest(self.tmpdir).lookup("Foo", "bar")
+        self.assertEqual(manifest.hash_image(self.image), entry["hash"])
+
+    def test_touching_a_reference_leaves_the_manifest_alone(self):
+        self._record()
+        path = os.path.join(self.tmpdir, manifest.MANIFEST_FILE_NAME)
+        with open(path) as f:
+            recorded = f.read()
+        self.assertNotIn("mtime", recorded)
+
+        # as after a fresh clone
+        os.utime(os.path.join(self.tmpdir, "Foo", "bar.png"), (0, 0))
+        reference_manifest = manifest.ReferenceManifest(self.tmpdir)
+        self.assertIsNotNone(reference_manifest.lookup("Foo", "bar"))
+        reference_manifest.save()
+        self._record()
+
+        with open(path) as f:
+            self.assertEqual(recorded, f.read())
+
+    def test_corrupt_manifest_is_ignored(self):
+        with open(os.path.join(self.tmpdir, manifest.MANIFEST_FILE_NAME), "w") as f:
+            f.write("{not json")
+
+        self.assertIsNone(manifest.ReferenceManifest(self.tmpdir).lookup("Foo", "bar"))
+
+
+if __name__ == '__main__':
+    unittest.main()
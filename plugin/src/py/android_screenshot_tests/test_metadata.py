@@ -7,8 +7,15 @@ from __future__ import unicode_literals
 import unittest
 import tempfile
 import shutil
+import io
 import os
+import sys
 import xml.etree.ElementTree as ET
+
+if sys.version_info >= (3,):
+    from unittest.mock import patch
+else:
+    from mock import patch
 from . import metadata
 
 # Tests for the metadata package
@@ -50,6 +57,94 @@ class TestMetadata(unittest.TestCase):
 
         self.assertEqual(7, self.get_num_screenshots_in(self.tmp_metadata))
 
+    def test_parse(self):
+        screenshots = metadata.parse(self.fixture_metadata)
+
+        self.assertEqual(self.get_num_screenshots_in(self.fixture_metadata), len(screenshots))
+        first = screenshots[0]
+        self.assertEqual("com.facebook.places.checkin.CheckinTitleBarTest_testEditBoxIsCentered", first.name)
+        self.assertEqual("com.facebook.places.checkin.CheckinTitleBarTest", first.test_class)
+        self.assertEqual("testEditBoxIsCentered", first.test_name)
+        self.assertEqual("", first.description)
+        self.assertIsNone(first.group)
+        self.assertIsNone(first.error)
+
+    def test_parse_tiles_and_extras(self):
+        with open(self.tmp_metadata, "w") as f:
+            f.write("""<screenshots>
+              <screenshot>
+                <name>foo</name>
+                <tile_width>2</tile_width>
+                <tile_height>1</tile_height>
+                <relative_file_name>foo.png</relative_file_name>
+                <relative_file_name>foo_1_0.png</relative_file_name>
+                <view_hierarchy>foo_dump.json</view_hierarchy>
+                <extras><bar>baz</bar><empty/></extras>
+                <error/>
+              </screenshot>
+            </screenshots>""")
+
+        screenshot, = metadata.parse(self.tmp_metadata)
+        self.assertEqual((2, 1), (screenshot.tile_width, screenshot.tile_height))
+        self.assertEqual(["foo.png", "foo_1_0.png"], screenshot.relative_file_names)
+        self.assertEqual("foo_dump.json", screenshot.view_hierarchy)
+        self.assertEqual([("bar", "baz"), ("empty", None)], screenshot.extras)
+        self.assertEqual("", screenshot.error)
+
+    def test_parse_does_not_keep_the_tree(self):
+        roots = []
+        iterparse = ET.iterparse
+
+        def capture_root(*args, **kwargs):
+            for event, element in iterparse(*args, **kwargs):
+                if not roots:
+                    roots.append(element)
+                yield event, element
+
+        with patch.object(metadata.ET, "iterparse", side_effect=capture_root):
+            screenshots = metadata.parse(self.fixture_metadata)
+
+        self.assertTrue(screenshots)
+        self.assertEqual(0, len(list(roots[0])))
+
+    def test_parse_error(self):
+        with open(self.tmp_metadata, "w") as f:
+            f.write("<screenshots><screenshot>")
+
+        self.assertRaises(ET.ParseError, metadata.parse, self.tmp_metadata)
+
+    def test_selector(self):
+        screenshots = metadata.parse(io.BytesIO(b"""<screenshots>
+          <screenshot><name>a.FooTest_one</name><test_class>a.FooTest</test_class><group>x</group></screenshot>
+          <screenshot><name>a.FooTest_two</name><test_class>a.FooTest</test_class></screenshot>
+          <screenshot><name>a.BarTest_one</name><test_class>a.BarTest</test_class><group>x</group></screenshot>
+        </screenshots>"""))
+
+        def select(**kwargs):
+            return [s.name for s in metadata.Selector(**kwargs).select(screenshots)]
+
+        self.assertEqual(["a.FooTest_one", "a.FooTest_two", "a.BarTest_one"], select())
+        self.assertEqual(["a.FooTest_one", "a.BarTest_one"], select(name_regex="_one"))
+        self.assertEqual(["a.FooTest_two"], select(name_globs=["*_tw?"]))
+        self.assertEqual(["a.FooTest_one", "a.FooTest_two"], select(test_classes=["a.FooTest"]))
+        self.assertEqual(["a.FooTest_one", "a.BarTest_one"], select(groups=["x"]))
+        self.assertEqual(["a.BarTest_one"], select(groups=["x"], exclude_test_classes=["a.FooTest"]))
+        self.assertEqual(["a.FooTest_two"], select(exclude_groups=["x"]))
+        self.assertEqual(["a.FooTest_one"], select(exclude_name_globs=["*Bar*", "*two"]))
+        self.assertEqual(["a.BarTest_one"], select(names=["a.BarTest_one", "missing"]))
+        self.assertEqual(["a.FooTest_two"], select(exclude_names=["a.FooTest_one", "a.BarTest_one"]))
+
+    def test_selector_selects_everything(self):
+        self.assertTrue(metadata.Selector().selects_everything())
+        self.assertFalse(metadata.Selector(names=[]).selects_everything())
+        self.assertEqual([], metadata.Selector(names=[]).select(metadata.parse(self.fixture_metadata)))
+
+    def test_read_names(self):
+        with open(self.tmp_metadata, "w") as f:
+            f.write("# screenshots to verify\nfoo\n\n  bar  \n")
+
+        self.assertEqual(["foo", "bar"], metadata.read_names(self.tmp_metadata))
+
     def get_num_screenshots_in(self, metadata_file):
         """Gets the number of screenshots in the given metadata file"""
         return len(list(ET.parse(metadata_file).getroot().iter('screenshot')))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import random
+import tempfile
+import unittest
+
+from PIL import Image
+
+from .png_reader import PngReader, UnsupportedPng
+from .png_writer import PngWriter
+
+
+class TestPngReader(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".png")
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def _noisy_image(self, mode, size):
+        rng = random.Random(42)
+        im = Image.new(mode, size)
+        bands = len(im.getbands())
+        for y in range(size[1]):
+            for x in range(0, size[0], rng.randrange(1, 5)):
+                pixel = tuple(rng.randrange(256) for _ in range(bands))
+                im.putpixel((x, y), pixel if bands > 1 else pixel[0])
+        return im
+
+    def _read_in_strips(self, strip_height):
+        strips = []
+        with PngReader(self.path) as reader:
+            while True:
+                strip = reader.read(strip_height)
+                if not strip.size[1]:
+                    return reader, strips
+                strips.append(strip)
+
+    def _assert_strips_match(self, im, strip_height):
+        reader, strips = self._read_in_strips(strip_height)
+        self.assertEqual(im.mode, reader.mode)
+        self.assertEqual(im.size, reader.size)
+        self.assertEqual([min(strip_height, im.size[1] - top) for top in range(0, im.size[1], strip_height)],
+                         [strip.size[1] for strip in strips])
+        self.assertEqual(im.tobytes(), b"".join(strip.tobytes() for strip in strips))
+
+    def test_reads_what_pil_writes(self):
+        # PIL picks a different filter for every row
+        for mode in ["L", "LA", "RGB", "RGBA"]:
+            im = self._noisy_image(mode, (37, 51))
+            im.save(self.path)
+            self._assert_strips_match(im, 10)
+
+    def test_reads_what_png_writer_writes(self):
+        im = self._noisy_image("RGBA", (37, 51))
+        with PngWriter(self.path, im.size) as writer:
+            for top in range(0, im.size[1], 13):
+                writer.write(im.crop((0, top, im.size[0], min(im.size[1], top + 13))))
+        self._assert_strips_match(im, 7)
+
+    def test_unsupported(self):
+        Image.new("P", (10, 10)).save(self.path)
+        self.assertRaises(UnsupportedPng, PngReader, self.path)
+
+        im = Image.new("RGB", (10, 10))
+        im.save(self.path, transparency=(0, 0, 0))
+        self.assertRaises(UnsupportedPng, PngReader, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
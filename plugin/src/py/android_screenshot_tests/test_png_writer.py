@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import random
+import tempfile
+import unittest
+
+from PIL import Image
+
+from . import png_writer
+from .png_writer import PngWriter
+
+
+class TestPngWriter(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".png")
+        os.close(fd)
+        self.numpy = png_writer.numpy
+
+    def tearDown(self):
+        png_writer.numpy = self.numpy
+        os.unlink(self.path)
+
+    def _noisy_image(self, mode, size):
+        rng = random.Random(42)
+        im = Image.new(mode, size)
+        bands = len(im.getbands())
+        for y in range(size[1]):
+            for x in range(0, size[0], rng.randrange(1, 5)):
+                pixel = tuple(rng.randrange(256) for _ in range(bands))
+                im.putpixel((x, y), pixel if bands > 1 else pixel[0])
+        return im
+
+    def _write_in_strips(self, im, strip_height):
+        with PngWriter(self.path, im.size, im.mode) as writer:
+            for top in range(0, im.size[1], strip_height):
+                writer.write(im.crop((0, top, im.size[0], min(im.size[1], top + strip_height))))
+
+    def test_round_trip(self):
+        for mode in ["L", "LA", "RGB", "RGBA"]:
+            im = self._noisy_image(mode, (37, 51))
+            self._write_in_strips(im, 10)
+            with Image.open(self.path) as written:
+                self.assertEqual(mode, written.mode)
+                self.assertEqual(im.tobytes(), written.tobytes())
+
+    def test_round_trip_without_numpy(self):
+        png_writer.numpy = None
+        im = self._noisy_image("RGBA", (37, 51))
+        self._write_in_strips(im, 7)
+        with Image.open(self.path) as written:
+            self.assertEqual(im.tobytes(), written.tobytes())
+
+    def test_missing_rows(self):
+        im = Image.new("RGBA", (10, 10))
+        writer = PngWriter(self.path, (10, 20))
+        writer.write(im)
+        self.assertRaises(ValueError, writer.close)
+
+    def test_wrong_width(self):
+        with PngWriter(self.path, (10, 10)) as writer:
+            self.assertRaises(ValueError, writer.write, Image.new("RGBA", (9, 10)))
+            writer.write(Image.new("RGBA", (10, 10)))
+
+
+if __name__ == '__main__':
+    unittest.main()
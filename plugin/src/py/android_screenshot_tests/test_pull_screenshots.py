@@ -5,12 +5,23 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 import unittest
+import hashlib
+import io
+import json
 import os
 import sys
+from . import adb_client
+from . import metadata
+from . import pull_journal
 from . import pull_screenshots
+from . import sharding
 import tempfile
 import shutil
+import socket
+import subprocess
+import threading
 import xml.etree.ElementTree as ET
+import zipfile
 from os.path import join
 
 if sys.version_info >= (3,):
@@ -41,6 +52,7 @@ def assert_nice_filename(filename):
 class AdbPuller:
     def __init__(self, fixture_dir=join(CURRENT_DIR, "fixtures")):
         self.fixture_dir = fixture_dir
+        self.remote_files = {}
 
     def pull(self, src, dest):
         self._valid_src(src)
@@ -48,6 +60,34 @@ class AdbPuller:
         src = self.fixture_dir + src
         shutil.copyfile(src, dest)
 
+    def pull_directory(self, src, dest):
+        self._valid_src(src)
+        src = self.fixture_dir + src
+        for name in os.listdir(src):
+            shutil.copyfile(join(src, name), join(dest, name))
+
+    def list_remote(self, dirs):
+        for dir in dirs:
+            dir = dir.replace("$EXTERNAL_STORAGE", self.get_external_data_dir())
+            local_dir = self.fixture_dir + dir
+            if os.path.isdir(local_dir):
+                for name in os.listdir(local_dir):
+                    st = os.stat(join(local_dir, name))
+                    self.remote_files[dir + "/" + name] = (st.st_size, int(st.st_mtime))
+        return self.remote_files
+
+    def get_remote_file_info(self, src):
+        return self.remote_files.get(src)
+
+    def md5sums(self, src):
+        self._valid_src(src)
+        src = self.fixture_dir + src
+        hashes = {}
+        for name in os.listdir(src):
+            with open(join(src, name), "rb") as f:
+                hashes[name] = hashlib.md5(f.read()).hexdigest()
+        return hashes
+
     def remote_file_exists(self, src):
         self._valid_src(src)
         assert_nice_filename(src)
@@ -81,6 +121,371 @@ class TestAdbHelpers(unittest.TestCase):
 
         self.assertTrue(os.path.exists(self.tmpdir + "/metadata.xml"))
 
+    def test_stream_bundle_extracts_referenced_files(self):
+        bundle = io.BytesIO()
+        with zipfile.ZipFile(bundle, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr("com.foo.Bar_test.png", b"wanted")
+            z.writestr("com.foo.Bar_filtered.png", b"filtered")
+        with open(join(self.tmpdir, "metadata.xml"), "w") as f:
+            f.write("""<screenshots><screenshot>
+<name>com.foo.Bar_test</name><test_class>com.foo.Bar</test_class>
+<relative_file_name>com.foo.Bar_test.png</relative_file_name>
+</screenshot></screenshots>""")
+
+        adb_instance = MagicMock()
+        adb_instance.remote_file_exists.return_value = True
+        adb_instance.open_remote.return_value.__enter__.return_value = io.BytesIO(bundle.getvalue())
+        adb_instance.pull.side_effect = Exception("should not be called")
+
+        pull_screenshots.pull_images(self.tmpdir, "/sdcard/screenshots", adb_instance,
+                                     stream_bundle=True, only_referenced=True)
+
+        adb_instance.open_remote.assert_called_once_with("/sdcard/screenshots/screenshot_bundle.zip")
+        self.assertTrue(os.path.exists(join(self.tmpdir, "com.foo.Bar_test.png")))
+        self.assertFalse(os.path.exists(join(self.tmpdir, "com.foo.Bar_filtered.png")))
+        self.assertFalse(os.path.exists(join(self.tmpdir, "screenshot_bundle.zip")))
+
+    def _make_device(self):
+        """A device directory like the fixture, without the failed screenshot"""
+        device = tempfile.mkdtemp()
+        device_dir = join(device, "sdcard/screenshots", TESTING_PACKAGE, "screenshots-default")
+        os.makedirs(device_dir)
+        root = ET.parse(join(FIXTURE_DIR, "metadata.xml")).getroot()
+        for s in root.findall("screenshot"):
+            if s.find("error") is not None:
+                root.remove(s)
+            else:
+                name = s.find("relative_file_name").text
+                shutil.copyfile(join(FIXTURE_DIR, name), join(device_dir, name))
+        ET.ElementTree(root).write(join(device_dir, "metadata.xml"))
+        shutil.copyfile(join(FIXTURE_DIR, "one_dump.json"), join(device_dir, "one_dump.json"))
+        return device
+
+    def test_pull_changed_only_leaves_recorded_screenshots_on_device(self):
+        from .recorder import Recorder
+        device = self._make_device()
+        record_dir = tempfile.mkdtemp()
+        verify_input = tempfile.mkdtemp()
+        try:
+            pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller(device))
+            Recorder(self.tmpdir, record_dir, None).record(incremental=True)
+
+            puller = AdbPuller(device)
+            pulled = []
+            pull = puller.pull
+            puller.pull = lambda src, dest: pulled.append(src) or pull(src, dest)
+            pull_screenshots.pull_all(TESTING_PACKAGE, verify_input, adb_puller=puller,
+                                      reference_dir=record_dir)
+            self.assertEqual([], [src for src in pulled if src.endswith(".png")])
+
+            recorder = Recorder(verify_input, record_dir, None)
+            recorder.verify()
+            self.assertEqual(2, recorder.stats["screenshots"])
+            self.assertEqual(2, recorder.stats["tile_matches"])
+
+            for report in (pull_screenshots.generate_html, pull_screenshots.generate_paged_html):
+                report(verify_input)
+                with io.open(join(verify_input, "index.html"), encoding="utf-8") as f:
+                    html = f.read()
+                if report is pull_screenshots.generate_paged_html:
+                    with io.open(join(verify_input, pull_screenshots.REPORT_PAGES_DIR, "page-0.js"), encoding="utf-8") as f:
+                        html = f.read()
+                self.assertEqual(2, html.count("not pulled from the device"))
+                self.assertNotIn("<td></td>", html)
+        finally:
+            shutil.rmtree(device)
+            shutil.rmtree(record_dir)
+            shutil.rmtree(verify_input)
+
+    def test_pull_changed_only_through_pull_screenshots(self):
+        from .recorder import Recorder
+        device = self._make_device()
+        record_dir = tempfile.mkdtemp()
+        try:
+            pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller(device))
+            Recorder(self.tmpdir, record_dir, None).record(incremental=True)
+
+            # the Recorder is made before the pull leaves the tiles on the device
+            for i, options in enumerate([dict(verify=record_dir, jobs=1),
+                                         dict(verify=record_dir, jobs=2),
+                                         dict(record=record_dir, incremental_record=True)]):
+                pull_screenshots.pull_screenshots(TESTING_PACKAGE, adb_puller=AdbPuller(device),
+                                                  temp_dir=join(self.tmpdir, "run%d" % i),
+                                                  pull_changed_only=True, **options)
+                self.assertEqual([], [name for name in self._list_files(join(self.tmpdir, "run%d" % i))
+                                      if name.endswith(".png") and "ScriptsFixtureTest" in name])
+        finally:
+            shutil.rmtree(device)
+            shutil.rmtree(record_dir)
+
+    def test_pull_changed_only_pulls_unknown_screenshots(self):
+        device = self._make_device()
+        record_dir = tempfile.mkdtemp()
+        try:
+            # nothing was recorded yet
+            pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller(device),
+                                      reference_dir=record_dir)
+            self.assertEqual(2, len(os.listdir(join(self.tmpdir, "com.facebook.testing.screenshot.ScriptsFixtureTest"))))
+        finally:
+            shutil.rmtree(device)
+            shutil.rmtree(record_dir)
+
+    def _flaky_puller(self, device, failures):
+        """A puller whose pulls of screenshots fail as often as failures
+        says, and that remembers what it pulled"""
+        puller = AdbPuller(device)
+        puller.pulled = []
+        pull = puller.pull
+
+        def flaky_pull(src, dest):
+            name = os.path.basename(src)
+            if failures.get(name):
+                failures[name] -= 1
+                raise subprocess.CalledProcessError(1, ["adb", "pull", src], b"error: device offline\n")
+            puller.pulled.append(name)
+            pull(src, dest)
+
+        puller.pull = flaky_pull
+        return puller
+
+    def test_failed_pull_is_resumed(self):
+        device = self._make_device()
+        try:
+            with patch.object(pull_journal, "RETRIES", 0):
+                puller = self._flaky_puller(device, {"com.foo.ScriptsFixtureTest_testSecondScreenshot.png": 1})
+                self.assertRaises(subprocess.CalledProcessError, pull_screenshots.pull_all,
+                                  TESTING_PACKAGE, self.tmpdir, adb_puller=puller)
+                self.assertIn("com.foo.ScriptsFixtureTest_testGetTextViewScreenshot.png", puller.pulled)
+
+                puller = self._flaky_puller(device, {})
+                pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=puller)
+                self.assertNotIn("com.foo.ScriptsFixtureTest_testGetTextViewScreenshot.png", puller.pulled)
+                self.assertIn("com.foo.ScriptsFixtureTest_testSecondScreenshot.png", puller.pulled)
+        finally:
+            shutil.rmtree(device)
+
+    def test_changed_file_is_not_resumed(self):
+        device = self._make_device()
+        try:
+            pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller(device))
+            device_file = join(device, "sdcard/screenshots", TESTING_PACKAGE, "screenshots-default",
+                               "com.foo.ScriptsFixtureTest_testSecondScreenshot.png")
+            os.utime(device_file, (0, 0))
+
+            puller = self._flaky_puller(device, {})
+            pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=puller)
+            self.assertEqual(["com.foo.ScriptsFixtureTest_testSecondScreenshot.png"],
+                             [name for name in puller.pulled if name.endswith(".png")])
+        finally:
+            shutil.rmtree(device)
+
+    def test_flaky_pull_is_retried(self):
+        device = self._make_device()
+        try:
+            puller = self._flaky_puller(device, {"com.foo.ScriptsFixtureTest_testSecondScreenshot.png": 2})
+            with patch.object(pull_journal.time, "sleep") as sleep:
+                pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=puller)
+            self.assertEqual([call(1.0), call(2.0)], sleep.call_args_list)
+            self.assertIn("com.foo.ScriptsFixtureTest_testSecondScreenshot.png", puller.pulled)
+        finally:
+            shutil.rmtree(device)
+
+    def test_local_errors_are_not_retried(self):
+        def pull():
+            raise IOError(28, "No space left on device")
+
+        with patch.object(pull_journal.time, "sleep") as sleep:
+            self.assertRaises(IOError, pull_journal.with_retries, pull)
+        self.assertEqual([], sleep.call_args_list)
+
+    def test_missing_files_are_not_retried(self):
+        for error in [subprocess.CalledProcessError(1, ["adb", "pull"],
+                                                    b"adb: error: remote object '/sdcard/a.png' does not exist\n"),
+                      adb_client.AdbError("pull /sdcard/a.png: No such file or directory")]:
+            with patch.object(pull_journal.time, "sleep") as sleep:
+                self.assertRaises(type(error), pull_journal.with_retries, Mock(side_effect=error))
+            self.assertEqual([], sleep.call_args_list)
+
+    def test_transport_errors_are_retried(self):
+        for error in [subprocess.CalledProcessError(1, ["adb", "pull"], b"error: device offline\n"),
+                      adb_client.AdbError("Connection closed by adb server"),
+                      socket.timeout()]:
+            pull = Mock(side_effect=[error, "pulled"])
+            with patch.object(pull_journal.time, "sleep"):
+                self.assertEqual("pulled", pull_journal.with_retries(pull))
+
+    def test_selected_screenshots_leave_metadata_alone(self):
+        device = self._make_device()
+        try:
+            puller = self._flaky_puller(device, {})
+            selector = metadata.Selector(name_globs=["*_testSecond*"])
+            screenshots = pull_screenshots.pull_filtered(TESTING_PACKAGE, self.tmpdir, adb_puller=puller,
+                                                         selector=selector)
+
+            self.assertEqual(["com.foo.ScriptsFixtureTest_testSecondScreenshot"],
+                             [s.name for s in screenshots])
+            self.assertEqual(["com.foo.ScriptsFixtureTest_testSecondScreenshot.png"],
+                             [name for name in puller.pulled if name.endswith(".png")])
+            self.assertEqual(2, len(metadata.parse(join(self.tmpdir, "metadata.xml"))))
+        finally:
+            shutil.rmtree(device)
+
+    def test_screenshots_are_announced_as_they_are_pulled(self):
+        device = self._make_device()
+        try:
+            events = []
+            puller = self._flaky_puller(device, {})
+            pull = puller.pull
+            puller.pull = lambda src, dest: events.append(("pull", os.path.basename(src))) or pull(src, dest)
+
+            pull_screenshots.pull_filtered(TESTING_PACKAGE, self.tmpdir, adb_puller=puller,
+                                           on_screenshot_pulled=lambda name: events.append(("ready", name)))
+
+            first = events.index(("ready", "com.foo.ScriptsFixtureTest_testGetTextViewScreenshot"))
+            second = events.index(("pull", "com.foo.ScriptsFixtureTest_testSecondScreenshot.png"))
+            self.assertTrue(first < second)
+            self.assertIn(("ready", "com.foo.ScriptsFixtureTest_testSecondScreenshot"), events)
+        finally:
+            shutil.rmtree(device)
+
+    def test_verify_while_pulling(self):
+        device = self._make_device()
+        record_dir = tempfile.mkdtemp()
+        try:
+            pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller(device))
+            from .recorder import Recorder
+            Recorder(self.tmpdir, record_dir, None).record()
+
+            verify_input = join(self.tmpdir, "verify")
+            pull_screenshots.pull_screenshots(TESTING_PACKAGE, adb_puller=AdbPuller(device),
+                                              temp_dir=verify_input, verify=record_dir, jobs=2)
+        finally:
+            shutil.rmtree(device)
+            shutil.rmtree(record_dir)
+
+    def test_verify_pipeline_is_aborted_when_the_report_fails(self):
+        device = self._make_device()
+        record_dir = tempfile.mkdtemp()
+        try:
+            pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller(device))
+            from .recorder import Recorder
+            Recorder(self.tmpdir, record_dir, None).record()
+
+            pipeline = MagicMock()
+            with patch.object(Recorder, "start_verify", return_value=pipeline), \
+                    patch.object(pull_screenshots, "generate_html", side_effect=IOError("disk full")):
+                self.assertRaises(IOError, pull_screenshots.pull_screenshots, TESTING_PACKAGE,
+                                  adb_puller=AdbPuller(device), temp_dir=join(self.tmpdir, "verify"),
+                                  verify=record_dir, jobs=2)
+            pipeline.abort.assert_called_once_with()
+            pipeline.finish.assert_not_called()
+        finally:
+            shutil.rmtree(device)
+            shutil.rmtree(record_dir)
+
+    def test_single_job_verify_does_not_start_a_pipeline(self):
+        device = self._make_device()
+        record_dir = tempfile.mkdtemp()
+        try:
+            pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller(device))
+            from .recorder import Recorder
+            Recorder(self.tmpdir, record_dir, None).record()
+
+            with patch.object(Recorder, "start_verify") as start_verify:
+                pull_screenshots.pull_screenshots(TESTING_PACKAGE, adb_puller=AdbPuller(device),
+                                                  temp_dir=join(self.tmpdir, "verify"),
+                                                  verify=record_dir, jobs=1)
+            start_verify.assert_not_called()
+        finally:
+            shutil.rmtree(device)
+            shutil.rmtree(record_dir)
+
+    def test_sharded_verify_offline(self):
+        device = self._make_device()
+        record_dir = tempfile.mkdtemp()
+        try:
+            pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller(device))
+            from .recorder import Recorder
+            Recorder(self.tmpdir, record_dir, None).record()
+
+            failure_dirs = []
+            for i in range(2):
+                failure_dirs.append(join(self.tmpdir, "failures%d" % i))
+                pull_screenshots.pull_screenshots(TESTING_PACKAGE, adb_puller=None, perform_pull=False,
+                                                  temp_dir=self.tmpdir, verify=record_dir,
+                                                  failure_dir=failure_dirs[-1],
+                                                  shard_index=i, shard_count=2)
+
+            merged = sharding.merge(failure_dirs, join(self.tmpdir, "merged"))["."]
+            self.assertEqual([], merged["missing_shards"])
+            self.assertEqual(["testGetTextViewScreenshot", "testSecondScreenshot"],
+                             [s["test_name"] for s in merged["screenshots"] if s["passed"]])
+        finally:
+            shutil.rmtree(device)
+            shutil.rmtree(record_dir)
+
+    def test_recording_a_subset_keeps_other_references(self):
+        device = self._make_device()
+        record_dir = tempfile.mkdtemp()
+        try:
+            pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller(device))
+            from .recorder import Recorder
+            Recorder(self.tmpdir, record_dir, None).record()
+            recorded = self._list_files(record_dir)
+
+            selector = metadata.Selector(name_globs=["*_testSecond*"])
+            for incremental in (False, True):
+                pull_screenshots.pull_screenshots(TESTING_PACKAGE, adb_puller=None, perform_pull=False,
+                                                  temp_dir=self.tmpdir, record=record_dir,
+                                                  incremental_record=incremental, selector=selector)
+                self.assertEqual(recorded, self._list_files(record_dir))
+        finally:
+            shutil.rmtree(device)
+            shutil.rmtree(record_dir)
+
+    def _list_files(self, dir):
+        return sorted(os.path.relpath(join(root, name), dir)
+                      for root, _, names in os.walk(dir) for name in names
+                      if name != pull_journal.JOURNAL_FILE_NAME)
+
+    def test_parallel_pull_gets_the_same_files(self):
+        pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller())
+        parallel_dir = tempfile.mkdtemp(prefix="screenshots")
+        try:
+            pull_screenshots.pull_all(TESTING_PACKAGE, parallel_dir, adb_puller=AdbPuller(), pull_jobs=4)
+            self.assertEqual(self._list_files(self.tmpdir), self._list_files(parallel_dir))
+        finally:
+            shutil.rmtree(parallel_dir)
+
+    def test_pull_directory_keeps_only_needed_files(self):
+        pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller())
+        directory_dir = tempfile.mkdtemp(prefix="screenshots")
+        try:
+            pull_screenshots.pull_all(TESTING_PACKAGE, directory_dir, adb_puller=AdbPuller(),
+                                      pull_directory=True)
+            self.assertEqual(self._list_files(self.tmpdir), self._list_files(directory_dir))
+            self.assertEqual(sorted(set(os.listdir(self.tmpdir)) - set([pull_journal.JOURNAL_FILE_NAME])),
+                             sorted(os.listdir(directory_dir)))
+        finally:
+            shutil.rmtree(directory_dir)
+
+
+    def test_pull_directory_twice_into_the_same_directory(self):
+        pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller(), pull_directory=True)
+        files = self._list_files(self.tmpdir)
+        pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller(), pull_directory=True)
+        self.assertEqual(files, self._list_files(self.tmpdir))
+
+    def test_shared_files_are_pulled_once(self):
+        screenshots = metadata.parse(io.BytesIO(b"""<screenshots>
+          <screenshot><name>one</name><test_class>Foo</test_class><view_hierarchy>dump.json</view_hierarchy>
+            <relative_file_name>one.png</relative_file_name></screenshot>
+          <screenshot><name>two</name><test_class>Foo</test_class><view_hierarchy>dump.json</view_hierarchy>
+            <relative_file_name>one.png</relative_file_name></screenshot>
+        </screenshots>"""))
+        pulls = pull_screenshots._get_image_pulls(self.tmpdir, screenshots)
+        self.assertEqual(["one.png", "dump.json"], [relative for relative, _ in pulls])
+
 
 class TestPullScreenshots(unittest.TestCase):
     def setUp(self):
@@ -137,6 +542,63 @@ class TestPullScreenshots(unittest.TestCase):
         html = pull_screenshots.generate_html(self.tmpdir)
         self.assertTrue(os.path.exists(html))
 
+    def test_generate_html_in_chunks(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='screenshots')
+        pull_screenshots.pull_all(TESTING_PACKAGE, self.tmpdir, adb_puller=AdbPuller())
+        with open(pull_screenshots.generate_html(self.tmpdir), "rb") as f:
+            expected = f.read()
+
+        with patch.object(pull_screenshots, "REPORT_CHUNK_SCREENSHOTS", 1):
+            with open(pull_screenshots.generate_html(self.tmpdir), "rb") as f:
+                self.assertEqual(expected, f.read())
+
+    def test_generate_paged_html(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='screenshots')
+        device_dir = join(CURRENT_DIR, "fixtures/sdcard/screenshots", TESTING_PACKAGE, "screenshots-default")
+        for name in os.listdir(device_dir):
+            shutil.copy(join(device_dir, name), self.tmpdir)
+        index = pull_screenshots.generate_paged_html(self.tmpdir, page_size=2)
+
+        with io.open(index, encoding="utf-8") as f:
+            contents = f.read()
+        self.assertEqual(3, contents.count('class="screenshot '))
+        self.assertNotIn("<img", contents)
+        self.assertIn("Outofmem and such", contents)
+
+        pages = []
+        for page in range(2):
+            with io.open(join(self.tmpdir, "report", "page-%d.js" % page), encoding="utf-8") as f:
+                script = f.read()
+            prefix = "screenshotReportPage(%d, " % page
+            self.assertTrue(script.startswith(prefix))
+            pages.append(json.loads(script[len(prefix):-len(");\n")]))
+        self.assertFalse(os.path.exists(join(self.tmpdir, "report", "page-2.js")))
+
+        bodies = pages[0] + pages[1]
+        self.assertEqual(3, len(bodies))
+        # sorted by name, and the error has no body
+        self.assertIsNone(bodies[0])
+        self.assertIn('<img src="./com.foo.ScriptsFixtureTest_testGetTextViewScreenshot.png" loading="lazy" />',
+                      bodies[1])
+
+    def test_write_deep_view_hierarchy(self):
+        # deeper than the recursion limit
+        hierarchy = {"class": "Leaf", "left": 0, "top": 0, "width": 1, "height": 1}
+        for i in range(5000):
+            hierarchy = {"left": 0, "top": 0, "width": 1, "height": 1, "children": [hierarchy]}
+        html = io.StringIO()
+        pull_screenshots.write_view_hierarchy_tree_node(hierarchy, html, 1, False)
+
+        output = html.getvalue()
+        self.assertEqual(5001, output.count("<details>"))
+        self.assertEqual(5001, output.count("</details>"))
+        self.assertTrue(output.endswith("<summary>Leaf</summary><ul>"
+                                        "<li><strong>height:</strong> 1</li>"
+                                        "<li><strong>left:</strong> 0</li>"
+                                        "<li><strong>top:</strong> 0</li>"
+                                        "<li><strong>width:</strong> 1</li>"
+                                        "</ul>" + "</details>" * 5001))
+
     def test_adb_puller_sanity(self):
         self.assertTrue(AdbPuller().remote_file_exists("/sdcard"))
 
@@ -227,17 +689,17 @@ class TestPullScreenshots(unittest.TestCase):
             assertRegex(self, e.args[0], "You must supply a directory for temp_dir")
 
     def test_screenshots_with_same_group_ordered_together(self):
-        xml = ET.fromstring("""<screenshots>
+        xml = metadata.parse(io.BytesIO(b"""<screenshots>
           <screenshot><name>one</name><group>foo</group></screenshot>
           <screenshot><name>two</name></screenshot>
           <screenshot><name>three</name><group>foo</group></screenshot>
-        </screenshots>""")
+        </screenshots>"""))
 
-        screenshots = pull_screenshots.sort_screenshots(xml.iter('screenshot'))
+        screenshots = pull_screenshots.sort_screenshots(xml)
 
         self.assertEquals(
             ["two", "one", "three"],
-            [x.find('name').text for x in screenshots])
+            [x.name for x in screenshots])
 
     def test_invalid_xml(self):
         source = join(tempfile.mkdtemp(), "foo")
@@ -259,6 +721,62 @@ class TestPullScreenshots(unittest.TestCase):
         except RuntimeError as e:
             assertRegex(self, e.args[0], ".*ScreenshotRunner.*")
 
+class TestPullDevices(unittest.TestCase):
+    def test_errors_are_collected_in_order(self):
+        def pull(puller_args):
+            if puller_args[-1] == "bad":
+                raise RuntimeError("no device")
+
+        args_list = [["-s", "good"], ["-s", "bad"], ["-s", "other"]]
+        with patch("traceback.print_exc"):
+            results = pull_screenshots.pull_devices(args_list, pull)
+
+        self.assertEqual(args_list, [args for args, _ in results])
+        self.assertIsNone(results[0][1])
+        self.assertIsInstance(results[1][1], RuntimeError)
+        self.assertIsNone(results[2][1])
+
+    def test_single_device_runs_inline(self):
+        pulled = []
+        results = pull_screenshots.pull_devices([[]], pulled.append)
+        self.assertEqual([[]], pulled)
+        self.assertEqual([([], None)], results)
+
+    def test_devices_run_in_order_when_not_concurrent(self):
+        threads = []
+
+        def pull(puller_args):
+            threads.append((puller_args[-1], threading.current_thread()))
+
+        args_list = [["-s", "first"], ["-s", "second"]]
+        results = pull_screenshots.pull_devices(args_list, pull, concurrent=False)
+
+        self.assertEqual(["first", "second"], [serial for serial, _ in threads])
+        self.assertTrue(all(thread is threading.current_thread() for _, thread in threads))
+        self.assertEqual([None, None], [error for _, error in results])
+
+
+    def _temp_dirs(self, *args):
+        calls = []
+        with patch.dict(os.environ), \
+                patch.object(pull_screenshots.common, "get_connected_devices", return_value=["one", "two"]), \
+                patch.object(pull_screenshots, "DeviceNameCalculator"), \
+                patch.object(pull_screenshots, "pull_screenshots",
+                             side_effect=lambda *a, **kw: calls.append((kw["temp_dir"], kw["perform_pull"]))):
+            os.environ.pop("ANDROID_SERIAL", None)
+            self.assertEqual(0, pull_screenshots.main(["pull_screenshots", "com.foo"] + list(args)))
+        return sorted(calls)
+
+    def test_devices_share_temp_dir_without_multiple_devices(self):
+        self.assertEqual([("out", True), ("out", True)], self._temp_dirs("--temp-dir", "out"))
+        self.assertEqual([("out", False)], self._temp_dirs("--temp-dir", "out", "--no-pull"))
+
+    def test_multiple_devices_have_their_own_temp_dir(self):
+        for perform_pull, args in [(True, []), (False, ["--no-pull"])]:
+            self.assertEqual([(join("out", "one"), perform_pull), (join("out", "two"), perform_pull)],
+                             self._temp_dirs("--temp-dir", "out", "--multiple-devices", "true", *args))
+
+
 class TestAndroidJoin(unittest.TestCase):
     def test_simple(self):
         self.assertEquals("/foo/bar",
@@ -4,9 +4,17 @@ import tempfile
 import unittest
 import shutil
 import os
+import sys
 from os.path import join, exists
+from . import recorder
+from .png_reader import PngReader
 from .recorder import Recorder, VerifyError
 
+if sys.version_info >= (3,):
+    from unittest.mock import patch
+else:
+    from mock import patch
+
 from PIL import Image
 
 class TestRecorder(unittest.TestCase):
@@ -209,8 +217,9 @@ class TestRecorder(unittest.TestCase):
         try:
             self.recorder.verify()
             self.fail("expected exception")
-        except VerifyError:
-            pass  # expected
+        except VerifyError as e:
+            # the stitched image that was compared, not one of its tiles
+            self.assertIn(join(join(self.failureDir, "FooBar"), "foobar_actual.png"), str(e))
 
         self.assertTrue(os.path.exists(join(join(self.failureDir, "FooBar"), "foobar_actual.png")))
         self.assertTrue(os.path.exists(join(join(self.failureDir, "FooBar"), "foobar_expected.png")))
@@ -228,6 +237,356 @@ class TestRecorder(unittest.TestCase):
             self.assertEqual((0, 128, 0, 255), im.getpixel((1, 1)))
             self.assertEqual((0, 128, 0, 255), im.getpixel((9, 1)))
 
+    def test_verify_failures_are_aggregated_in_order(self):
+        self.create_temp_image("", "foo.png", (10, 10), "blue")
+        self.create_temp_image("", "bar.png", (10, 10), "red")
+        self.make_metadata("""<screenshots>
+    <screenshot>
+        <test_class>Foo</test_class>
+        <test_name>foo</test_name>
+        <name>foo</name>
+        <tile_width>1</tile_width>
+        <tile_height>1</tile_height>
+    </screenshot>
+    <screenshot>
+        <test_class>Bar</test_class>
+        <test_name>bar</test_name>
+        <name>bar</name>
+        <tile_width>1</tile_width>
+        <tile_height>1</tile_height>
+    </screenshot>
+    </screenshots>""")
+
+        self.recorder.record()
+        self.create_temp_image("", "foo.png", (10, 10), "green")
+        self.create_temp_image("", "bar.png", (10, 10), "green")
+
+        recorder = Recorder(self.inputdir, self.outputdir, None, workers=2)
+        try:
+            recorder.verify()
+            self.fail("expected exception")
+        except VerifyError as e:
+            message = str(e)
+
+        # without failure artifacts, the first differing block is enough
+        self.assertEqual(20, recorder.stats["rows"])
+        self.assertTrue(recorder.stats["rows_scanned"] <= 20)
+
+        foo = message.find(join(join(self.outputdir, "Foo"), "foo.png"))
+        bar = message.find(join(join(self.outputdir, "Bar"), "bar.png"))
+        self.assertTrue(0 <= foo < bar)
+        self.assertIn("is not same as screenshot foo (not written without a failure directory)\n", message)
+
+    def test_pipelined_verify(self):
+        self.create_temp_image("", "foo.png", (10, 10), "blue")
+        self.create_temp_image("", "bar.png", (10, 10), "red")
+        self.make_metadata("""<screenshots>
+    <screenshot>
+        <test_class>Foo</test_class>
+        <test_name>foo</test_name>
+        <name>foo</name>
+        <tile_width>1</tile_width>
+        <tile_height>1</tile_height>
+    </screenshot>
+    <screenshot>
+        <test_class>Bar</test_class>
+        <test_name>bar</test_name>
+        <name>bar</name>
+        <tile_width>1</tile_width>
+        <tile_height>1</tile_height>
+    </screenshot>
+    </screenshots>""")
+
+        self.recorder.record()
+        self.create_temp_image("", "bar.png", (10, 10), "green")
+
+        recorder = Recorder(self.inputdir, self.outputdir, None, workers=2)
+        pipeline = recorder.start_verify()
+        pipeline.submit("bar")
+        pipeline.submit("bar")
+        pipeline.submit("unknown")
+        # foo is verified by finish()
+        self.assertRaises(VerifyError, pipeline.finish)
+        self.assertEqual(2, recorder.stats["screenshots"])
+        self.assertEqual(1, recorder.stats["tile_matches"])
+
+    def test_verify_skips_decoding_unchanged_references(self):
+        self.create_temp_image("", "foo.png", (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+    <screenshot>
+        <test_class>Foo</test_class>
+        <test_name>foo</test_name>
+        <name>foo</name>
+        <tile_width>1</tile_width>
+        <tile_height>1</tile_height>
+    </screenshot>
+    </screenshots>""")
+
+        self.recorder.record()
+        self.assertTrue(exists(join(self.outputdir, "manifest.json")))
+
+        def fail(*args):
+            raise AssertionError("reference should not be compared")
+
+        self.recorder._compare = fail
+        self.recorder._stitch = fail
+        self.recorder.verify()
+        self.assertEqual(1, self.recorder.stats["tile_matches"])
+        self.assertEqual(0, self.recorder.stats["rows_scanned"])
+
+    def test_verify_falls_back_to_pixel_hash_for_reencoded_tiles(self):
+        self.create_temp_image("", "foo.png", (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+    <screenshot>
+        <test_class>Foo</test_class>
+        <test_name>foo</test_name>
+        <name>foo</name>
+        <tile_width>1</tile_width>
+        <tile_height>1</tile_height>
+    </screenshot>
+    </screenshots>""")
+
+        self.recorder.record()
+        Image.new("RGBA", (10, 10), "blue").save(join(self.inputdir, "foo.png"), compress_level=0)
+
+        self.recorder.verify()
+        self.assertEqual(1, self.recorder.stats["hash_matches"])
+
+        # the new tile hashes are remembered for the next run
+        self.recorder.verify()
+        self.assertEqual(1, self.recorder.stats["tile_matches"])
+
+    def test_verify_rebuilds_manifest_for_edited_reference(self):
+        self.create_temp_image("", "foo.png", (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+    <screenshot>
+        <test_class>Foo</test_class>
+        <test_name>foo</test_name>
+        <name>foo</name>
+        <tile_width>1</tile_width>
+        <tile_height>1</tile_height>
+    </screenshot>
+    </screenshots>""")
+
+        self.recorder.record()
+        reference = join(join(self.outputdir, "Foo"), "foo.png")
+        Image.new("RGB", (10, 10), "blue").save(reference)
+
+        self.recorder.verify()
+
+        with open(join(self.outputdir, "manifest.json")) as f:
+            self.assertTrue('"mode": "RGB"' in f.read())
+
+    def test_verify_success_writes_no_failure_artifacts(self):
+        self.create_temp_image("Foo", "foo.png", (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+    <screenshot>
+        <test_class>Foo</test_class>
+        <test_name>foo</test_name>
+        <name>foo</name>
+        <tile_width>1</tile_width>
+        <tile_height>1</tile_height>
+    </screenshot>
+    </screenshots>""")
+
+        self.recorder.record()
+        os.remove(join(self.outputdir, "manifest.json"))
+        self.recorder.verify()
+
+        self.assertEqual([], os.listdir(self.failureDir))
+
+    def test_each_tile_is_decoded_once(self):
+        for x in range(3):
+            for y in range(2):
+                name = "foobar.png" if x == 0 and y == 0 else "foobar_%d_%d.png" % (x, y)
+                self.create_temp_image("Foo", name, (10 if x < 2 else 4, 10 if y < 1 else 7), "blue")
+
+        self.make_metadata("""<screenshots>
+    <screenshot>
+       <test_class>Foo</test_class>
+       <test_name>Bar</test_name>
+       <name>foobar</name>
+        <tile_width>3</tile_width>
+        <tile_height>2</tile_height>
+    </screenshot>
+    </screenshots>""")
+
+        with patch.object(recorder.Image, "open", wraps=recorder.Image.open) as image_open:
+            im = self.recorder._stitch("foobar", "Foo", 3, 2)
+
+        self.assertEqual(6, image_open.call_count)
+        self.assertEqual((24, 17), im.size)
+
+    def _make_tall_screenshot(self, color_of_last_row="red"):
+        for y in range(4):
+            for x in range(2):
+                name = "foobar.png" if x == 0 and y == 0 else "foobar_%d_%d.png" % (x, y)
+                color = color_of_last_row if y == 3 else "blue"
+                self.create_temp_image("Foo", name, (10 if x < 1 else 6, 10 if y < 3 else 5), color)
+
+        self.make_metadata("""<screenshots>
+    <screenshot>
+       <test_class>Foo</test_class>
+       <test_name>Bar</test_name>
+       <name>foobar</name>
+        <tile_width>2</tile_width>
+        <tile_height>4</tile_height>
+    </screenshot>
+    </screenshots>""")
+
+    def test_record_in_strips(self):
+        self._make_tall_screenshot()
+        expected = self.recorder._stitch("foobar", "Foo", 2, 4)
+
+        recorder = Recorder(self.inputdir, self.outputdir, None, strip_budget=16 * 20 * 4)
+        recorder.record()
+
+        with Image.open(join(join(self.outputdir, "Foo"), "Bar.png")) as im:
+            self.assertEqual((16, 35), im.size)
+            self.assertEqual(expected.tobytes(), im.tobytes())
+
+    def test_verify_in_strips(self):
+        self._make_tall_screenshot()
+        self.recorder.record()
+        os.remove(join(self.outputdir, "manifest.json"))
+
+        recorder = Recorder(self.inputdir, self.outputdir, self.failureDir, strip_budget=1)
+        recorder.verify()
+
+        self._make_tall_screenshot(color_of_last_row="green")
+        try:
+            recorder.verify()
+            self.fail("expected exception")
+        except VerifyError:
+            pass  # expected
+
+        with Image.open(join(join(self.failureDir, "Foo"), "foobar_diff.png")) as im:
+            self.assertEqual((255, 0, 0, 255), im.getpixel((0, 30)))
+            self.assertEqual((255, 0, 0, 255), im.getpixel((15, 30)))
+            self.assertEqual((255, 0, 0, 255), im.getpixel((0, 34)))
+            self.assertEqual((0, 0, 255, 255), im.getpixel((1, 29)))
+
+    def test_verify_in_strips_reads_the_reference_in_strips(self):
+        self._make_tall_screenshot()
+        strip_recorder = Recorder(self.inputdir, self.outputdir, None, strip_budget=16 * 10 * 4)
+        strip_recorder.record()
+        os.remove(join(self.outputdir, "manifest.json"))
+        self._make_tall_screenshot(color_of_last_row="green")
+
+        strips = []
+        read = PngReader.read
+        with patch.object(recorder, "_CroppingReader", side_effect=AssertionError), \
+                patch.object(PngReader, "read", autospec=True,
+                             side_effect=lambda reader, nrows: strips.append(nrows) or read(reader, nrows)):
+            self.assertRaises(VerifyError, strip_recorder.verify)
+
+        self.assertTrue(strips)
+        self.assertTrue(max(strips) <= 10)
+
+    def test_workers_are_not_forked(self):
+        if not hasattr(recorder.multiprocessing, "get_context"):
+            return
+
+        with patch.object(recorder.multiprocessing, "get_context") as get_context:
+            recorder._make_pool(2)
+        self.assertIn(get_context.call_args[0][0], ("forkserver", "spawn"))
+
+    def test_incremental_record(self):
+        self.create_temp_image("", "foo.png", (10, 10), "blue")
+        self.create_temp_image("", "bar.png", (10, 10), "red")
+        self.make_metadata("""<screenshots>
+    <screenshot>
+        <test_class>Foo</test_class>
+        <test_name>foo</test_name>
+        <name>foo</name>
+        <tile_width>1</tile_width>
+        <tile_height>1</tile_height>
+    </screenshot>
+    <screenshot>
+        <test_class>Bar</test_class>
+        <test_name>bar</test_name>
+        <name>bar</name>
+        <tile_width>1</tile_width>
+        <tile_height>1</tile_height>
+    </screenshot>
+    </screenshots>""")
+        self.recorder.record()
+        foo = join(join(self.outputdir, "Foo"), "foo.png")
+        os.utime(foo, (0, 0))
+
+        self.create_temp_image("", "baz.png", (10, 10), "green")
+        self.create_temp_image("", "bar.png", (10, 10), "green")
+        self.make_metadata("""<screenshots>
+    <screenshot>
+        <test_class>Foo</test_class>
+        <test_name>foo</test_name>
+        <name>foo</name>
+        <tile_width>1</tile_width>
+        <tile_height>1</tile_height>
+    </screenshot>
+    <screenshot>
+        <test_class>Foo</test_class>
+        <test_name>baz</test_name>
+        <name>baz</name>
+        <tile_width>1</tile_width>
+        <tile_height>1</tile_height>
+    </screenshot>
+    </screenshots>""")
+
+        counts = self.recorder.record(incremental=True)
+
+        self.assertEqual({"added": 1, "updated": 0, "removed": 1, "unchanged": 1}, counts)
+        self.assertEqual(0, os.stat(foo).st_mtime)
+        self.assertTrue(exists(join(join(self.outputdir, "Foo"), "baz.png")))
+        self.assertFalse(exists(join(self.outputdir, "Bar")))
+
+    def test_incremental_record_updates_changed_references(self):
+        self.create_temp_image("", "foo.png", (10, 10), "blue")
+        self.make_metadata("""<screenshots>
+    <screenshot>
+        <test_class>Foo</test_class>
+        <test_name>foo</test_name>
+        <name>foo</name>
+        <tile_width>1</tile_width>
+        <tile_height>1</tile_height>
+    </screenshot>
+    </screenshots>""")
+        self.recorder.record()
+        os.remove(join(self.outputdir, "manifest.json"))
+        self.create_temp_image("", "foo.png", (10, 10), "red")
+
+        counts = self.recorder.record(clean_record=False, incremental=True)
+
+        self.assertEqual({"added": 0, "updated": 1, "removed": 0, "unchanged": 0}, counts)
+        with Image.open(join(join(self.outputdir, "Foo"), "foo.png")) as im:
+            self.assertEqual((255, 0, 0, 255), im.getpixel((0, 0)))
+
+    def test_record_with_compression_options(self):
+        self.create_temp_image("", "foo.png", (10, 10), "blue")
+        self.create_temp_image("", "bar.png", (10, 10), "red")
+        self.make_metadata("""<screenshots>
+    <screenshot>
+        <test_class>Foo</test_class>
+        <test_name>foo</test_name>
+        <name>foo</name>
+        <tile_width>1</tile_width>
+        <tile_height>1</tile_height>
+    </screenshot>
+    <screenshot>
+        <test_class>Bar</test_class>
+        <test_name>bar</test_name>
+        <name>bar</name>
+        <tile_width>1</tile_width>
+        <tile_height>1</tile_height>
+    </screenshot>
+    </screenshots>""")
+
+        for options in [{"compress_level": 0}, {"compress_level": 1, "workers": 2}, {"optimize": True}]:
+            Recorder(self.inputdir, self.outputdir, None, **options).record()
+            self.recorder.verify()
+            with Image.open(join(join(self.outputdir, "Bar"), "bar.png")) as im:
+                self.assertEqual((255, 0, 0, 255), im.getpixel((5, 5)))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from os.path import join
+
+from . import merge_results
+from . import metadata
+from . import sharding
+
+
+def _screenshots(count):
+    xml = "<screenshots>%s</screenshots>" % "".join(
+        "<screenshot><name>com.foo.Test_%d</name><test_class>com.foo.Test</test_class>"
+        "<test_name>test%d</test_name></screenshot>" % (i, i) for i in range(count))
+    return metadata.parse(io.BytesIO(xml.encode("utf-8")))
+
+
+class TestSharding(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _check_partition(self, screenshots, shards):
+        names = [s.name for shard in shards for s in shard]
+        self.assertEqual(sorted(s.name for s in screenshots), sorted(names))
+        for shard in shards:
+            # in the original order
+            self.assertEqual([s for s in screenshots if s in shard], shard)
+
+    def test_split(self):
+        screenshots = _screenshots(100)
+        shards = [sharding.split(screenshots, i, 4) for i in range(4)]
+
+        self._check_partition(screenshots, shards)
+        self.assertTrue(all(shards))
+        # the same on every node, whatever else is in the run
+        self.assertEqual([s.name for s in shards[1]],
+                         [s.name for s in sharding.split(screenshots[::-1], 1, 4)][::-1])
+
+    def test_split_by_cost(self):
+        screenshots = _screenshots(9)
+        costs = [100, 1, 1, 1, 1, 50, 50, 1, 1]
+        shards = [sharding.split(screenshots, i, 2, costs) for i in range(2)]
+
+        self._check_partition(screenshots, shards)
+        loads = sorted(sum(costs[screenshots.index(s)] for s in shard) for shard in shards)
+        self.assertEqual([103, 103], loads)
+
+    def test_bad_shard_index(self):
+        self.assertRaises(ValueError, sharding.split, _screenshots(1), 2, 2)
+
+    def test_reference_costs(self):
+        with open(join(self.tmpdir, "manifest.json"), "w") as f:
+            json.dump({"com.foo.Test/test0": {"width": 10, "height": 20},
+                       "com.foo.Test/test1": {"width": 10, "height": 40}}, f)
+
+        self.assertEqual([200, 400, 300], sharding.reference_costs(self.tmpdir, _screenshots(3)))
+
+    def _write_shard(self, index, count, passed):
+        shard_dir = join(self.tmpdir, "shard%d" % index)
+        results = [{"name": "com.foo.Test_%d" % index, "test_class": "com.foo.Test",
+                    "test_name": "test%d" % index, "passed": passed}]
+        os.makedirs(join(shard_dir, "com.foo.Test"))
+        if not passed:
+            with open(join(shard_dir, "com.foo.Test", "com.foo.Test_%d_diff.png" % index), "w") as f:
+                f.write("diff")
+        sharding.write_results(shard_dir, index, count, {"screenshots": 1, "rows": 10}, results)
+        return shard_dir
+
+    def test_merge(self):
+        shard_dirs = [self._write_shard(0, 2, True), self._write_shard(1, 2, False)]
+        output = join(self.tmpdir, "merged")
+        merged = sharding.merge(shard_dirs, output)
+
+        results = merged["."]
+        self.assertEqual([], results["missing_shards"])
+        self.assertEqual({"screenshots": 2, "rows": 20}, results["stats"])
+        self.assertEqual([True, False], [s["passed"] for s in results["screenshots"]])
+        self.assertTrue(os.path.exists(join(output, "com.foo.Test", "com.foo.Test_1_diff.png")))
+        with open(join(output, sharding.REPORT_FILE_NAME)) as f:
+            self.assertIn("com.foo.Test/com.foo.Test_1_diff.png", f.read())
+
+    def test_merge_results_exit_code(self):
+        output = join(self.tmpdir, "merged")
+        old_stdout = sys.stdout
+        sys.stdout = io.StringIO() if sys.version_info >= (3,) else io.BytesIO()
+        try:
+            passed = self._write_shard(0, 2, True)
+            self.assertEqual(1, merge_results.main(["merge_results", "--output", output, passed]))
+            self.assertEqual(0, merge_results.main(["merge_results", "--output", output, passed,
+                                                    self._write_shard(1, 2, True)]))
+            self.assertEqual(2, merge_results.main(["merge_results", passed]))
+        finally:
+            sys.stdout = old_stdout
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,8 +12,16 @@ import tempfile
 from .common import get_adb
 import shutil
 import os
+import sys
+from . import adb_client
+from . import simple_puller
 from . import common
 
+if sys.version_info >= (3,):
+    from unittest.mock import *
+else:
+    from mock import *
+
 class TestSimplePuller(unittest.TestCase):
     def setUp(self):
         self.puller = SimplePuller()
@@ -54,5 +62,46 @@ class TestSimplePuller(unittest.TestCase):
         ]
         self.assertIn(self.puller.get_external_data_dir(), accepted_dirs)
 
+class TestSimplePullerListing(unittest.TestCase):
+    LISTING = "\n".join([
+        "E /sdcard",
+        "D /sdcard/screenshots/com.foo/screenshots-default",
+        "F 1234 1500000000 /sdcard/screenshots/com.foo/screenshots-default/metadata.xml",
+        "F 99 1500000000 /sdcard/screenshots/com.foo/screenshots-default/sub/foo.png",
+        "M /data/data/com.foo/app_screenshots-default",
+        ""])
+
+    def setUp(self):
+        self.puller = SimplePuller(["-s", "foo"])
+        self.puller._shell = MagicMock(return_value=self.LISTING)
+        self.files = self.puller.list_remote([
+            "$EXTERNAL_STORAGE/screenshots/com.foo/screenshots-default",
+            "/data/data/com.foo/app_screenshots-default"])
+
+    def test_listing(self):
+        self.assertEqual((1234, 1500000000),
+                         self.files["/sdcard/screenshots/com.foo/screenshots-default/metadata.xml"])
+        self.assertEqual(1, self.puller._shell.call_count)
+
+    def test_answers_from_listing(self):
+        self.assertEqual("/sdcard", self.puller.get_external_data_dir())
+        self.assertTrue(self.puller.remote_file_exists(
+            "/sdcard/screenshots/com.foo/screenshots-default/metadata.xml"))
+        self.assertTrue(self.puller.remote_file_exists(
+            "/sdcard/screenshots/com.foo/screenshots-default/sub"))
+        self.assertFalse(self.puller.remote_file_exists(
+            "/sdcard/screenshots/com.foo/screenshots-default/screenshot_bundle.zip"))
+        self.assertFalse(self.puller.remote_file_exists(
+            "/data/data/com.foo/app_screenshots-default/metadata.xml"))
+        self.assertEqual(1, self.puller._shell.call_count)
+
+    def test_unlisted_paths_are_probed(self):
+        with patch.object(adb_client, "get_client", return_value=None), \
+                patch.object(simple_puller, "get_adb", return_value="adb"), \
+                patch.object(common, "check_output", return_value="EXISTS\n") as check_output:
+            self.assertTrue(self.puller.remote_file_exists("/sdcard/other"))
+            self.assertEqual(1, check_output.call_count)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+from . import zip_stream
+
+
+class _Unseekable(io.RawIOBase):
+    """What ZipFile writes to when streaming, like ZipOutputStream on the
+    device it leaves the sizes to a data descriptor after each member"""
+
+    def __init__(self):
+        self.data = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self.data.write(b)
+
+
+class TestZipStream(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.members = {
+            "foo.png": os.urandom(100000),
+            "com.foo.Bar/baz.png": b"baz" * 10000,
+            "empty.json": b"",
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _zip(self, out, compression=zipfile.ZIP_DEFLATED):
+        with zipfile.ZipFile(out, "w", compression) as z:
+            for name in sorted(self.members):
+                z.writestr(name, self.members[name])
+
+    def _read(self, name):
+        with open(os.path.join(self.tmpdir, name), "rb") as f:
+            return f.read()
+
+    def _extract(self, data, wanted=None):
+        # small reads to exercise headers split across reads
+        return zip_stream.extract(io.BufferedReader(io.BytesIO(data), 7), self.tmpdir, wanted)
+
+    def test_extract(self):
+        for compression in [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED]:
+            out = io.BytesIO()
+            self._zip(out, compression)
+            names = self._extract(out.getvalue())
+
+            self.assertEqual(sorted(self.members), sorted(names))
+            for name, data in self.members.items():
+                self.assertEqual(data, self._read(name))
+
+    @unittest.skipIf(sys.version_info < (3, 5), "ZipFile cannot write to unseekable files")
+    def test_extract_with_data_descriptors(self):
+        out = _Unseekable()
+        self._zip(out)
+        names = self._extract(out.data.getvalue())
+
+        self.assertEqual(sorted(self.members), sorted(names))
+        for name, data in self.members.items():
+            self.assertEqual(data, self._read(name))
+
+    def test_only_wanted(self):
+        out = io.BytesIO()
+        self._zip(out)
+        names = self._extract(out.getvalue(), wanted=set(["com.foo.Bar/baz.png"]))
+
+        self.assertEqual(["com.foo.Bar/baz.png"], names)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "foo.png")))
+
+    def test_names_cannot_escape(self):
+        self.members = {"../../evil.png": b"evil"}
+        out = io.BytesIO()
+        self._zip(out)
+        self._extract(out.getvalue())
+
+        self.assertEqual(b"evil", self._read("evil.png"))
+
+    def test_corrupt_data(self):
+        out = io.BytesIO()
+        self._zip(out, zipfile.ZIP_STORED)
+        data = bytearray(out.getvalue())
+        data[100] ^= 0xff
+
+        self.assertRaises(zip_stream.BadZipStream, self._extract, bytes(data))
+
+    def test_truncated(self):
+        out = io.BytesIO()
+        self._zip(out)
+
+        self.assertRaises(zip_stream.BadZipStream, self._extract, out.getvalue()[:5000])
+
+
+if __name__ == '__main__':
+    unittest.main()
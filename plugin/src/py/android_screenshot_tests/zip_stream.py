@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import struct
+import zlib
+
+# Extracts a zip archive as it is read front to back, using the local file
+# headers in front of every member instead of the central directory at the
+# end, so that the archive never needs to be on disk.
+
+_LOCAL_HEADER = b"PK\x03\x04"
+_LOCAL_HEADER_FORMAT = "<4sHHHHHIIIHH"
+_LOCAL_HEADER_SIZE = struct.calcsize(_LOCAL_HEADER_FORMAT)
+_DATA_DESCRIPTOR = b"PK\x07\x08"
+_CENTRAL_DIRECTORY = b"PK\x01\x02"
+_END_OF_CENTRAL_DIRECTORY = b"PK\x05\x06"
+
+# the sizes are in a data descriptor after the data
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_ENCRYPTED = 0x01
+
+_STORED = 0
+_DEFLATED = 8
+
+_CHUNK = 64 * 1024
+
+
+class BadZipStream(Exception):
+    pass
+
+
+class _Reader:
+    """Reads exact amounts from a stream, with data read too far pushed back"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._buffer = b""
+
+    def read_chunk(self):
+        if self._buffer:
+            chunk, self._buffer = self._buffer, b""
+            return chunk
+        return self._stream.read(_CHUNK)
+
+    def read(self, n):
+        chunks = []
+        while n:
+            chunk = self.read_chunk()
+            if not chunk:
+                raise BadZipStream("Unexpected end of stream")
+            if len(chunk) > n:
+                self.unread(chunk[n:])
+                chunk = chunk[:n]
+            chunks.append(chunk)
+            n -= len(chunk)
+        return b"".join(chunks)
+
+    def unread(self, data):
+        self._buffer = data + self._buffer
+
+    def drain(self):
+        while self.read_chunk():
+            pass
+
+
+def _safe_path(dest_dir, name):
+    # like ZipFile.extract(), drop anything that would escape dest_dir
+    parts = [part for part in name.replace("\\", "/").split("/")
+             if part not in ("", ".", "..")]
+    if not parts:
+        return None
+    return os.path.join(dest_dir, *parts)
+
+
+def _copy_sized(reader, size, method, out):
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if method == _DEFLATED else None
+    crc = 0
+    while size:
+        chunk = reader.read(min(size, _CHUNK))
+        size -= len(chunk)
+        if decompressor:
+            chunk = decompressor.decompress(chunk)
+        crc = zlib.crc32(chunk, crc)
+        if out:
+            out.write(chunk)
+    if decompressor:
+        chunk = decompressor.flush()
+        crc = zlib.crc32(chunk, crc)
+        if out:
+            out.write(chunk)
+    return crc & 0xffffffff
+
+
+def _copy_until_end_of_deflate(reader, out):
+    # The compressed size is only known after the data, but deflate marks
+    # its own end, after which anything left over goes back to the reader
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    crc = 0
+    while not decompressor.unused_data:
+        chunk = reader.read_chunk()
+        if not chunk:
+            raise BadZipStream("Unexpected end of stream")
+        chunk = decompressor.decompress(chunk)
+        crc = zlib.crc32(chunk, crc)
+        if out:
+            out.write(chunk)
+    reader.unread(decompressor.unused_data)
+    return crc & 0xffffffff
+
+
+def _read_data_descriptor(reader):
+    # the signature of the descriptor is optional
+    data = reader.read(4)
+    if data == _DATA_DESCRIPTOR:
+        data = reader.read(4)
+    crc = struct.unpack("<I", data)[0]
+    reader.read(8)
+    return crc
+
+
+def extract(stream, dest_dir, wanted=None):
+    """Extracts the zip archive read from stream into dest_dir, only the
+    members whose name is in wanted if it is given. Returns the names of
+    the extracted members."""
+    reader = _Reader(stream)
+    extracted = []
+    while True:
+        signature = reader.read(4)
+        if signature in (_CENTRAL_DIRECTORY, _END_OF_CENTRAL_DIRECTORY):
+            # nothing but the index of what was already read is left
+            reader.drain()
+            return extracted
+        if signature != _LOCAL_HEADER:
+            raise BadZipStream("Bad local header signature %r" % signature)
+
+        (_, _, flags, method, _, _, crc, compressed_size, _, name_length,
+         extra_length) = struct.unpack(_LOCAL_HEADER_FORMAT, signature + reader.read(_LOCAL_HEADER_SIZE - 4))
+        name = reader.read(name_length).decode("utf-8" if flags & 0x800 else "cp437")
+        reader.read(extra_length)
+
+        if flags & _FLAG_ENCRYPTED:
+            raise BadZipStream("%s is encrypted" % name)
+        if method not in (_STORED, _DEFLATED):
+            raise BadZipStream("%s uses unsupported compression method %d" % (name, method))
+        has_descriptor = flags & _FLAG_DATA_DESCRIPTOR
+        if has_descriptor and method != _DEFLATED:
+            raise BadZipStream("%s has no size and is not deflated" % name)
+
+        path = None
+        if wanted is None or name in wanted:
+            path = _safe_path(dest_dir, name)
+        if path and name.endswith("/"):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            path = None
+
+        out = None
+        if path:
+            parent = os.path.dirname(path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            out = open(path, "wb")
+        try:
+            if has_descriptor:
+                actual_crc = _copy_until_end_of_deflate(reader, out)
+                crc = _read_data_descriptor(reader)
+            else:
+                actual_crc = _copy_sized(reader, compressed_size, method, out)
+        finally:
+            if out:
+                out.close()
+
+        if actual_crc != crc:
+            raise BadZipStream("Bad CRC for %s" % name)
+        if path:
+            extracted.append(name)